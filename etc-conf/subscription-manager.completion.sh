@@ -52,6 +52,19 @@ _subscription_manager_remove()
   COMPREPLY=($(compgen -W "${opts}" -- ${1}))
 }
 
+_subscription_manager_cache()
+{
+  case $prev in
+      --invalidate)
+          CACHES=$(LANG=C /usr/sbin/subscription-manager cache --list 2>/dev/null | sed -ne "s|Cache:\s*\(\S*\)|\1|p" )
+          COMPREPLY=($(compgen -W "${CACHES} all" -- ${1}))
+          return 0
+  esac
+  local opts="--list --invalidate --reset-stats
+              -h --help"
+  COMPREPLY=($(compgen -W "${opts}" -- ${1}))
+}
+
 _subscription_manager_clean()
 {
   local opts="-h --help"
@@ -200,11 +213,12 @@ _subscription_manager()
   prev="${COMP_WORDS[COMP_CWORD-1]}"
 
   # top-level commands and options
-  opts="attach auto-attach clean config environments facts identity import list orgs
+  opts="attach auto-attach cache clean config environments facts identity import list orgs
         repo-override plugins redeem refresh register release remove repos service-level status
         subscribe unregister unsubscribe version"
 
   case "${first}" in
+      cache|\
       clean|\
       config|\
       environments|\
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Compare loading a directory of certificates lazily, one after another,
+# against loading them in a pool of worker processes (see
+# parallel_cert_parse_threshold in rhsm.conf), to find how many certificates
+# it takes for the pool to win on this machine. Both do what listing a
+# certificate directory does.
+#
+# Usage: PYTHONPATH=src scripts/bench_cert_parsing.py CERT.pem [COUNT ...]
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from rhsm.certificate import create_from_file, CertificateException
+from rhsm.certificate2 import EntitlementCertificate
+from subscription_manager.certindex import cert_to_record, \
+        create_lazy_cert, parse_records, ENTITLEMENT, PRODUCT
+
+DEFAULT_COUNTS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+ROUNDS = 3
+
+
+def make_dir(cert_path, count):
+    d = tempfile.mkdtemp(prefix="bench-certs-")
+    paths = []
+    for i in range(count):
+        path = os.path.join(d, "%d.pem" % i)
+        shutil.copy(cert_path, path)
+        paths.append(path)
+    return d, paths
+
+
+def best_of(func, paths, cert_type):
+    best = None
+    for i in range(ROUNDS):
+        start = time.time()
+        func(paths, cert_type)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def serial(paths, cert_type):
+    return [cert_to_record(create_lazy_cert(path, cert_type))
+            for path in paths]
+
+
+def main(args):
+    if not args:
+        print "Usage: %s CERT.pem [COUNT ...]" % sys.argv[0]
+        return 1
+    cert_path = args[0]
+    counts = [int(count) for count in args[1:]] or DEFAULT_COUNTS
+    try:
+        cert = create_from_file(cert_path)
+    except (IOError, CertificateException), e:
+        print "Unable to read %s: %s" % (cert_path, e)
+        return 1
+    cert_type = PRODUCT
+    if isinstance(cert, EntitlementCertificate):
+        cert_type = ENTITLEMENT
+
+    print "%8s %12s %12s %8s" % ("certs", "serial (s)", "parallel (s)", "speedup")
+    crossover = None
+    for count in counts:
+        d, paths = make_dir(cert_path, count)
+        try:
+            serial_time = best_of(serial, paths, cert_type)
+            parallel_time = best_of(parse_records, paths, cert_type)
+        finally:
+            shutil.rmtree(d)
+        print "%8d %12.4f %12.4f %7.2fx" % (count, serial_time, parallel_time,
+                serial_time / parallel_time)
+        if crossover is None and parallel_time < serial_time:
+            crossover = count
+
+    if crossover is None:
+        print "\nParsing in parallel never paid off here."
+    else:
+        print "\nSuggested parallel_cert_parse_threshold: %d" % crossover
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -48,7 +48,7 @@ def main(options, log):
         if options.autoheal:
             actionclient = action_client.HealingActionClient()
         else:
-            actionclient = action_client.ActionClient()
+            actionclient = action_client.ActionClient(prune=True)
 
         actionclient.update(options.autoheal)
 
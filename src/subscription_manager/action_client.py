@@ -21,7 +21,8 @@ import logging
 
 from rhsm.connection import GoneException, ExpiredIdentityCertException
 
-from subscription_manager.entcertlib import EntCertActionInvoker
+from subscription_manager.entcertlib import EntCertActionInvoker, \
+        EntCertPruneActionInvoker
 from subscription_manager.identitycertlib import IdentityCertActionInvoker
 from subscription_manager.healinglib import HealingActionInvoker
 from subscription_manager.factlib import FactsActionInvoker
@@ -29,6 +30,7 @@ from subscription_manager.repolib import RepoActionInvoker
 from subscription_manager.packageprofilelib import PackageProfileActionInvoker
 from subscription_manager.installedproductslib import InstalledProductsActionInvoker
 from subscription_manager import injection as inj
+from subscription_manager.consumer_state import CONSUMER, OVERRIDES
 
 log = logging.getLogger('rhsm-app.' + __name__)
 
@@ -53,6 +55,25 @@ class BaseActionClient(object):
     def _get_libset(self):
         return []
 
+    def _get_prefetch(self):
+        """
+        Returns the consumer state (see consumer_state.py) the libset is
+        going to need, to be fetched all at once up front.
+        """
+        return []
+
+    def _prefetch(self):
+        names = self._get_prefetch()
+        identity = inj.require(inj.IDENTITY)
+        if not names or not identity.is_valid():
+            return
+        try:
+            uep = inj.require(inj.CP_PROVIDER).get_consumer_auth_cp()
+            inj.require(inj.CONSUMER_STATE).prefetch(uep, identity.uuid, names)
+        except Exception, e:
+            # Whatever needs it will try again, and handle the error:
+            log.warning("Unable to prefetch consumer state: %s" % e)
+
     def update(self, autoheal=False):
         """
         Update I{entitlement} certificates and corresponding
@@ -65,6 +86,7 @@ class BaseActionClient(object):
         # TODO: move to using a lock context manager
         try:
             lock.acquire()
+            self._prefetch()
             self.update_reports = self._run_updates(autoheal)
         finally:
             lock.release()
@@ -105,9 +127,17 @@ class BaseActionClient(object):
 
 class ActionClient(BaseActionClient):
 
+    def __init__(self, facts=None, prune=False):
+        # Only rhsmcertd archives expired certs, not interactive commands:
+        self.prune = prune
+        super(ActionClient, self).__init__(facts=facts)
+
     def _get_libset(self):
 
         self.entcertlib = EntCertActionInvoker()
+        self.prunelib = None
+        if self.prune:
+            self.prunelib = EntCertPruneActionInvoker()
         self.repolib = RepoActionInvoker()
         self.factlib = FactsActionInvoker()
         self.profilelib = PackageProfileActionInvoker()
@@ -116,13 +146,20 @@ class ActionClient(BaseActionClient):
 
         # WARNING: order is important here, we need to update a number
         # of things before attempting to autoheal, and we need to autoheal
-        # before attempting to fetch our certificates:
-        lib_set = [self.entcertlib, self.idcertlib, self.repolib,
-                   self.factlib, self.profilelib,
-                   self.installedprodlib]
+        # before attempting to fetch our certificates. Expired certs are
+        # archived before the repos are updated from what is left:
+        lib_set = [self.entcertlib]
+        if self.prunelib:
+            lib_set.append(self.prunelib)
+        lib_set.extend([self.idcertlib, self.repolib, self.factlib,
+                        self.profilelib, self.installedprodlib])
 
         return lib_set
 
+    def _get_prefetch(self):
+        # For idcertlib and repolib:
+        return [CONSUMER, OVERRIDES]
+
 
 class HealingActionClient(BaseActionClient):
     def _get_libset(self):
@@ -19,11 +19,20 @@ this with the current state, and perform an update on the server if
 necessary.
 """
 
+import atexit
+import copy
 import gettext
+import gzip
+import hashlib
+import inspect
 import logging
 import os
+import rpm
 import socket
+import tempfile
 import threading
+import time
+from iniparse.compat import NoOptionError, NoSectionError
 from M2Crypto import SSL
 
 from rhsm.config import initConfig
@@ -41,6 +50,401 @@ PACKAGES_RESOURCE = "packages"
 cfg = initConfig()
 
 
+GZIP_MAGIC = "\x1f\x8b"
+
+# How much encoded JSON to collect before writing it out:
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+def _compress_caches():
+    """
+    Whether caches which can get large should be written compressed.
+    """
+    try:
+        return bool(cfg.get_int('rhsm', 'compress_caches'))
+    except (NoSectionError, NoOptionError):
+        return False
+    except ValueError, e:
+        log.warn(e)
+        return False
+
+
+def open_cache_file(path):
+    """
+    Open a cache file for reading, whether it was written compressed or not.
+    """
+    f = open(path, "rb")
+    try:
+        magic = f.read(len(GZIP_MAGIC))
+    finally:
+        f.close()
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def write_cache_file(path, data, compress=False):
+    """
+    Replace the cache file at path with data encoded as JSON.
+
+    The JSON is encoded a piece at a time into a temporary file next to
+    the cache, which is synced to disk and then renamed over the cache,
+    so readers only ever see the old or the new cache in full.
+    """
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir,
+            prefix=".%s." % os.path.basename(path))
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            out = f
+            if compress:
+                out = gzip.GzipFile(filename=os.path.basename(path),
+                        mode="wb", fileobj=f)
+            chunks = []
+            size = 0
+            for chunk in json.JSONEncoder().iterencode(data):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= WRITE_BUFFER_SIZE:
+                    out.write("".join(chunks))
+                    chunks = []
+                    size = 0
+            out.write("".join(chunks))
+            if compress:
+                # Doesn't close f, just finishes the gzip stream:
+                out.close()
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _supports_conditional_get(uep):
+    """
+    Whether the connection lets us send our own request headers and see
+    the response headers, which conditional requests need.
+    """
+    base = getattr(connection, 'BaseRestLib', None)
+    if base is None or not isinstance(getattr(uep, 'conn', None), base):
+        return False
+    return 'headers' in inspect.getargspec(base._request)[0]
+
+
+def cert_dirs_state():
+    """
+    Returns a string which changes whenever a certificate is added to,
+    or removed from, any of the cert directories.
+    """
+    state = []
+    for option in ('consumerCertDir', 'entitlementCertDir', 'productCertDir'):
+        try:
+            state.append(repr(os.stat(cfg.get('rhsm', option)).st_mtime))
+        except OSError:
+            state.append("-")
+    return ",".join(state)
+
+
+def data_digest(data):
+    """
+    Returns a digest of the given JSON serializable data, which is the
+    same for equal data regardless of dict ordering.
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    if isinstance(canonical, unicode):
+        canonical = canonical.encode('utf-8')
+    return hashlib.sha256(canonical).hexdigest()
+
+
+class CacheStats(object):
+    """
+    Tracks how the caches are doing across runs: how often they could be
+    used as they were (hits) or had to be synced with the server
+    (misses), how long syncing took, and how large they are.
+
+    Counts are kept in memory and added to those in the stats file when
+    the process exits, so keeping them is next to free. Processes exiting
+    at the same moment can lose each other's counts, which is good enough
+    for what these are for.
+    """
+    STATS_FILE = "/var/lib/rhsm/cache/cache_stats.json"
+    VERSION = 1
+
+    # Counts which add up across runs, the rest is just the latest value:
+    COUNTERS = ["hits", "misses", "errors", "syncs", "sync_time"]
+
+    def __init__(self, path=None):
+        self.path = path or self.STATS_FILE
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._save_at_exit = False
+
+    def _record(self, name, counts=None, values=None):
+        self._lock.acquire()
+        try:
+            entry = self._pending.setdefault(name, {})
+            for (key, count) in (counts or {}).items():
+                entry[key] = entry.get(key, 0) + count
+            entry.update(values or {})
+            if not self._save_at_exit:
+                self._save_at_exit = True
+                atexit.register(self.save)
+        finally:
+            self._lock.release()
+
+    def hit(self, name):
+        self._record(name, {"hits": 1})
+
+    def miss(self, name):
+        self._record(name, {"misses": 1})
+
+    def error(self, name):
+        self._record(name, {"errors": 1})
+
+    def synced(self, name, duration):
+        self._record(name, {"syncs": 1, "sync_time": duration},
+                {"last_sync": time.time(), "last_sync_time": duration})
+
+    def wrote(self, name, size):
+        self._record(name, values={"size": size, "last_write": time.time()})
+
+    def _read(self):
+        try:
+            f = open_cache_file(self.path)
+            try:
+                stats = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(stats, dict) or stats.get("version") != self.VERSION:
+            return {}
+        return stats.get("caches", {})
+
+    def _merge(self, caches):
+        for (name, pending) in self._pending.items():
+            entry = caches.setdefault(name, {})
+            for (key, value) in pending.items():
+                if key in self.COUNTERS:
+                    entry[key] = entry.get(key, 0) + value
+                else:
+                    entry[key] = value
+
+    def load(self):
+        """
+        Returns a dict of cache name to its stats, including those not
+        saved yet.
+        """
+        self._lock.acquire()
+        try:
+            caches = self._read()
+            self._merge(caches)
+        finally:
+            self._lock.release()
+        return caches
+
+    def _write(self, caches):
+        write_cache_file(self.path, {"version": self.VERSION,
+            "caches": caches})
+
+    def save(self):
+        """
+        Add what was recorded to the stats file.
+        """
+        # Don't create the cache directory just for stats:
+        if not self._pending or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        self._lock.acquire()
+        try:
+            caches = self._read()
+            self._merge(caches)
+            self._pending = {}
+        finally:
+            self._lock.release()
+        try:
+            self._write(caches)
+        except (IOError, OSError):
+            # Stats are not worth failing (or logging at exit) for
+            pass
+
+    def reset(self, names=None):
+        """
+        Forget the stats for the given cache names, or all of them.
+        """
+        self._lock.acquire()
+        try:
+            caches = self._read()
+            for name in (names or caches.keys() + self._pending.keys()):
+                caches.pop(name, None)
+                self._pending.pop(name, None)
+        finally:
+            self._lock.release()
+        if os.path.exists(self.path):
+            self._write(caches)
+
+
+cache_stats = CacheStats()
+
+
+class CacheWriter(object):
+    """
+    Writes caches in the background, so whoever updated one never waits
+    on the disk.
+
+    A single thread does all the writing, and goes away when there has
+    been nothing to write for a while. Only the latest version of each
+    cache file is written, in the order the cache files were queued, and
+    whatever is still queued when the process exits is written first.
+    """
+    # Seconds the thread waits for more to write before going away:
+    IDLE_TIMEOUT = 5
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # Cache files in the order they were queued, and what to write
+        # for each:
+        self._queue = []
+        self._pending = {}
+        # The cache file being written right now:
+        self._writing = None
+        self._thread = None
+        self._closed = False
+        self._close_at_exit = False
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                    name="CacheWriter")
+            self._thread.setDaemon(True)
+            self._thread.start()
+        if not self._close_at_exit:
+            self._close_at_exit = True
+            atexit.register(self.close)
+
+    def write(self, cache):
+        """
+        Queue the cache to be written as it is now, replacing anything
+        still queued for its cache file.
+        """
+        # Later changes to the cache must not change what gets written:
+        snapshot = copy.copy(cache)
+        self._cond.acquire()
+        try:
+            if not self._closed:
+                if snapshot.CACHE_FILE not in self._pending:
+                    self._queue.append(snapshot.CACHE_FILE)
+                self._pending[snapshot.CACHE_FILE] = snapshot
+                self._start()
+                self._cond.notifyAll()
+                return
+        finally:
+            self._cond.release()
+        # Exiting, nobody is left to write it for us:
+        self._write(snapshot)
+
+    def _write(self, snapshot):
+        # Logging in here can cause a segfault, BZ 988861 and 988430
+        try:
+            CacheManager.write_cache(snapshot, False)
+        except Exception:
+            pass
+
+    def _next(self):
+        """
+        Returns the next snapshot to write, or None once there is nothing
+        left to write.
+        """
+        self._cond.acquire()
+        try:
+            self._writing = None
+            self._cond.notifyAll()
+            if not self._queue and not self._closed:
+                self._cond.wait(self.IDLE_TIMEOUT)
+            if not self._queue:
+                self._thread = None
+                return None
+            self._writing = self._queue.pop(0)
+            return self._pending.pop(self._writing)
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        snapshot = self._next()
+        while snapshot is not None:
+            self._write(snapshot)
+            snapshot = self._next()
+
+    def _busy(self, cache_file=None):
+        if cache_file is None:
+            return bool(self._queue) or self._writing is not None
+        return cache_file in self._pending or self._writing == cache_file
+
+    def flush(self, cache_file=None):
+        """
+        Wait until everything queued so far, or just the given cache file,
+        has been written.
+        """
+        self._cond.acquire()
+        try:
+            while self._busy(cache_file) and self._thread is not None:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def discard(self, cache_file):
+        """
+        Drop what is queued for the given cache file, and wait for it if it
+        is being written right now, i.e. before deleting the cache.
+        """
+        self._cond.acquire()
+        try:
+            if cache_file in self._pending:
+                del self._pending[cache_file]
+                self._queue.remove(cache_file)
+            while self._writing == cache_file and self._thread is not None:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """
+        Write whatever is still queued and stop the thread, any later
+        writes are done right away. Called when the process exits.
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread is not None:
+            thread.join()
+
+        # In case the thread is gone without finishing:
+        self._cond.acquire()
+        try:
+            snapshots = [self._pending.pop(cache_file) for cache_file in self._queue]
+            self._queue = []
+        finally:
+            self._cond.release()
+        for snapshot in snapshots:
+            self._write(snapshot)
+
+
+cache_writer = CacheWriter()
+
+
 class CacheManager(object):
     """
     Parent class used for common logic in a number of collections
@@ -52,6 +456,13 @@ class CacheManager(object):
     # Fields the subclass must override:
     CACHE_FILE = None
 
+    # Suffixes of the files kept next to CACHE_FILE, see _write_sidecar:
+    SIDECARS = ["digest"]
+
+    # Whether this cache can get large enough to be worth compressing
+    # (if compress_caches is enabled in rhsm.conf):
+    COMPRESSIBLE = False
+
     def to_dict(self):
         """
         Returns the data for this collection as a dict to be serialized
@@ -79,12 +490,97 @@ class CacheManager(object):
         """
         raise NotImplementedError
 
+    def _digest_data(self):
+        """
+        Returns the data the cache digest is computed from. Sub-classes
+        should leave out anything has_changed() ignores, and put anything
+        whose order does not matter in a canonical order.
+        """
+        return self.to_dict()
+
+    @classmethod
+    def stats_name(cls):
+        """
+        The name this cache goes by in the cache stats, and on the command
+        line.
+        """
+        return os.path.splitext(os.path.basename(cls.CACHE_FILE))[0]
+
+    def _sidecar_path(self, suffix):
+        return "%s.%s" % (self.CACHE_FILE, suffix)
+
+    def _digest_path(self):
+        return self._sidecar_path("digest")
+
+    def _read_sidecar(self, suffix):
+        """
+        Returns the value stored next to the cache with the given suffix,
+        or None if there is none or the cache file was written without
+        updating it.
+        """
+        try:
+            f = open(self._sidecar_path(suffix))
+            try:
+                header = f.readline().split()
+                value = f.read()
+            finally:
+                f.close()
+            st = os.stat(self.CACHE_FILE)
+        except (IOError, OSError):
+            return None
+        if header != [repr(st.st_mtime), str(st.st_size)]:
+            return None
+        return value
+
+    def _write_sidecar(self, suffix, value):
+        """
+        Store a string next to the cache, tied to the cache file as it is
+        now.
+        """
+        st = os.stat(self.CACHE_FILE)
+        f = open(self._sidecar_path(suffix), "w")
+        try:
+            f.write("%r %d\n%s" % (st.st_mtime, st.st_size, value))
+        finally:
+            f.close()
+
+    def _write_sidecars(self):
+        """
+        Called once the cache has been written, to write what we keep
+        next to it.
+        """
+        self._write_digest(data_digest(self._digest_data()))
+
+    def _read_digest(self):
+        return self._read_sidecar("digest")
+
+    def _write_digest(self, digest):
+        self._write_sidecar("digest", digest)
+
+    def _digest_changed(self):
+        """
+        Compare a digest of the current data with the one stored with the
+        cache, which is a lot cheaper than loading a large cache.
+
+        Returns True or False if that tells us whether the data changed,
+        None if it can't tell (i.e. there is no usable stored digest), in
+        which case the caller has to compare against the cache itself.
+        """
+        cached_digest = self._read_digest()
+        if cached_digest is None:
+            return None
+        return data_digest(self._digest_data()) != cached_digest
+
     @classmethod
     def delete_cache(cls):
         """ Delete the cache for this collection from disk. """
         if os.path.exists(cls.CACHE_FILE):
             log.info("Deleting cache: %s" % cls.CACHE_FILE)
             os.remove(cls.CACHE_FILE)
+        for suffix in cls.SIDECARS:
+            path = "%s.%s" % (cls.CACHE_FILE, suffix)
+            if os.path.exists(path):
+                os.remove(path)
 
     def _cache_exists(self):
         return os.path.exists(self.CACHE_FILE)
@@ -101,14 +597,14 @@ class CacheManager(object):
         """
         # Logging in this method (when threaded) can cause a segfault, BZ 988861 and 988430
         try:
-            if not os.access(os.path.dirname(self.CACHE_FILE), os.R_OK):
-                os.makedirs(os.path.dirname(self.CACHE_FILE))
-            f = open(self.CACHE_FILE, "w+")
-            json.dump(self.to_dict(), f)
-            f.close()
+            write_cache_file(self.CACHE_FILE, self.to_dict(),
+                    self.COMPRESSIBLE and _compress_caches())
+            self._write_sidecars()
+            cache_stats.wrote(self.stats_name(),
+                    os.path.getsize(self.CACHE_FILE))
             if debug:
                 log.debug("Wrote cache: %s" % self.CACHE_FILE)
-        except IOError, e:
+        except (IOError, OSError), e:
             if debug:
                 log.error("Unable to write cache: %s" %
                         self.CACHE_FILE)
@@ -120,10 +616,11 @@ class CacheManager(object):
         Returns none if no cache file exists.
         """
         try:
-            f = open(self.CACHE_FILE)
-            data = self._load_data(f)
-            f.close()
-            return data
+            f = open_cache_file(self.CACHE_FILE)
+            try:
+                return self._load_data(f)
+            finally:
+                f.close()
         except IOError:
             log.error("Unable to read cache: %s" % self.CACHE_FILE)
         except ValueError:
@@ -136,23 +633,30 @@ class CacheManager(object):
         Check if data has changed, and push an update if so.
         """
         log.info("Checking current system info against cache: %s" % self.CACHE_FILE)
+        name = self.stats_name()
         if self.has_changed() or force:
             log.info("System data has changed, updating server.")
+            cache_stats.miss(name)
             try:
+                started = time.time()
                 self._sync_with_server(uep, consumer_uuid)
+                cache_stats.synced(name, time.time() - started)
                 self.write_cache()
                 # Return the number of 'updates' we did, assuming updating all
                 # packages at once is one update.
                 return 1
             except connection.RestlibException, re:
+                cache_stats.error(name)
                 raise re
             except Exception, e:
+                cache_stats.error(name)
                 log.error("Error updating system data on the server")
                 log.exception(e)
                 raise Exception(_("Error updating system data on the server, see /var/log/rhsm/rhsm.log "
                         "for more details."))
         else:
             log.info("No changes.")
+            cache_stats.hit(name)
             return 0  # No updates performed.
 
 
@@ -161,14 +665,138 @@ class StatusCache(CacheManager):
     Unlike other cache managers, this one gets info from the server rather
     than sending it.
     """
+    SIDECARS = ["digest", "certdirs", "validators"]
+
+    # rhsm.conf option for how many seconds the cache can be used without
+    # asking the server. Without it the server is always asked:
+    TTL_OPTION = None
+
+    # Which resource of the consumer state (see consumer_state.py) the
+    # status comes from:
+    CONSUMER_STATE_KEY = None
+
+    # Response headers which let us ask the server whether the status
+    # changed since:
+    VALIDATORS = {'etag': 'If-None-Match',
+                  'last-modified': 'If-Modified-Since'}
+
     def __init__(self):
         self.server_status = None
         self.last_error = None
+        # Whether the last sync got a status different from the cache:
+        self._changed = True
+        # The state of the cert directories when we last synced:
+        self._synced_cert_dirs = None
+        # Validators from the response the status came from:
+        self._validators = None
+
+    def _get_ttl(self):
+        if not self.TTL_OPTION:
+            return 0
+        try:
+            return cfg.get_int('rhsm', self.TTL_OPTION) or 0
+        except (NoSectionError, NoOptionError):
+            return 0
+        except ValueError, e:
+            log.warn(e)
+            return 0
+
+    def _cert_dirs_state(self):
+        return cert_dirs_state()
+
+    def _write_sidecars(self):
+        CacheManager._write_sidecars(self)
+        self._write_sidecar("certdirs",
+                self._synced_cert_dirs or self._cert_dirs_state())
+        if self._validators:
+            self._write_sidecar("validators", json.dumps(self._validators))
+        elif os.path.exists(self._sidecar_path("validators")):
+            os.remove(self._sidecar_path("validators"))
+
+    def _read_validators(self):
+        value = self._read_sidecar("validators")
+        if not value:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def fetch_status(self, uep, uuid):
+        """
+        Fetch the status from the server, returning a tuple of the status
+        and whether it changed since the cache was written.
+        """
+        raise NotImplementedError
+
+    def _get_consumer_state(self, uep, uuid):
+        """
+        Get our resource from the consumer state shared with everything
+        else needing it during this run.
+        """
+        state = inj.require(inj.CONSUMER_STATE)
+        return state.get(uep, uuid, self.CONSUMER_STATE_KEY,
+                self.__class__.__name__, self.fetch_status)
+
+    def _get_status(self, uep, method, fallback):
+        """
+        GET the status from method, sending the validators from the last
+        response so the server can answer with a 304 (and no body) if it
+        hasn't changed, in which case we use the cache.
+
+        Returns a tuple of the status and whether it changed. fallback is
+        used to get the status if we can't make conditional requests.
+        """
+        if not _supports_conditional_get(uep):
+            return (fallback(), True)
+
+        headers = {}
+        cached = None
+        validators = self._read_validators()
+        if validators:
+            cached = self._read_cache()
+        if cached is not None:
+            for (name, header) in self.VALIDATORS.items():
+                if name in validators:
+                    headers[header] = validators[name]
+
+        response = connection.BaseRestLib._request(uep.conn, "GET", method,
+                headers=headers)
+        if response['status'] == 304 and cached is not None:
+            log.debug("Server status unchanged: %s" % method)
+            self._validators = validators
+            return (cached, False)
+
+        self._validators = dict((name, value) for (name, value)
+                in response.get('headers', {}).items() if name in self.VALIDATORS)
+        if not response['content']:
+            return (None, True)
+        return (json.loads(response['content']), True)
+
+    def is_fresh(self):
+        """
+        True if the cache was written recently enough to be used without
+        asking the server, and no certificates have changed since.
+        """
+        ttl = self._get_ttl()
+        if ttl <= 0:
+            return False
+        try:
+            age = time.time() - os.stat(self.CACHE_FILE).st_mtime
+        except OSError:
+            return False
+        # A cache from the future means the clock moved, don't trust it:
+        if age < 0 or age >= ttl:
+            return False
+        return self._read_sidecar("certdirs") == self._cert_dirs_state()
 
     def load_status(self, uep, uuid):
         """
         Load status from wherever is appropriate.
 
+        If the cache is still fresh (see is_fresh), return it without
+        contacting the server.
+
         If server is reachable, return it's response
         and cache the results to disk.
 
@@ -177,20 +805,39 @@ class StatusCache(CacheManager):
 
         Returns None if we cannot reach the server, or use the cache.
         """
+        name = self.stats_name()
+        if self.is_fresh():
+            status = self._read_cache()
+            if status is not None:
+                log.debug("Using fresh cache: %s" % self.CACHE_FILE)
+                self.last_error = False
+                cache_stats.hit(name)
+                return status
+
         try:
+            self._synced_cert_dirs = self._cert_dirs_state()
+            self._changed = True
+            started = time.time()
             self._sync_with_server(uep, uuid)
+            cache_stats.synced(name, time.time() - started)
+            if self._changed:
+                cache_stats.miss(name)
+            else:
+                cache_stats.hit(name)
             self.write_cache()
             self.last_error = False
             return self.server_status
         except SSL.SSLError, ex:
             log.exception(ex)
             self.last_error = ex
+            cache_stats.error(name)
             log.error("Consumer certificate is invalid")
             return None
         except connection.RestlibException, ex:
             # Indicates we may be talking to a very old candlepin server
             # which does not have the necessary API call.
             self.last_error = ex
+            cache_stats.error(name)
             return None
 
         # If we hit a network error, but no cache exists (extremely unlikely)
@@ -198,6 +845,7 @@ class StatusCache(CacheManager):
         except socket.error, ex:
             log.exception(ex)
             self.last_error = ex
+            cache_stats.error(name)
             if not self._cache_exists():
                 log.error("Server unreachable, registered, but no cache exists.")
                 return None
@@ -208,6 +856,7 @@ class StatusCache(CacheManager):
         except connection.NetworkException, ex:
             log.exception(ex)
             self.last_error = ex
+            cache_stats.error(name)
             if not self._cache_exists():
                 log.error("Server unreachable, registered, but no cache exists.")
                 raise
@@ -217,12 +866,14 @@ class StatusCache(CacheManager):
         except connection.ExpiredIdentityCertException, ex:
             log.exception(ex)
             self.last_error = ex
+            cache_stats.error(name)
             log.error("Bad identity, unable to connect to server")
             return None
         except connection.AuthenticationException, ex:
             log.error("Could not authenticate with server, check registration status.")
             log.exception(ex)
             self.last_error = ex
+            cache_stats.error(name)
             return None
 
     def to_dict(self):
@@ -252,16 +903,21 @@ class StatusCache(CacheManager):
 
     def write_cache(self):
         """
-        This is threaded because it should never block in runtime.
+        This is done in the background because it should never block in
+        runtime, see CacheWriter.
         Writing to disk means it will be read from memory for the rest of this run.
         """
-        threading.Thread(target=super(StatusCache, self).write_cache, args=[False], name="WriteCache%s" % self.__class__.__name__).start()
-        log.debug("Started thread to write cache: %s" % self.CACHE_FILE)
+        cache_writer.write(self)
+        log.debug("Queued cache to be written: %s" % self.CACHE_FILE)
 
     # we override a @classmethod with an instance method in the sub class?
     def delete_cache(self):
+        # Don't let a queued write bring it back:
+        cache_writer.discard(self.CACHE_FILE)
         super(StatusCache, self).delete_cache()
         self.server_status = None
+        self._synced_cert_dirs = None
+        self._validators = None
 
 
 class EntitlementStatusCache(StatusCache):
@@ -271,9 +927,19 @@ class EntitlementStatusCache(StatusCache):
     than sending it.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/entitlement_status.json"
+    COMPRESSIBLE = True
+    TTL_OPTION = "entitlement_status_ttl"
+
+    CONSUMER_STATE_KEY = "compliance"
+
+    def fetch_status(self, uep, uuid):
+        return self._get_status(uep,
+                '/consumers/%s/compliance' % uep.sanitize(uuid),
+                lambda: uep.getCompliance(uuid))
 
     def _sync_with_server(self, uep, uuid):
-        self.server_status = uep.getCompliance(uuid)
+        (self.server_status, self._changed) = \
+                self._get_consumer_state(uep, uuid)
 
 
 class ProductStatusCache(StatusCache):
@@ -281,9 +947,14 @@ class ProductStatusCache(StatusCache):
     Manages the system cache of installed product valid date ranges.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/product_status.json"
+    TTL_OPTION = "product_status_ttl"
 
     def _sync_with_server(self, uep, uuid):
-        consumer_data = uep.getConsumer(uuid)
+        # The consumer is needed in full by others (i.e. healing), so we
+        # share theirs rather than asking for it conditionally:
+        state = inj.require(inj.CONSUMER_STATE)
+        consumer_data = state.get(uep, uuid, "consumer",
+                self.__class__.__name__)
 
         if 'installedProducts' not in consumer_data:
             log.warn("Server does not support product date ranges.")
@@ -296,9 +967,18 @@ class OverrideStatusCache(StatusCache):
     Manages the cache of yum repo overrides set on the server.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/content_overrides.json"
+    TTL_OPTION = "override_status_ttl"
+
+    CONSUMER_STATE_KEY = "overrides"
+
+    def fetch_status(self, uep, uuid):
+        return self._get_status(uep,
+                '/consumers/%s/content_overrides' % uep.sanitize(uuid),
+                lambda: uep.getContentOverrides(uuid))
 
     def _sync_with_server(self, uep, consumer_uuid):
-        self.server_status = uep.getContentOverrides(consumer_uuid)
+        (self.server_status, self._changed) = \
+                self._get_consumer_state(uep, consumer_uuid)
 
 
 # this is injected normally
@@ -307,6 +987,11 @@ class ProfileManager(CacheManager):
     Manages the profile of packages installed on this system.
     """
     CACHE_FILE = "/var/lib/rhsm/packages/packages.json"
+    SIDECARS = ["digest", "rpmdb"]
+    COMPRESSIBLE = True
+
+    # Used to tell whether the rpmdb changed if rpm can't tell us:
+    RPMDB_FILES = ["/var/lib/rpm/Packages", "/var/lib/rpm/rpmdb.sqlite"]
 
     def __init__(self, current_profile=None):
 
@@ -314,6 +999,11 @@ class ProfileManager(CacheManager):
         # we're sure we actually need the data.
         self._current_profile = current_profile
         self._report_package_profile = cfg.get_int('rhsm', 'report_package_profile')
+        # The rpmdb cookie from when we read the current profile:
+        self._rpmdb_cookie = None
+
+        # Details of the last upload, see _record_upload:
+        self.last_upload = None
 
     # give tests a chance to use something other than RPMProfile
     def _get_profile(self, profile_type):
@@ -322,6 +1012,9 @@ class ProfileManager(CacheManager):
     def _get_current_profile(self):
         # If we weren't given a profile, load the current systems packages:
         if not self._current_profile:
+            # Taken first, so a transaction while we read makes us look
+            # again next time:
+            self._rpmdb_cookie = self._get_rpmdb_cookie()
             self._current_profile = self._get_profile('rpm')
         return self._current_profile
 
@@ -339,6 +1032,47 @@ class ProfileManager(CacheManager):
     def _load_data(self, open_file):
         return RPMProfile(from_file=open_file)
 
+    def _get_rpmdb_cookie(self):
+        """
+        Returns a string which changes whenever the rpmdb does, or None if
+        we can't tell.
+        """
+        try:
+            ts = rpm.TransactionSet()
+            if hasattr(ts, 'dbCookie'):
+                return ts.dbCookie()
+        except Exception, e:
+            log.debug("Unable to get the rpmdb cookie: %s" % e)
+        for path in self.RPMDB_FILES:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return "%r-%d-%d" % (st.st_mtime, st.st_size, st.st_ino)
+        return None
+
+    def _rpmdb_unchanged(self):
+        """
+        True if the rpmdb is the same as when the cache was last written,
+        which lets us skip reading it altogether.
+        """
+        # Only meaningful if the profile comes from this system's rpmdb:
+        if self._current_profile and self._rpmdb_cookie is None:
+            return False
+
+        cookie = self._get_rpmdb_cookie()
+        if cookie is None:
+            return False
+        if self._current_profile and cookie != self._rpmdb_cookie:
+            # Read while the rpmdb was different, load it again:
+            self._current_profile = None
+        return cookie == self._read_sidecar("rpmdb")
+
+    def _write_sidecars(self):
+        CacheManager._write_sidecars(self)
+        if self._rpmdb_cookie is not None:
+            self._write_sidecar("rpmdb", self._rpmdb_cookie)
+
     def update_check(self, uep, consumer_uuid, force=False):
         """
         Check if packages have changed, and push an update if so.
@@ -355,17 +1089,40 @@ class ProfileManager(CacheManager):
 
         return CacheManager.update_check(self, uep, consumer_uuid, force)
 
+    def _digest_data(self):
+        # Package order doesn't matter, see RPMProfile.__eq__:
+        return sorted([data_digest(pkg) for pkg in
+            self.current_profile.collect()])
+
     def has_changed(self):
         if not self._cache_exists():
             log.info("Cache does not exist")
             return True
 
+        if self._rpmdb_unchanged():
+            log.debug("rpmdb unchanged since the last package profile upload")
+            return False
+
+        changed = self._digest_changed()
+        if changed is not None:
+            return changed
+
         cached_profile = self._read_cache()
         return not cached_profile == self.current_profile
 
     def _sync_with_server(self, uep, consumer_uuid):
-        uep.updatePackageProfile(consumer_uuid,
-                self.current_profile.collect())
+        packages = self.current_profile.collect()
+        start = time.time()
+        uep.updatePackageProfile(consumer_uuid, packages)
+        self._record_upload(packages, time.time() - start)
+
+    def _record_upload(self, packages, elapsed):
+        self.last_upload = {
+            'packages': len(packages),
+            'time': elapsed,
+        }
+        log.info("Uploaded package profile (%d packages) in %.2fs" %
+                (len(packages), elapsed))
 
 
 class InstalledProductsManager(CacheManager):
@@ -407,10 +1164,14 @@ class InstalledProductsManager(CacheManager):
             log.info("Cache does not exist")
             return True
 
-        cached = self._read_cache()
-
         self._setup_installed()
 
+        changed = self._digest_changed()
+        if changed is not None:
+            return changed
+
+        cached = self._read_cache()
+
         if len(cached.keys()) != len(self.installed.keys()):
             return True
 
@@ -447,27 +1208,82 @@ class InstalledProductsManager(CacheManager):
                 installed_products=self.format_for_server())
 
 
-class PoolTypeCache(object):
+class PoolTypeCache(CacheManager):
+    """
+    Maps pool ids to the type of the pool, which only the server knows.
+
+    The types of attached pools are kept on disk between runs, so we only
+    have to ask the server about pools attached since.
+    """
+    CACHE_FILE = "/var/lib/rhsm/cache/pool_types.json"
+
+    # Up to this many missing pools are fetched one at a time, rather than
+    # with the whole entitlement list:
+    MAX_POOL_FETCHES = 5
 
     def __init__(self):
         self.identity = inj.require(inj.IDENTITY)
         self.cp_provider = inj.require(inj.CP_PROVIDER)
         self.ent_dir = inj.require(inj.ENT_DIR)
         self.pooltype_map = {}
+        if self._cache_exists():
+            self.pooltype_map = self._read_cache() or {}
         self.update()
 
+    def to_dict(self):
+        # Only what is attached is worth keeping:
+        attached_pool_ids = set(self.ent_dir.list_pool_ids())
+        return dict((pool_id, pool_type) for (pool_id, pool_type)
+                in self.pooltype_map.items() if pool_id in attached_pool_ids)
+
+    def _load_data(self, open_file):
+        return json.loads(open_file.read())
+
     def get(self, pool_id):
         return self.pooltype_map.get(pool_id, '')
 
     def update(self):
-        if self.requires_update():
+        missing_pool_ids = self._missing_pool_ids()
+        if not missing_pool_ids:
+            cache_stats.hit(self.stats_name())
+            return
+
+        cache_stats.miss(self.stats_name())
+        started = time.time()
+        # With nothing to go on (i.e. the first run) one big request beats
+        # many small ones:
+        if self.pooltype_map and len(missing_pool_ids) <= self.MAX_POOL_FETCHES:
+            self._update_pools(missing_pool_ids)
+        else:
             self._do_update()
+        cache_stats.synced(self.stats_name(), time.time() - started)
+
+        if set(self.pooltype_map) & missing_pool_ids:
+            self.write_cache()
+
+    def _missing_pool_ids(self):
+        attached_pool_ids = set(self.ent_dir.list_pool_ids())
+        return attached_pool_ids - set(self.pooltype_map)
 
     def requires_update(self):
-        attached_pool_ids = set([ent.pool.id for ent in self.ent_dir.list()
-            if ent.pool and ent.pool.id])
-        missing_types = attached_pool_ids - set(self.pooltype_map)
-        return bool(missing_types)
+        return bool(self._missing_pool_ids())
+
+    def _update_pools(self, pool_ids):
+        """
+        Fetch the given pools from the server one at a time.
+        """
+        if not self.identity.is_valid():
+            return
+        cp = self.cp_provider.get_consumer_auth_cp()
+        for pool_id in pool_ids:
+            try:
+                pool = cp.getPool(pool_id, self.identity.uuid)
+            except Exception, e:
+                # We just won't populate the field for this one
+                log.debug('Problem attempting to get pool %s from the server' % pool_id)
+                log.debug(e)
+                continue
+            self.pooltype_map[pool_id] = PoolWrapper(pool).get_pool_type()
 
     def _do_update(self):
         result = {}
@@ -495,6 +1311,7 @@ class PoolTypeCache(object):
 
     def clear(self):
         self.pooltype_map = {}
+        self.delete_cache()
 
 
 class WrittenOverrideCache(CacheManager):
@@ -78,7 +78,7 @@ class ComplianceManager(object):
         # expired on the date in question. If another valid or partially valid
         # entitlement provides the installed product, that product should not
         # appear in this dict.
-        # Maps product ID to the expired entitlement certificate:
+        # Maps product ID to summaries of the expired entitlement certificates:
         self.expired_products = {}
 
         # Products that are only partially entitled (aka, "yellow"). If another
@@ -97,7 +97,7 @@ class ComplianceManager(object):
         self.partial_stacks = {}
 
         # Products which are installed and entitled sometime in the future.
-        # Maps product ID to future entitlements.
+        # Maps product ID to summaries of the future entitlement certificates.
         self.future_products = {}
 
         # Reasons that products aren't fully compliant
@@ -212,29 +212,32 @@ class ComplianceManager(object):
                                 if k not in self.valid_products.keys()
                                 and k not in self.partially_valid_products.keys())
         ent_certs = self.entitlement_dir.list()
+        # The summaries are all we need to keep for expired and future
+        # entitlements:
+        summaries = self.entitlement_dir.list_summaries()
 
         on_date = datetime.now(GMT())
-        for ent_cert in ent_certs:
+        for ent_cert, summary in zip(ent_certs, summaries):
 
             # Builds the list of valid entitlement certs today:
-            if ent_cert.is_valid():
+            if summary.is_valid():
                 self.valid_entitlement_certs.append(ent_cert)
 
-            for product in ent_cert.products:
-                if product.id in unknown_products.keys():
+            for product_id in summary.product_ids:
+                if product_id in unknown_products:
                     # If the entitlement starts after the date we're checking, we
                     # consider this a future entitlement. Technically it could be
                     # partially stacked on that date, but we cannot determine that
                     # without recursively cert sorting again on that date.
-                    if ent_cert.valid_range.begin() > on_date:
+                    if summary.start > on_date:
                         product_dict = self.future_products
                     # Check if entitlement has already expired:
-                    elif ent_cert.valid_range.end() < on_date:
+                    elif summary.end < on_date:
                         product_dict = self.expired_products
                     else:
                         continue
 
-                    product_dict.setdefault(product.id, []).append(ent_cert)
+                    product_dict.setdefault(product_id, []).append(summary)
 
     def get_system_status(self):
         return STATUS_MAP.get(self.system_status, STATUS_MAP['unknown'])
@@ -318,7 +321,7 @@ class CertSorter(ComplianceManager):
         self.callbacks = set()
 
         self.cert_monitor = file_monitor.Monitor()
-        self.cert_monitor.connect('changed', self.on_cert_changed)
+        self.cert_monitor.connect('files-changed', self.on_certs_changed)
 
     def get_compliance_status(self):
         status_cache = inj.require(inj.ENTITLEMENT_STATUS_CACHE)
@@ -367,12 +370,28 @@ class CertSorter(ComplianceManager):
         # Now that local data has been refreshed, updated compliance
         self.on_change()
 
-    def on_prod_dir_changed(self):
-        self.product_dir.refresh()
+    def on_certs_changed(self, monitor, ident_files, ent_files, prod_files):
+        """
+        Like on_cert_changed, but only the files which changed in each
+        directory are loaded again, and directories which didn't change
+        (None) are left alone.
+        """
+        if ident_files is not None:
+            self.on_identity_changed()
+        if ent_files is not None:
+            self.on_ent_dir_changed(ent_files)
+        if prod_files is not None:
+            self.on_prod_dir_changed(prod_files)
+
+        # Now that local data has been refreshed, updated compliance
+        self.on_change()
+
+    def on_prod_dir_changed(self, names=None):
+        self.product_dir.refresh(names)
         self.update_product_manager()
 
-    def on_ent_dir_changed(self):
-        self.entitlement_dir.refresh()
+    def on_ent_dir_changed(self, names=None):
+        self.entitlement_dir.refresh(names)
 
     def on_identity_changed(self):
         self.identity.reload()
@@ -15,12 +15,21 @@
 # in this software or its documentation.
 #
 
+from datetime import datetime
+import errno
 import gettext
 import logging
 import os
+import shutil
+import tempfile
 
-from rhsm.certificate import Key, create_from_file
+from iniparse.compat import NoSectionError, NoOptionError
+from rhsm.certificate import Key, create_from_file, DateRange, GMT, \
+        get_datetime_from_x509, CertificateException
+from rhsm.certificate2 import EntitlementCertificate
 from rhsm.config import initConfig
+from subscription_manager.certindex import CertificateIndex, ENTITLEMENT, \
+        PRODUCT, file_stat_key, parse_records, record_to_cert, full_record
 from subscription_manager.injection import require, ENT_DIR
 
 log = logging.getLogger('rhsm-app.' + __name__)
@@ -30,6 +39,151 @@ _ = gettext.gettext
 cfg = initConfig()
 
 
+def _parallel_parse_threshold():
+    """
+    Number of certs which have to be parsed at once before it is worth
+    parsing them in worker processes, 0 if that is disabled.
+    """
+    try:
+        return cfg.get_int('rhsm', 'parallel_cert_parse_threshold') or 0
+    except (NoSectionError, NoOptionError):
+        return 0
+    except ValueError, e:
+        log.warn(e)
+        return 0
+
+
+def _stacking_id(cert):
+    order = getattr(cert, 'order', None)
+    if order:
+        return order.stacking_id
+    return None
+
+
+def _pool_id(cert):
+    pool = getattr(cert, 'pool', None)
+    if pool:
+        return pool.id
+    return None
+
+
+def _gmt(date):
+    if date.tzinfo is None:
+        return date.replace(tzinfo=GMT())
+    return date.astimezone(GMT())
+
+
+class _Summary(object):
+    """
+    Base for the compact, read only summaries of certificates.
+
+    Certificates carry their whole decoded extension tree, summaries only
+    the handful of fields most callers look at, in __slots__, so they stay
+    small however many certificates there are.
+    """
+    __slots__ = ('serial', 'start', 'end', 'path')
+
+    def __init__(self, cert):
+        self.serial = cert.serial
+        self.start = cert.valid_range.begin()
+        self.end = cert.valid_range.end()
+        self.path = cert.path
+
+    @classmethod
+    def from_record(cls, record, path):
+        """
+        Build the summary from a complete certindex record rather than a
+        certificate.
+        """
+        summary = cls.__new__(cls)
+        summary._set_record(record, path)
+        return summary
+
+    def _set_record(self, record, path):
+        self.serial = record['serial']
+        self.start = get_datetime_from_x509(record['start'])
+        self.end = get_datetime_from_x509(record['end'])
+        self.path = path
+
+    @property
+    def valid_range(self):
+        return DateRange(self.start, self.end)
+
+    def is_valid(self, on_date=None):
+        on_date = _gmt(on_date or datetime.utcnow())
+        return self.start <= on_date <= self.end
+
+    def is_expired(self, on_date=None):
+        on_date = _gmt(on_date or datetime.utcnow())
+        return self.end < on_date
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.serial, self.path)
+
+
+class EntitlementSummary(_Summary):
+    """
+    Summary of an entitlement certificate.
+    """
+    __slots__ = ('product_ids', 'content_labels', 'stacking_id', 'pool_id')
+
+    def __init__(self, cert):
+        super(EntitlementSummary, self).__init__(cert)
+        self.product_ids = tuple([p.id for p in cert.products])
+        content = getattr(cert, 'content', None) or []
+        self.content_labels = tuple([c.label for c in content])
+        self.stacking_id = _stacking_id(cert)
+        self.pool_id = _pool_id(cert)
+
+    def _set_record(self, record, path):
+        super(EntitlementSummary, self)._set_record(record, path)
+        self.product_ids = tuple([p['id'] for p in record['products']])
+        self.content_labels = tuple([c['label'] for c in (record['content'] or [])])
+        self.stacking_id = None
+        if record['order']:
+            self.stacking_id = record['order'].get('stacking_id')
+        self.pool_id = record['pool_id']
+
+
+class ProductSummary(_Summary):
+    """
+    Summary of a product certificate, by its first product (the one it
+    is installed as). product_ids has the ids of all its products.
+    """
+    __slots__ = ('id', 'name', 'version', 'architectures', 'provided_tags',
+            'product_ids')
+
+    def __init__(self, cert):
+        super(ProductSummary, self).__init__(cert)
+        self.product_ids = tuple([p.id for p in cert.products])
+        product = cert.products[0]
+        self.id = product.id
+        self.name = product.name
+        self.version = product.version
+        self.architectures = tuple(product.architectures or [])
+        self.provided_tags = tuple(product.provided_tags or [])
+
+    def _set_record(self, record, path):
+        super(ProductSummary, self)._set_record(record, path)
+        self.product_ids = tuple([p['id'] for p in record['products']])
+        product = record['products'][0]
+        self.id = product['id']
+        self.name = product.get('name')
+        self.version = product.get('version')
+        self.architectures = tuple(product.get('architectures') or [])
+        self.provided_tags = tuple(product.get('provided_tags') or [])
+
+
+def summarize(cert):
+    """
+    Return the EntitlementSummary or ProductSummary for cert, for
+    directories which don't say which kind of certs they hold.
+    """
+    if isinstance(cert, EntitlementCertificate):
+        return EntitlementSummary(cert)
+    return ProductSummary(cert)
+
+
 class Directory(object):
 
     def __init__(self, path):
@@ -99,26 +253,188 @@ class CertificateDirectory(Directory):
 
     KEY = 'key.pem'
 
+    # Where to keep the persistent index of parsed certificates, if any:
+    INDEX_FILE = None
+    # Kind of certificate expected here (see certindex), if known. This
+    # allows certificates to be decoded lazily.
+    CERT_TYPE = None
+    # Summary class for the certificates here (see list_summaries), if
+    # known. Otherwise it is picked for each certificate.
+    SUMMARY_CLASS = None
+
+    # Sub-classes (and test stubs) don't always call our __init__:
+    _listing = None
+    _lookup = None
+    _known = None
+    _index = None
+    _summaries = None
+
     def __init__(self, path):
         super(CertificateDirectory, self).__init__(path)
         self.create()
         self._listing = None
+        self._lookup = None
+        # Maps the path of every cert we have loaded to the stat key of
+        # the file when we did, and the cert itself:
+        self._known = {}
+        # Maps the path of every cert we have summarized to the stat key of
+        # the file when we did, and the summary:
+        self._summaries = None
+        self._index = None
+        if self.INDEX_FILE:
+            self._index = CertificateIndex(Path.abs(self.INDEX_FILE))
+
+    def refresh(self, names=None):
+        """
+        Forget the current listing, the next list() will reload it.
 
-    def refresh(self):
-        # simply clear the cache. the next list() will reload.
+        Only certs whose files were added or changed since are loaded
+        again, certs which were removed are dropped. Certs which another
+        process has parsed and indexed since are not parsed again.
+
+        If the names of the files which changed are known (see
+        file_monitor), only those are looked at again and the rest of the
+        current listing is kept.
+        """
+        if self._index is not None:
+            self._index.refresh()
+        if names is not None and self._listing is not None and \
+                self._known is not None:
+            self._refresh_files(names)
+            return
         self._listing = None
+        self._lookup = None
+
+    def _refresh_files(self, names):
+        paths = []
+        for name in names:
+            if not name.endswith('.pem') or name.endswith(self.KEY):
+                continue
+            path = self.abspath(name)
+            stat_key = None
+            if os.path.isfile(path):
+                try:
+                    stat_key = file_stat_key(path)
+                except OSError:
+                    # Removed since we were told about it.
+                    pass
+            previous = self._known.get(path)
+            if previous and previous[0] == stat_key:
+                continue
+            paths.append(path)
+            if stat_key is None:
+                self._known.pop(path, None)
+                if self._index is not None:
+                    self._index.remove(path)
+            else:
+                self._known[path] = (stat_key, self._load_cert(path, stat_key))
+
+        if not paths:
+            return
+        listed = [c.path for c in self._listing]
+        listed.extend(sorted(set(paths) - set(listed)))
+        self._listing = [self._known[listed_path][1]
+                for listed_path in listed if listed_path in self._known]
+        self._lookup = None
+        if self._index is not None:
+            self._index.save()
 
     def list(self):
         if self._listing is not None:
             return self._listing
-        listing = []
+        paths = []
+        known = {}
+        missing = []
         for p, fn in Directory.list(self):
             if not fn.endswith('.pem') or fn.endswith(self.KEY):
                 continue
             path = self.abspath(fn)
-            listing.append(create_from_file(path))
-        self._listing = listing
-        return listing
+            try:
+                stat_key = file_stat_key(path)
+            except OSError:
+                # Removed since we listed the directory.
+                continue
+            paths.append(path)
+            previous = (self._known or {}).get(path)
+            if previous and previous[0] == stat_key:
+                known[path] = previous
+                continue
+            cert = None
+            if self._index is not None:
+                cert = self._index.lookup(path, stat_key)
+            if cert is None:
+                missing.append((path, stat_key))
+            else:
+                known[path] = (stat_key, cert)
+
+        if missing:
+            threshold = _parallel_parse_threshold()
+            if threshold and len(missing) >= threshold:
+                self._parse_certs(missing, known)
+        for path, stat_key in missing:
+            if path not in known:
+                known[path] = (stat_key, self._load_cert(path, stat_key))
+
+        if self._index is not None:
+            self._index.retain(known.keys())
+            self._index.save()
+        self._known = known
+        self._listing = [known[path][1] for path in paths]
+        return self._listing
+
+    def _load_cert(self, path, stat_key=None):
+        if self._index is not None:
+            return self._index.load_cert(path, self.CERT_TYPE, stat_key)
+        return create_from_file(path)
+
+    def _parse_certs(self, missing, known):
+        """
+        Parse the certs in missing in worker processes, adding those which
+        could be parsed to known. Anything left over is loaded as usual.
+        """
+        try:
+            records = parse_records([path for (path, stat_key) in missing],
+                    self.CERT_TYPE)
+        except (OSError, IOError, CertificateException), e:
+            log.warn("Unable to parse certificates in parallel: %s" % e)
+            return
+        for ((path, stat_key), record) in zip(missing, records):
+            if record is None:
+                continue
+            if self._index is not None:
+                cert = self._index.add_record(path, record, stat_key)
+            else:
+                cert = record_to_cert(record, path)
+            known[path] = (stat_key, cert)
+
+    def add_cert(self, cert):
+        """
+        Add a cert which was just written into this directory to the
+        current listing, rather than loading it from disk again.
+        """
+        self.add_certs([cert])
+
+    def add_certs(self, certs):
+        """
+        Add several certs which were just written into this directory to
+        the current listing at once.
+        """
+        added = []
+        for cert in certs:
+            try:
+                stat_key = file_stat_key(cert.path)
+            except OSError:
+                continue
+            if self._index is not None:
+                self._index.add(cert.path, cert, stat_key)
+            if self._known is not None:
+                self._known[cert.path] = (stat_key, cert)
+            added.append(cert)
+        if self._listing is not None and added:
+            paths = set([cert.path for cert in added])
+            self._listing = [c for c in self._listing if c.path not in paths]
+            self._listing.extend(added)
+            self._lookup = None
 
     def list_valid(self):
         valid = []
@@ -134,42 +450,87 @@ class CertificateDirectory(Directory):
                 expired.append(c)
         return expired
 
+    def list_summaries(self):
+        """
+        Return a compact summary (see EntitlementSummary and ProductSummary)
+        of every cert in the listing, in the same order.
+
+        Summaries are kept until their cert file changes, so callers which
+        only need the basics can hold on to them rather than the certs.
+        """
+        summaries = {}
+        result = []
+        for cert in self.list():
+            stat_key = None
+            if cert.path in (self._known or {}):
+                stat_key = self._known[cert.path][0]
+            previous = (self._summaries or {}).get(cert.path)
+            if previous and stat_key is not None and previous[0] == stat_key:
+                summary = previous[1]
+            else:
+                summary = self._summarize(cert)
+            summaries[cert.path] = (stat_key, summary)
+            result.append(summary)
+        self._summaries = summaries
+        return result
+
+    def _summarize(self, cert):
+        if self.SUMMARY_CLASS is None:
+            return summarize(cert)
+        if hasattr(cert, 'is_decoded') and not cert.is_decoded():
+            # Decoding the listed cert would keep all of it around for as
+            # long as the listing, build the summary from a record instead:
+            record = self._full_record(cert.path)
+            if record is not None:
+                return self.SUMMARY_CLASS.from_record(record, cert.path)
+        return self.SUMMARY_CLASS(cert)
+
+    def _full_record(self, path):
+        """
+        Return the complete index record of the cert at path, parsing it
+        (and completing the index) if all we have is a partial one.
+        """
+        record = None
+        if self._index is not None:
+            record = self._index.record(path)
+        if record is None or 'products' not in record:
+            try:
+                record = full_record(path)
+            except Exception, e:
+                log.debug("Unable to parse %s: %s" % (path, e))
+                return None
+            if record is not None and self._index is not None:
+                self._index.complete_record(path, record)
+        return record
+
+    def _get_lookup(self):
+        """
+        Return the CertificateLookup for the current listing, building a
+        new one if the listing has changed since.
+        """
+        listing = self.list()
+        if self._lookup is None or not self._lookup.matches(listing):
+            self._lookup = CertificateLookup(listing, self.list_summaries)
+        return self._lookup
+
     def find(self, sn):
-        # TODO: could optimize to just load SERIAL.pem? Maybe not in all cases.
-        for c in self.list():
-            if c.serial == sn:
-                return c
-        return None
+        return self._get_lookup().by_serial().get(sn)
 
     def find_all_by_product(self, p_hash):
-        certs = set()
-        providing_stack_ids = set()
-        stack_id_map = {}
-        for c in self.list():
-            for p in c.products:
-                if p.id == p_hash:
-                    certs.add(c)
-                    # Keep track of stacks that provide our product
-                    if (c.order and c.order.stacking_id):
-                        providing_stack_ids.add(c.order.stacking_id)
-
-            # Keep track of stack ids in case we need them later.  avoids another loop
-            if (c.order and c.order.stacking_id):
-                if c.order.stacking_id not in stack_id_map:
-                    stack_id_map[c.order.stacking_id] = set()
-                stack_id_map[c.order.stacking_id].add(c)
-
-        # Complete
-        for stack_id in providing_stack_ids:
-            certs |= stack_id_map[stack_id]
+        lookup = self._get_lookup()
+        certs = set(lookup.by_product().get(p_hash, []))
+
+        # Include everything stacked with a cert providing our product:
+        stacks = lookup.by_stacking_id()
+        for stack_id in lookup.stacking_ids(p_hash):
+            certs.update(stacks[stack_id])
 
         return list(certs)
 
     def find_by_product(self, p_hash):
-        for c in self.list():
-            for p in c.products:
-                if p.id == p_hash:
-                    return c
+        certs = self._get_lookup().by_product().get(p_hash)
+        if certs:
+            return certs[0]
         return None
 
     #Set up an alias for backwards compatibility
@@ -179,6 +540,9 @@ class CertificateDirectory(Directory):
 class ProductDirectory(CertificateDirectory):
 
     PATH = cfg.get('rhsm', 'productCertDir')
+    INDEX_FILE = '/var/lib/rhsm/cache/product_cert_index.json'
+    CERT_TYPE = PRODUCT
+    SUMMARY_CLASS = ProductSummary
 
     def __init__(self):
         super(ProductDirectory, self).__init__(self.PATH)
@@ -208,7 +572,14 @@ class ProductDirectory(CertificateDirectory):
 class EntitlementDirectory(CertificateDirectory):
 
     PATH = cfg.get('rhsm', 'entitlementCertDir')
+    INDEX_FILE = '/var/lib/rhsm/cache/entitlement_cert_index.json'
+    CERT_TYPE = ENTITLEMENT
+    SUMMARY_CLASS = EntitlementSummary
     PRODUCT = 'product'
+    # Where long expired certificates are moved to (see archive()):
+    ARCHIVE_PATH = '/var/lib/rhsm/expired-entitlement'
+    # How many archived certificates to keep, oldest are removed first:
+    ARCHIVE_MAX = 100
 
     @classmethod
     def productpath(cls):
@@ -257,17 +628,191 @@ class EntitlementDirectory(CertificateDirectory):
 
         return valid
 
+    def archive(self, certs):
+        """
+        Move the given certificates and their keys out of this directory
+        into ARCHIVE_PATH, and drop them from the listing and the index.
+        Only the ARCHIVE_MAX most recently archived certificates are kept.
+
+        Returns the certificates which were archived.
+        """
+        archive_path = Path.abs(self.ARCHIVE_PATH)
+        if not os.path.exists(archive_path):
+            os.makedirs(archive_path)
+
+        archived = []
+        for cert in certs:
+            key_path = self.abspath("%s-key.pem" % cert.serial)
+            dest = os.path.join(archive_path, os.path.basename(cert.path))
+            try:
+                # shutil.move copies if the archive is on another filesystem:
+                shutil.move(cert.path, dest)
+                # Date it by when it was archived, for _rotate_archive():
+                os.utime(dest, None)
+                if os.path.exists(key_path):
+                    shutil.move(key_path, os.path.join(archive_path,
+                        os.path.basename(key_path)))
+            except (IOError, OSError), e:
+                log.warn("Unable to archive %s: %s" % (cert.path, e))
+                continue
+            archived.append(cert)
+
+        if archived:
+            paths = set([cert.path for cert in archived])
+            for path in paths:
+                if self._index is not None:
+                    self._index.remove(path)
+                if self._known is not None:
+                    self._known.pop(path, None)
+            if self._listing is not None:
+                self._listing = [c for c in self._listing
+                        if c.path not in paths]
+                self._lookup = None
+            if self._index is not None:
+                self._index.save()
+            self._rotate_archive(archive_path)
+        return archived
+
+    def _rotate_archive(self, archive_path):
+        """
+        Remove the oldest certificates and keys in the archive beyond
+        ARCHIVE_MAX.
+        """
+        serials = self.list_archived_serials()
+        if len(serials) <= self.ARCHIVE_MAX:
+            return
+
+        def mtime(serial):
+            try:
+                return os.path.getmtime(os.path.join(archive_path,
+                    "%s.pem" % serial))
+            except OSError:
+                return 0
+        serials.sort(key=mtime)
+        for serial in serials[:len(serials) - self.ARCHIVE_MAX]:
+            for fn in ("%s.pem" % serial, "%s-key.pem" % serial):
+                try:
+                    os.unlink(os.path.join(archive_path, fn))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        log.warn("Unable to remove archived %s: %s" % (fn, e))
+
+    def is_archived(self, serial):
+        """
+        Returns True if the certificate with the given serial is in
+        ARCHIVE_PATH.
+        """
+        return os.path.exists(os.path.join(Path.abs(self.ARCHIVE_PATH),
+            "%s.pem" % serial))
+
+    def list_archived_serials(self):
+        """
+        Returns the serials of the certificates in ARCHIVE_PATH.
+        """
+        archive_path = Path.abs(self.ARCHIVE_PATH)
+        if not os.path.isdir(archive_path):
+            return []
+        serials = []
+        for fn in os.listdir(archive_path):
+            if not fn.endswith('.pem') or fn.endswith('-key.pem'):
+                continue
+            try:
+                serials.append(long(fn[:-len('.pem')]))
+            except ValueError:
+                continue
+        return serials
+
     def list_for_product(self, product_id):
         """
         Returns all entitlement certificates providing access to the given
         product ID.
         """
-        entitlements = []
-        for cert in self.list():
-            for cert_product in cert.products:
-                if product_id == cert_product.id:
-                    entitlements.append(cert)
-        return entitlements
+        return list(self._get_lookup().by_product().get(product_id, []))
+
+    def find_by_pool_id(self, pool_id):
+        """
+        Returns all entitlement certificates from the given pool.
+        """
+        return list(self._get_lookup().by_pool_id().get(pool_id, []))
+
+    def list_pool_ids(self):
+        """
+        Returns the ids of all pools we have entitlement certificates from.
+        """
+        return self._get_lookup().by_pool_id().keys()
+
+
+class CertificateLookup(object):
+    """
+    Hash indexes over a certificate listing, so finding certificates by
+    serial, product, stack or pool does not scan every certificate.
+
+    Each index is only built the first time it is used. The product,
+    stack and pool indexes are built from the summaries of the listing
+    (see list_summaries), so lazily loaded certificates are not decoded
+    to build them. Certificates keep their listing order within each
+    index.
+    """
+
+    def __init__(self, certs, list_summaries):
+        self.certs = certs
+        self.size = len(certs)
+        self._list_summaries = list_summaries
+        self._summaries = None
+        self._indexes = {}
+
+    def matches(self, certs):
+        # Test stubs hand out their own lists, which may be modified:
+        return certs is self.certs and len(certs) == self.size
+
+    def _get_summaries(self):
+        if self._summaries is None:
+            self._summaries = self._list_summaries()
+        return self._summaries
+
+    def _build(self, name, keys_for):
+        if name not in self._indexes:
+            index = {}
+            for cert, summary in zip(self.certs, self._get_summaries()):
+                for key in keys_for(summary):
+                    index.setdefault(key, []).append(cert)
+            self._indexes[name] = index
+        return self._indexes[name]
+
+    def by_serial(self):
+        # find() has always returned the first cert with a serial:
+        if 'serial' not in self._indexes:
+            index = {}
+            for cert in self.certs:
+                index.setdefault(cert.serial, cert)
+            self._indexes['serial'] = index
+        return self._indexes['serial']
+
+    def by_product(self):
+        return self._build('product',
+                lambda summary: summary.product_ids)
+
+    def by_stacking_id(self):
+        return self._build('stacking_id', lambda summary:
+                filter(None, [getattr(summary, 'stacking_id', None)]))
+
+    def by_pool_id(self):
+        return self._build('pool_id', lambda summary:
+                filter(None, [getattr(summary, 'pool_id', None)]))
+
+    def stacking_ids(self, product_id):
+        """
+        Returns the stacking ids of the certificates providing product_id.
+        """
+        if 'product_stacking_id' not in self._indexes:
+            index = {}
+            for summary in self._get_summaries():
+                if not getattr(summary, 'stacking_id', None):
+                    continue
+                for key in summary.product_ids:
+                    index.setdefault(key, set()).add(summary.stacking_id)
+            self._indexes['product_stacking_id'] = index
+        return self._indexes['product_stacking_id'].get(product_id, set())
 
 
 class Path:
@@ -295,18 +840,153 @@ class Path:
 
 
 class Writer:
+    """
+    Writes entitlement certificates and their keys into the entitlement
+    directory.
+
+    Between begin() and commit(), write() only stages each pair in a
+    temporary directory next to the entitlement certificates. commit() then
+    renames them all into place and adds them to the listing in one go, so
+    readers never see a half written PEM, and a crash leaves either the old
+    or the new certificate behind. Outside of a batch, every write() is a
+    batch of its own.
+    """
+
+    # Staging directories are named after this and the pid which made them:
+    STAGE_PREFIX = '.staging-'
 
     def __init__(self):
         self.ent_dir = require(ENT_DIR)
+        self._batch = None
+        self._stage_dir = None
 
-    def write(self, key, cert):
-        serial = cert.serial
-        ent_dir_path = self.ent_dir.productpath()
+    def begin(self):
+        """ Start staging writes until commit() or abort(). """
+        self._batch = []
+        self._remove_stale_stage_dirs()
 
-        key_filename = '%s-key.pem' % str(serial)
-        key_path = Path.join(ent_dir_path, key_filename)
-        key.write(key_path)
+    def _remove_stale_stage_dirs(self):
+        """
+        Remove staging directories left behind by processes which died
+        before they could commit or abort.
+        """
+        ent_dir_path = self._ent_dir_path()
+        try:
+            names = os.listdir(ent_dir_path)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(self.STAGE_PREFIX):
+                continue
+            try:
+                pid = int(name[len(self.STAGE_PREFIX):].split('-')[0])
+            except ValueError:
+                pid = None
+            if pid is not None and _process_exists(pid):
+                continue
+            log.debug("Removing stale staging directory: %s" % name)
+            shutil.rmtree(os.path.join(ent_dir_path, name), True)
+
+    def write(self, key, cert):
+        if self._batch is not None:
+            self._stage(key, cert)
+            return
+        self.begin()
+        try:
+            self._stage(key, cert)
+            self.commit()
+        finally:
+            self.abort()
+
+    def staged(self):
+        """ Return the certificates staged in the current batch. """
+        return [cert for (key, cert, key_path, cert_path) in self._batch or []]
+
+    def landed(self):
+        """
+        Return the certificates of the current batch which were moved into
+        place, i.e. by a commit() which failed part way.
+        """
+        return [cert for (key, cert, key_path, cert_path) in self._batch or []
+                if cert.path == cert_path]
+
+    def _ent_dir_path(self):
+        return Path.abs(self.ent_dir.productpath())
+
+    def _stage(self, key, cert):
+        ent_dir_path = self._ent_dir_path()
+        if self._stage_dir is None:
+            # Must be on the same filesystem for the renames to be atomic:
+            self._stage_dir = tempfile.mkdtemp(
+                    prefix='%s%d-' % (self.STAGE_PREFIX, os.getpid()),
+                    dir=ent_dir_path)
+
+        key_filename = '%s-key.pem' % str(cert.serial)
+        cert_filename = '%s.pem' % str(cert.serial)
+        key.write(os.path.join(self._stage_dir, key_filename))
+        cert.write(os.path.join(self._stage_dir, cert_filename))
+        self._batch.append((key, cert,
+            os.path.join(ent_dir_path, key_filename),
+            os.path.join(ent_dir_path, cert_filename)))
+
+    def commit(self):
+        """
+        Move every staged key and certificate into place, and add the
+        certificates to the entitlement directory listing.
 
-        cert_filename = '%s.pem' % str(serial)
-        cert_path = Path.join(ent_dir_path, cert_filename)
-        cert.write(cert_path)
+        If this fails part way, those which made it (see landed()) are
+        still added to the listing. The batch is kept until abort().
+        """
+        batch = self._batch or []
+        # Make sure the contents are on disk before any of them replace
+        # what is there now:
+        for (key, cert, key_path, cert_path) in batch:
+            _fsync_path(key.path)
+            _fsync_path(cert.path)
+
+        try:
+            # Keys go first, so there is never a certificate without its
+            # key:
+            for (key, cert, key_path, cert_path) in batch:
+                os.rename(key.path, key_path)
+                key.path = key_path
+            for (key, cert, key_path, cert_path) in batch:
+                os.rename(cert.path, cert_path)
+                cert.path = cert_path
+        except (IOError, OSError), e:
+            self.ent_dir.add_certs(self.landed())
+            raise e
+        if batch:
+            _fsync_path(self._ent_dir_path())
+
+        self.ent_dir.add_certs([cert for (key, cert, key_path, cert_path)
+            in batch])
+        self._batch = []
+        self._remove_stage_dir()
+
+    def abort(self):
+        """ Drop anything still staged, and end the batch. """
+        self._batch = None
+        self._remove_stage_dir()
+
+    def _remove_stage_dir(self):
+        if self._stage_dir is not None:
+            shutil.rmtree(self._stage_dir, True)
+            self._stage_dir = None
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # EPERM means it exists, but isn't ours:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,604 @@
+#
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Persistent index of parsed certificates, and lazily decoded certificates.
+
+Every entry point (yum plugins, rhsmcertd-worker, the CLI and GUI) lists
+the entitlement and product certificate directories on startup, and
+decoding every PEM there dominates startup time on hosts with many
+certificates. The index stores the decoded fields of each certificate on
+disk, keyed by the file's path, mtime, size and inode, so unchanged files
+can be loaded without parsing them again.
+
+Certificates which are not in the index yet are loaded lazily: only the
+serial, validity dates and subject are read up front, the Red Hat
+extensions are decoded the first time something asks for them.
+"""
+
+import atexit
+import fcntl
+import logging
+import multiprocessing
+import os
+import tempfile
+
+from rhsm import _certificate
+from rhsm.certificate import create_from_file, get_datetime_from_x509, \
+        DateRange
+from rhsm.certificate2 import EntitlementCertificate, ProductCertificate, \
+        Product, Content, Order, Pool, Version
+from rhsm import ourjson as json
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+# Bump whenever the record format changes, older indexes are then rebuilt.
+INDEX_VERSION = 2
+
+# Starts the header line of every index file:
+INDEX_MAGIC = "rhsm-cert-index"
+
+ENTITLEMENT = "entitlement"
+PRODUCT = "product"
+
+PRODUCT_FIELDS = ('id', 'name', 'version', 'architectures', 'provided_tags',
+        'brand_type', 'brand_name')
+
+CONTENT_FIELDS = ('content_type', 'name', 'label', 'vendor', 'url', 'gpg',
+        'enabled', 'metadata_expire', 'required_tags', 'arches')
+
+ORDER_FIELDS = ('name', 'number', 'sku', 'subscription', 'quantity',
+        'virt_limit', 'socket_limit', 'contract', 'quantity_used',
+        'warning_period', 'account', 'provides_management', 'service_level',
+        'service_type', 'stacking_id', 'virt_only', 'ram_limit', 'core_limit')
+
+
+def _fields(obj, names):
+    # Only keep what this version of python-rhsm actually knows about, so
+    # the record can be fed straight back into the constructor.
+    return dict((name, getattr(obj, name)) for name in names
+            if hasattr(obj, name))
+
+
+def _str_keys(d):
+    # python 2.6 does not accept unicode keyword argument names
+    return dict((str(key), value) for (key, value) in d.items())
+
+
+def cert_to_record(cert):
+    """
+    Convert a certificate into a dict of the decoded fields we use,
+    suitable for serializing as JSON.
+
+    Lazy certificates only contribute the fields decoded so far, the rest
+    are filled in when the record is loaded again and they are first used.
+
+    Returns None for anything that is not an entitlement or product cert.
+    """
+    if isinstance(cert, EntitlementCertificate):
+        cert_type = ENTITLEMENT
+    elif isinstance(cert, ProductCertificate):
+        cert_type = PRODUCT
+    else:
+        return None
+
+    record = {
+        'type': cert_type,
+        'serial': cert.serial,
+        'start': cert.start.isoformat(),
+        'end': cert.end.isoformat(),
+    }
+
+    if isinstance(cert, _LazyCertificate) and not cert.is_decoded():
+        # Only the cheap x509 fields are known for this one:
+        if 'subject' in cert._values:
+            record['subject'] = cert._values['subject']
+        return record
+
+    record['subject'] = getattr(cert, 'subject', None)
+    record['version'] = str(cert.version)
+    record['issuer'] = getattr(cert, 'issuer', None)
+    record['products'] = [_fields(p, PRODUCT_FIELDS) for p in cert.products]
+
+    if cert_type == ENTITLEMENT:
+        record['order'] = None
+        if cert.order:
+            record['order'] = _fields(cert.order, ORDER_FIELDS)
+        record['content'] = None
+        if cert.content is not None:
+            record['content'] = [_fields(c, CONTENT_FIELDS) for c in cert.content]
+        record['pool_id'] = None
+        if cert.pool:
+            record['pool_id'] = cert.pool.id
+    return record
+
+
+def record_to_cert(record, path):
+    """
+    Build a lazy certificate from a record created by cert_to_record.
+    """
+    start = get_datetime_from_x509(record['start'])
+    end = get_datetime_from_x509(record['end'])
+    if record['type'] == ENTITLEMENT:
+        cert = LazyEntitlementCertificate(path, record['serial'], start, end)
+    else:
+        cert = LazyProductCertificate(path, record['serial'], start, end)
+
+    values = cert._values
+    if 'subject' in record:
+        values['subject'] = record['subject']
+    if 'products' not in record:
+        return cert
+
+    values['version'] = Version(record['version'])
+    values['issuer'] = record['issuer']
+    values['products'] = [Product(**_str_keys(p)) for p in record['products']]
+
+    if record['type'] == ENTITLEMENT:
+        values['order'] = None
+        if record['order'] is not None:
+            values['order'] = Order(**_str_keys(record['order']))
+        values['content'] = None
+        if record['content'] is not None:
+            values['content'] = [Content(**_str_keys(c)) for c in record['content']]
+        values['pool'] = None
+        if record['pool_id'] is not None:
+            values['pool'] = Pool(id=record['pool_id'])
+    return cert
+
+
+def file_stat_key(path):
+    """
+    Return what we compare to decide whether a certificate file has
+    changed since we last read it.
+    """
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+
+def create_lazy_cert(path, cert_type):
+    """
+    Read just the serial, validity dates and subject of the certificate at
+    path, leaving the Red Hat extensions to be decoded on first use.
+    """
+    x509 = _certificate.load(path)
+    if not x509:
+        # Let the full parser report what is wrong with it:
+        return create_from_file(path)
+
+    start = get_datetime_from_x509(x509.get_not_before())
+    end = get_datetime_from_x509(x509.get_not_after())
+    if cert_type == ENTITLEMENT:
+        cert = LazyEntitlementCertificate(path, x509.get_serial_number(), start, end)
+    else:
+        cert = LazyProductCertificate(path, x509.get_serial_number(), start, end)
+    cert._values['subject'] = x509.get_subject()
+    cert._values['x509'] = x509
+    return cert
+
+
+def full_record(path):
+    """
+    Fully decode the certificate at path and return its complete record.
+    """
+    return cert_to_record(create_from_file(path))
+
+
+def parse_record(path, cert_type=None):
+    """
+    Parse the certificate at path and return its record, or None if it can
+    not be parsed. Runs in the worker processes of parse_records.
+
+    If cert_type is known, only what create_lazy_cert reads is decoded,
+    and the record is partial. Otherwise the certificate is fully parsed.
+    """
+    try:
+        if cert_type is None:
+            cert = create_from_file(path)
+        else:
+            cert = create_lazy_cert(path, cert_type)
+        return cert_to_record(cert)
+    except Exception, e:
+        log.debug("Unable to parse %s: %s" % (path, e))
+        return None
+
+
+def _parse_record_args(args):
+    # Pool.map only hands a single argument to the workers:
+    return parse_record(*args)
+
+
+def parse_records(paths, cert_type=None, processes=None):
+    """
+    Parse the certificates at paths in a pool of worker processes, and
+    return their records (see parse_record) in the same order. Records
+    are small and cheap to pickle, unlike the certificates themselves.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # A few chunks per worker keeps them all busy without sending every
+    # path through the pipe on its own:
+    chunksize = max(1, len(paths) // (processes * 4))
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_parse_record_args,
+                [(path, cert_type) for path in paths], chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _lazy_property(name):
+
+    def getter(self):
+        if name not in self._values:
+            self._decode()
+        return self._values.get(name)
+
+    def setter(self, value):
+        self._values[name] = value
+
+    return property(getter, setter)
+
+
+class _LazyCertificate(object):
+    """
+    Mixin for certificates which are only partially decoded.
+
+    The serial, path and validity dates are always set. Everything else
+    lives in self._values, and the first access to anything missing there
+    decodes the whole file and fills in the gaps. This keeps listings that
+    only care about serials and dates (i.e. rhsmcertd and the yum plugin)
+    from decoding every extension of every certificate.
+    """
+    LAZY_FIELDS = ('version', 'subject', 'issuer', 'products', 'x509', 'pem')
+
+    # Called with the certificate once it has been fully decoded:
+    on_decode = None
+
+    def __init__(self, path, serial, start, end):
+        # The certificate2 constructors assign every field, which would
+        # defeat the point, so we set up only the eager ones here.
+        self._values = {}
+        self._decoded = False
+        self.path = path
+        self.serial = serial
+        self.start = start
+        self.end = end
+        self.valid_range = DateRange(start, end)
+
+    def _decode(self):
+        if self._decoded:
+            return
+        self._decoded = True
+        parsed = create_from_file(self.path)
+        for name in self.LAZY_FIELDS:
+            if name not in self._values:
+                self._values[name] = getattr(parsed, name, None)
+        if self.on_decode:
+            self.on_decode(self)
+
+    def is_decoded(self):
+        return 'products' in self._values
+
+    version = _lazy_property('version')
+    subject = _lazy_property('subject')
+    issuer = _lazy_property('issuer')
+    products = _lazy_property('products')
+    x509 = _lazy_property('x509')
+    pem = _lazy_property('pem')
+
+
+class LazyProductCertificate(_LazyCertificate, ProductCertificate):
+    pass
+
+
+class LazyEntitlementCertificate(_LazyCertificate, EntitlementCertificate):
+    LAZY_FIELDS = _LazyCertificate.LAZY_FIELDS + \
+            ('order', 'content', 'pool', 'extensions')
+
+    _path_tree_object = None
+
+    order = _lazy_property('order')
+    content = _lazy_property('content')
+    pool = _lazy_property('pool')
+    extensions = _lazy_property('extensions')
+
+
+def _parse_header(line):
+    """
+    Return the (version, generation) from the first line of an index file,
+    version is None if this is not an index file we know.
+    """
+    fields = line.split()
+    if len(fields) != 3 or fields[0] != INDEX_MAGIC:
+        return (None, 0)
+    return (int(fields[1]), int(fields[2]))
+
+
+class CertificateIndex(object):
+    """
+    On disk index of the certificates in a directory.
+
+    Maps each certificate path to the (mtime, size, inode) of the file
+    when it was parsed, and the record of decoded fields. A certificate is
+    only parsed again if its file no longer matches. A missing, outdated
+    or corrupt index file is simply rebuilt.
+
+    The index file is a snapshot shared by every process which lists the
+    directory. It starts with a header line carrying a generation counter,
+    which is bumped on every save, followed by the entries as JSON. Readers
+    can tell from the header alone whether another process saved a newer
+    snapshot since (see refresh()). Saving holds a lock next to the index
+    while it applies our own changes on top of the newest snapshot and
+    puts the result in place, so processes don't throw away each other's
+    work.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Generation of the snapshot we loaded, 0 if there was none:
+        self.generation = 0
+        self._entries = None
+        # Entries we changed since loading the snapshot, None for those we
+        # removed, to apply again over any newer snapshot:
+        self._changes = {}
+        self._dirty = False
+        self._save_at_exit = False
+
+    def _read_generation(self):
+        try:
+            f = open(self.path)
+            try:
+                return _parse_header(f.readline())[1]
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return 0
+
+    def _read_snapshot(self):
+        """
+        Read the index file and return its (version, generation, entries).
+        Entries are None if the version is not ours.
+        """
+        f = open(self.path)
+        try:
+            header = f.readline()
+            if not header.endswith('\n'):
+                raise ValueError("No index header")
+            version, generation = _parse_header(header)
+            if version != INDEX_VERSION:
+                return (version, generation, None)
+            return (version, generation, dict(json.load(f)))
+        finally:
+            f.close()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if os.path.exists(self.path):
+            try:
+                version, generation, entries = self._read_snapshot()
+                self.generation = max(self.generation, generation)
+                if entries is None:
+                    log.debug("Ignoring outdated certificate index: %s" %
+                            self.path)
+                    self._dirty = True
+                else:
+                    self._entries = entries
+            except (EnvironmentError, ValueError, TypeError), e:
+                log.warn("Rebuilding corrupt certificate index: %s" % self.path)
+                log.debug(e)
+                self._dirty = True
+        for (cert_path, entry) in self._changes.items():
+            if entry is None:
+                self._entries.pop(cert_path, None)
+            else:
+                self._entries[cert_path] = entry
+
+    def _set(self, cert_path, entry):
+        if entry is None:
+            self._entries.pop(cert_path, None)
+        else:
+            self._entries[cert_path] = entry
+        self._changes[cert_path] = entry
+        self._dirty = True
+
+    def refresh(self):
+        """
+        Load the snapshot again if another process saved a newer one since
+        we loaded ours. Changes of our own which are not saved yet are kept.
+        """
+        if self._entries is not None and \
+                self._read_generation() != self.generation:
+            self._entries = None
+
+    def load_cert(self, cert_path, cert_type=None, stat_key=None):
+        """
+        Return the certificate at cert_path, from the index if the file is
+        unchanged since it was indexed, otherwise parse it and index it.
+
+        If cert_type (ENTITLEMENT or PRODUCT) is known, new certificates
+        are loaded lazily, and their index records are completed once
+        something decodes them.
+        """
+        if stat_key is None:
+            stat_key = file_stat_key(cert_path)
+        cert = self.lookup(cert_path, stat_key)
+        if cert is not None:
+            return cert
+
+        if cert_type is None:
+            cert = create_from_file(cert_path)
+        else:
+            cert = create_lazy_cert(cert_path, cert_type)
+            if isinstance(cert, _LazyCertificate):
+                cert.on_decode = self._cert_decoded
+        self.add(cert_path, cert, stat_key)
+        return cert
+
+    def lookup(self, cert_path, stat_key=None):
+        """
+        Return the certificate at cert_path if the index has a record of
+        it and the file is unchanged since, otherwise None.
+        """
+        self._load()
+        if stat_key is None:
+            stat_key = file_stat_key(cert_path)
+        entry = self._entries.get(cert_path)
+        if entry is None or entry.get('stat') != stat_key:
+            return None
+        try:
+            cert = record_to_cert(entry['cert'], cert_path)
+        except Exception, e:
+            log.debug("Unable to use index record for %s: %s" %
+                    (cert_path, e))
+            return None
+        if not cert.is_decoded():
+            cert.on_decode = self._cert_decoded
+        return cert
+
+    def add_record(self, cert_path, record, stat_key=None):
+        """
+        Index a record created by cert_to_record (i.e. in parse_records),
+        and return the certificate it describes.
+        """
+        self._load()
+        if stat_key is None:
+            stat_key = file_stat_key(cert_path)
+        self._set(cert_path, {'stat': stat_key, 'cert': record})
+        cert = record_to_cert(record, cert_path)
+        if not cert.is_decoded():
+            cert.on_decode = self._cert_decoded
+        return cert
+
+    def record(self, cert_path):
+        """
+        Return the indexed record of the certificate at cert_path, or None.
+        It may only be partial (see cert_to_record).
+        """
+        self._load()
+        entry = self._entries.get(cert_path)
+        if entry is None:
+            return None
+        return entry['cert']
+
+    def _cert_decoded(self, cert):
+        self.complete_record(cert.path, cert_to_record(cert))
+
+    def complete_record(self, cert_path, record):
+        """
+        Replace the record of an indexed certificate with the complete one
+        from decoding it, the index is saved at exit.
+        """
+        self._load()
+        entry = self._entries.get(cert_path)
+        if entry is None:
+            return
+        self._set(cert_path, {'stat': entry['stat'], 'cert': record})
+        # Most callers decode certificates long after listing the
+        # directory, don't make the next process decode them all again:
+        if not self._save_at_exit:
+            self._save_at_exit = True
+            atexit.register(self.save)
+
+    def add(self, cert_path, cert, stat_key=None):
+        """ Index an already parsed certificate. """
+        self._load()
+        record = cert_to_record(cert)
+        if record is None:
+            self.remove(cert_path)
+            return
+        if stat_key is None:
+            stat_key = file_stat_key(cert_path)
+        self._set(cert_path, {'stat': stat_key, 'cert': record})
+
+    def remove(self, cert_path):
+        self._load()
+        if cert_path in self._entries:
+            self._set(cert_path, None)
+
+    def retain(self, cert_paths):
+        """ Drop entries for any certificate not in cert_paths. """
+        self._load()
+        keep = set(cert_paths)
+        for cert_path in self._entries.keys():
+            if cert_path not in keep:
+                self.remove(cert_path)
+
+    def save(self):
+        """
+        Write the index if anything changed, as the next generation of the
+        snapshot. The file is replaced atomically so readers never see a
+        partial index. Failure to write is not fatal, the certificates will
+        just be parsed again next time.
+        """
+        if not self._dirty:
+            return
+        index_dir = os.path.dirname(self.path)
+        try:
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            lock_file = open(self.path + ".lock", "a")
+        except (IOError, OSError), e:
+            log.debug("Unable to write certificate index %s: %s" %
+                    (self.path, e))
+            return
+        try:
+            # Nobody else may save between our reading the newest snapshot
+            # and putting ours in its place:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._save_locked(index_dir)
+        finally:
+            # Closing it releases the lock:
+            lock_file.close()
+
+    def _save_locked(self, index_dir):
+        # Build on whatever other processes saved in the meantime:
+        self.refresh()
+        self._load()
+        generation = self.generation + 1
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=index_dir,
+                    prefix=".%s." % os.path.basename(self.path))
+            f = os.fdopen(fd, "w")
+            try:
+                try:
+                    f.write("%s %d %d\n" % (INDEX_MAGIC, INDEX_VERSION,
+                        generation))
+                    json.dump(self._entries, f)
+                finally:
+                    f.close()
+                os.chmod(tmp_path, 0644)
+                os.rename(tmp_path, self.path)
+            except:
+                os.unlink(tmp_path)
+                raise
+            self.generation = generation
+            self._changes = {}
+            self._dirty = False
+        except (IOError, OSError), e:
+            log.debug("Unable to write certificate index %s: %s" %
+                    (self.path, e))
+
+    def delete(self):
+        self._entries = {}
+        self._changes = {}
+        self._dirty = False
+        self.generation = 0
+        # The lock file stays, another process may be holding it:
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,202 @@
+#
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Fetch what the server knows about the consumer once, for everything that
+needs it during a run.
+"""
+
+import logging
+import threading
+import time
+
+from subscription_manager import injection as inj
+from subscription_manager.cache import cert_dirs_state
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+# The resources we know how to fetch:
+CONSUMER = "consumer"
+COMPLIANCE = "compliance"
+OVERRIDES = "overrides"
+
+# Seconds a fetched resource can be handed out for:
+MAX_AGE = 30
+
+
+class _Fetched(object):
+    """ One fetched resource. """
+
+    def __init__(self, value):
+        self.value = value
+        self.fetched_at = time.time()
+        # Requesters which got this one already:
+        self.taken = set()
+
+
+class ConsumerState(object):
+    """
+    The consumer, its compliance status, and its content overrides as the
+    server last told us.
+
+    The consumer, entitlement status and override caches, healing and the
+    identity cert check all need some of these, often during the same
+    run. Each resource is fetched once for all of them, and prefetch()
+    lets entry points which know what they will need fetch several
+    resources concurrently.
+
+    Each requester gets a fetched resource at most once. Asking again
+    means it wants something newer (i.e. after changing it on the
+    server), so the resource is fetched again. Nothing is handed out once
+    it is older than MAX_AGE, or after a certificate has been added or
+    removed, or for another consumer. Errors are only raised to the
+    requester which asked, the next one fetches the resource again.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._uuid = None
+        self._cert_dirs = None
+        self._fetched = {}
+
+    def invalidate(self):
+        """ Forget everything fetched so far. """
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def _status_caches(self):
+        return {
+            COMPLIANCE: inj.require(inj.ENTITLEMENT_STATUS_CACHE),
+            OVERRIDES: inj.require(inj.OVERRIDE_STATUS_CACHE),
+        }
+
+    def _fetchers(self):
+        """
+        Returns a dict of resource name to a callable taking the uep and
+        consumer uuid, which fetches it.
+        """
+        fetchers = {CONSUMER: lambda uep, uuid: uep.getConsumer(uuid)}
+        for (name, status_cache) in self._status_caches().items():
+            fetchers[name] = status_cache.fetch_status
+        return fetchers
+
+    def _check_current(self, uuid):
+        cert_dirs = cert_dirs_state()
+        if uuid != self._uuid or cert_dirs != self._cert_dirs:
+            self._clear()
+            self._uuid = uuid
+            self._cert_dirs = cert_dirs
+
+    def _usable(self, name, requester):
+        fetched = self._fetched.get(name)
+        if fetched is None or requester in fetched.taken:
+            return False
+        age = time.time() - fetched.fetched_at
+        return 0 <= age < MAX_AGE
+
+    def _fetch_all(self, uep, uuid, fetchers):
+        """
+        Fetch every resource in fetchers, all but the first in a thread
+        each. Those get a connection of their own, uep is only used from
+        this thread.
+
+        Returns a dict of resource name to the error fetching it, for any
+        which could not be fetched.
+        """
+        errors = {}
+
+        def fetch(uep, name, fetcher):
+            try:
+                self._fetched[name] = _Fetched(fetcher(uep, uuid))
+            except Exception, e:
+                errors[name] = e
+
+        items = fetchers.items()
+        threads = []
+        if len(items) > 1:
+            cp_provider = inj.require(inj.CP_PROVIDER)
+            for (name, fetcher) in items[1:]:
+                threads.append(threading.Thread(target=fetch,
+                    args=(cp_provider.new_consumer_auth_cp(), name, fetcher),
+                    name="ConsumerState-%s" % name))
+        for thread in threads:
+            thread.start()
+        try:
+            fetch(uep, *items[0])
+        finally:
+            # Never leave a thread behind, logging from one during
+            # interpreter shutdown can crash (BZ 988861):
+            for thread in threads:
+                thread.join()
+        return errors
+
+    def prefetch(self, uep, uuid, names):
+        """
+        Fetch the named resources concurrently, for requesters to get
+        later on. Resources whose status cache is still fresh won't be
+        asked for, so are skipped.
+        """
+        status_caches = self._status_caches()
+        names = [name for name in names if name not in status_caches or
+                not status_caches[name].is_fresh()]
+        if not names:
+            return
+
+        self._lock.acquire()
+        try:
+            self._check_current(uuid)
+            fetchers = self._fetchers()
+            errors = self._fetch_all(uep, uuid,
+                    dict((name, fetchers[name]) for name in names))
+        finally:
+            self._lock.release()
+        # Whatever needs the others will fetch them again:
+        for (name, error) in errors.items():
+            log.debug("Unable to prefetch %s: %s" % (name, error))
+        log.debug("Prefetched consumer state: %s" % ", ".join(
+            [name for name in names if name not in errors]))
+
+    def get(self, uep, uuid, name, requester, fetcher=None):
+        """
+        Returns the named resource, fetching it unless there is a usable
+        one already fetched. fetcher replaces the usual way of fetching
+        it, if given.
+
+        Raises whatever fetching it raised.
+        """
+        self._lock.acquire()
+        try:
+            self._check_current(uuid)
+            if not self._usable(name, requester):
+                fetcher = fetcher or self._fetchers()[name]
+                # Don't hand out an older one if fetching fails:
+                self._fetched.pop(name, None)
+                errors = self._fetch_all(uep, uuid, {name: fetcher})
+                if name in errors:
+                    raise errors[name]
+            fetched = self._fetched[name]
+            fetched.taken.add(requester)
+        finally:
+            self._lock.release()
+        return fetched.value
+
+    def get_consumer(self, uep, uuid, requester):
+        return self.get(uep, uuid, CONSUMER, requester)
@@ -13,12 +13,14 @@
 # in this software or its documentation.
 #
 
+from datetime import datetime, timedelta
 import gettext
 import logging
 import socket
 
+from iniparse.compat import NoSectionError, NoOptionError
 from rhsm.config import initConfig
-from rhsm.certificate import Key, create_from_pem
+from rhsm.certificate import Key, create_from_pem, GMT
 
 from subscription_manager.certdirectory import Writer
 from subscription_manager import certlib
@@ -43,6 +45,75 @@ class EntCertActionInvoker(certlib.BaseActionInvoker):
         return action.perform()
 
 
+class EntCertPruneActionInvoker(certlib.BaseActionInvoker):
+    """Invoker for archiving long expired entitlement certificates."""
+    def _do_update(self):
+        action = EntCertPruneAction()
+        return action.perform()
+
+
+def _prune_grace_period():
+    """
+    Days a certificate has to be expired for before it is archived, None
+    if expired certificates are kept where they are.
+    """
+    try:
+        return cfg.get_int('rhsmcertd', 'expiredCertGracePeriod') or None
+    except (NoSectionError, NoOptionError):
+        return None
+    except ValueError, e:
+        log.warn(e)
+        return None
+
+
+class EntCertPruneAction(object):
+    """
+    Moves entitlement certificates which have been expired for longer
+    than the grace period into the entitlement archive directory, so
+    they no longer slow down every listing of the entitlement directory.
+
+    Does nothing unless expiredCertGracePeriod is set in the rhsmcertd
+    section of rhsm.conf.
+    """
+    def __init__(self, grace_period=None):
+        self.ent_dir = inj.require(inj.ENT_DIR)
+        self.report = EntCertPruneReport()
+        self.grace_period = grace_period
+        if self.grace_period is None:
+            self.grace_period = _prune_grace_period()
+
+    def perform(self):
+        if not self.grace_period:
+            return self.report
+
+        cutoff = datetime.now(GMT()) - timedelta(days=self.grace_period)
+        expired = [cert for cert in self.ent_dir.list()
+                if cert.valid_range.end() < cutoff]
+        if expired:
+            archived = self.ent_dir.archive(expired)
+            self.report.archived = archived
+            for cert in archived:
+                log.info("Archived entitlement certificate %s, expired %s" %
+                        (cert.serial, cert.valid_range.end()))
+        return self.report
+
+
+class EntCertPruneReport(certlib.ActionReport):
+    """Report entitlement certs archived after expiring."""
+    name = "Expired Entitlement Cert Archival"
+
+    def __init__(self):
+        super(EntCertPruneReport, self).__init__()
+        self.archived = []
+
+    def updates(self):
+        return len(self.archived)
+
+    def __str__(self):
+        return "%s\n        archived: %s\n" % (self.name,
+                [cert.serial for cert in self.archived])
+
+
 # this guy is an oddball
 # NOTE: this lib and EntCertDeleteAction are currently
 # unused. Intention is to replace managerlib.clean_all_data
@@ -176,7 +247,10 @@ class EntCertUpdateAction(object):
 
     def _find_missing_serials(self, local, expected):
         """ Find serials from the server we do not have locally. """
-        missing = [sn for sn in expected if sn not in local]
+        # Don't fetch expired certs again after archiving them. Only
+        # serials we don't have are checked, so the archive isn't listed:
+        missing = [sn for sn in expected if sn not in local
+                and not self.ent_dir.is_archived(sn)]
         return missing
 
     def _find_rogue_serials(self, local, expected):
@@ -272,6 +346,9 @@ class EntitlementCertBundlesInstaller(object):
     pre_install() is triggered before any of the ent cert
     bundles are installed. post_install() is triggered after
     all of the ent cert bundles are installed.
+
+    The bundles are staged first and moved into the entitlement
+    directory together, see certdirectory.Writer.
     """
 
     def __init__(self, report):
@@ -280,9 +357,27 @@ class EntitlementCertBundlesInstaller(object):
 
     def install(self, cert_bundles):
         """Fetch entitliement certs, install them, and update the report."""
-        bundle_installer = EntitlementCertBundleInstaller(self.report)
-        for cert_bundle in cert_bundles:
-            bundle_installer.install(cert_bundle)
+        # Stage every cert and key, and only then move them into place
+        # together:
+        writer = Writer()
+        writer.begin()
+        bundle_installer = EntitlementCertBundleInstaller(self.report, writer)
+        try:
+            for cert_bundle in cert_bundles:
+                bundle_installer.install(cert_bundle)
+            # All of them, unless the commit fails:
+            landed = None
+            try:
+                writer.commit()
+            except (IOError, OSError), e:
+                log.exception(e)
+                log.error("Unable to install entitlement certificates: %s" % e)
+                landed = writer.landed()
+                self.report._exceptions.append(e)
+            # Only what is on disk now counts as installed:
+            bundle_installer.committed(landed)
+        finally:
+            writer.abort()
         self.exceptions = bundle_installer.exceptions
         self.post_install()
 
@@ -316,20 +411,30 @@ class EntitlementCertBundleInstaller(object):
     Note that EntitlementCertBundlesInstaller's pre and post install
     hooks are before and after installing the full list of ent cert
     bundles, while this is pre/post each ent cert bundle.
+
+    If given a Writer in the middle of a batch, bundles are only staged
+    by install(). They are reported and post_install() runs once the
+    batch is committed, see committed().
     """
 
-    def __init__(self, report):
+    def __init__(self, report, writer=None):
         self.exceptions = []
         self.report = report
+        self.writer = writer
+        # (bundle, cert) staged in the writer's batch:
+        self._staged = []
 
     def install(self, bundle):
         """Persist an ent cert and it's key after splitting it from the bundle."""
         self.pre_install(bundle)
 
-        cert_bundle_writer = Writer()
         try:
             key, cert = self.build_cert(bundle)
-            cert_bundle_writer.write(key, cert)
+            if self.writer is not None:
+                self.writer.write(key, cert)
+                self._staged.append((bundle, cert))
+                return
+            Writer().write(key, cert)
 
             self.report.added.append(cert)
         except Exception, e:
@@ -337,6 +442,22 @@ class EntitlementCertBundleInstaller(object):
 
         self.post_install(bundle)
 
+    def committed(self, landed=None):
+        """
+        Report the staged certs which are among the landed ones (all of
+        them if None), and run post_install() for their bundles. The
+        others were never installed.
+        """
+        # Certificates compare by their dates alone, go by serial:
+        serials = None
+        if landed is not None:
+            serials = set([cert.serial for cert in landed])
+        for (bundle, cert) in self._staged:
+            if serials is None or cert.serial in serials:
+                self.report.added.append(cert)
+                self.post_install(bundle)
+        self._staged = []
+
     # TODO: add subman plugin, slot, and conduit
     def pre_install(self, bundle):
         """Hook called before an ent cert bundle is installed."""
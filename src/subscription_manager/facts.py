@@ -12,11 +12,13 @@
 #
 
 from datetime import datetime
+import fnmatch
 import gettext
 import glob
 import logging
 import os
 
+from iniparse.compat import NoOptionError, NoSectionError
 import rhsm.config
 
 from subscription_manager.injection import PLUGIN_MANAGER, require
@@ -32,6 +34,99 @@ log = logging.getLogger('rhsm-app.' + __name__)
 # prefers:
 CERT_VERSION = "3.2"
 
+# see bz #627962
+# we would like to have this info, but for now, since it
+# can change constantly on laptops, it makes for a lot of
+# fact churn, so we report it, but ignore it as an indicator
+# that we need to update. More globs can be added with
+# fact_graylist in rhsm.conf.
+DEFAULT_GRAYLIST = ['cpu.cpu_mhz', 'lscpu.cpu_mhz']
+
+cfg = rhsm.config.initConfig()
+
+
+def configured_graylist():
+    """
+    Returns the fact globs from fact_graylist in rhsm.conf, which can be
+    separated by commas or whitespace.
+    """
+    try:
+        value = cfg.get('rhsm', 'fact_graylist')
+    except (NoSectionError, NoOptionError):
+        return []
+    return (value or '').replace(',', ' ').split()
+
+
+def is_gray(key, graylist):
+    """ Whether the fact matches any of the graylist globs. """
+    for pattern in graylist:
+        if fnmatch.fnmatchcase(key, pattern):
+            return True
+    return False
+
+
+class FactsDiff(object):
+    """
+    The facts added, removed and changed going from old to new, leaving
+    out those matching any of the graylist globs.
+
+    added and removed are dicts of fact to its value, changed is a dict
+    of fact to a tuple of its old and new value. Evaluates to False when
+    nothing counts as a change.
+    """
+
+    def __init__(self, old, new, graylist=None):
+        self.graylist = graylist or []
+        self.added = {}
+        self.removed = {}
+        self.changed = {}
+        for key in set(old) | set(new):
+            if is_gray(key, self.graylist):
+                continue
+            if key not in old:
+                self.added[key] = new[key]
+            elif key not in new:
+                self.removed[key] = old[key]
+            elif old[key] != new[key]:
+                self.changed[key] = (old[key], new[key])
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self):
+        parts = []
+        for (label, facts) in [("added", self.added),
+                               ("removed", self.removed),
+                               ("changed", self.changed)]:
+            if facts:
+                parts.append("%s: %s" % (label, ", ".join(sorted(facts))))
+        return "; ".join(parts) or "no changes"
+
+
+class HardwareProbeCache(CacheManager):
+    """
+    The facts each hardware probe found last time, so probes whose facts
+    can't have changed since don't have to run again. See
+    hwprobe.Hardware.PROBE_VOLATILITY.
+    """
+    CACHE_FILE = "/var/lib/rhsm/facts/hardware_probes.json"
+    SIDECARS = []
+
+    def __init__(self):
+        self.probes = {}
+        if self._cache_exists():
+            self.probes = self._read_cache() or {}
+
+    def to_dict(self):
+        return self.probes
+
+    def _load_data(self, open_file):
+        return json.loads(open_file.read())
+
+    def _write_sidecars(self):
+        # Never compared against, so nothing to keep next to it
+        pass
+
 
 class Facts(CacheManager):
     """
@@ -48,12 +143,8 @@ class Facts(CacheManager):
 
         self.entitlement_dir = ent_dir or inj.require(inj.ENT_DIR)
         self.product_dir = prod_dir or inj.require(inj.PROD_DIR)
-        # see bz #627962
-        # we would like to have this info, but for now, since it
-        # can change constantly on laptops, it makes for a lot of
-        # fact churn, so we report it, but ignore it as an indicator
-        # that we need to update
-        self.graylist = ['cpu.cpu_mhz', 'lscpu.cpu_mhz']
+        # Globs of facts we report, but which don't count as a change:
+        self.graylist = DEFAULT_GRAYLIST + configured_graylist()
 
         # plugin manager so we can add custom facst via plugin
         self.plugin_manager = require(PLUGIN_MANAGER)
@@ -66,21 +157,35 @@ class Facts(CacheManager):
 
     def has_changed(self):
         """
-        return a dict of any key/values that have changed
-        including new keys or deleted keys
+        Check whether any facts which aren't graylisted were added,
+        removed or changed since they were last sent to the server.
         """
         if not self._cache_exists():
             log.info("Cache %s does not exit" % self.CACHE_FILE)
             return True
 
-        cached_facts = self._read_cache() or {}
         # In order to accurately check for changes, we must refresh local data
         self.facts = self.get_facts(True)
 
-        for key in (set(self.facts) | set(cached_facts)) - set(self.graylist):
-            if self.facts.get(key) != cached_facts.get(key):
-                return True
-        return False
+        # Reading the cache to tell what changed waits for the upload:
+        changed = self._digest_changed()
+        if changed is not None:
+            return changed
+
+        diff = self.get_diff()
+        if diff:
+            log.info("Facts changed: %s" % diff)
+        return bool(diff)
+
+    def get_diff(self, refresh=False):
+        """
+        Returns a FactsDiff from the facts last sent to the server to the
+        current ones, collecting them again first if refresh is set.
+        """
+        cached_facts = {}
+        if self._cache_exists():
+            cached_facts = self._read_cache() or {}
+        return FactsDiff(cached_facts, self.get_facts(refresh), self.graylist)
 
     def get_facts(self, refresh=False):
         if ((len(self.facts) == 0) or refresh):
@@ -98,9 +203,20 @@ class Facts(CacheManager):
     def to_dict(self):
         return self.get_facts()
 
+    def _digest_data(self):
+        return dict((key, value) for (key, value) in self.get_facts().items()
+                if not is_gray(key, self.graylist))
+
     def _load_hw_facts(self):
         import hwprobe
-        return hwprobe.Hardware().get_all()
+        probe_cache = HardwareProbeCache()
+        hardware = hwprobe.Hardware(probe_cache=probe_cache.probes)
+        hw_facts = hardware.get_all()
+        if hardware.probe_cache_changed:
+            # A probe which timed out may still add to it while writing:
+            probe_cache.probes = dict(probe_cache.probes)
+            probe_cache.write_cache()
+        return hw_facts
 
     def _parse_facts_json(self, json_buffer, file_path):
         custom_facts = None
@@ -149,7 +265,8 @@ class Facts(CacheManager):
         return file_facts
 
     def _sync_with_server(self, uep, consumer_uuid):
-        log.debug("Updating facts on server")
+        # The server only takes all of them at once:
+        log.info("Updating facts on server, %s" % self.get_diff())
         uep.updateConsumer(consumer_uuid, facts=self.get_facts())
 
     def _load_data(self, open_file):
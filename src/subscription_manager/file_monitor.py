@@ -20,17 +20,40 @@ Perfers to use gio as the backend, but can fallback to polling.
 """
 
 import gobject
+import logging
 import os
 
 import rhsm.config
 
+log = logging.getLogger('rhsm-app.' + __name__)
+
+try:
+    import gio
+except ImportError:
+    gio = None
+
+# How often to poll directories we can't watch through gio:
+POLL_INTERVAL = 2000
+
+# gio reports every step of writing a file, wait this long for things to
+# settle down before telling anyone:
+SETTLE_INTERVAL = 250
+
 
 class MonitorDirectory(object):
+    """
+    Polls a directory for changes.
+
+    The directory mtime tells us something was added or removed, comparing
+    the mtime of each file in it then tells us which files changed.
+    """
 
     def __init__(self, path):
         self.mtime = None
         self.exists = None
+        self.files = {}
         self.path = path
+        self.changed_files = set()
         self.update()
 
     def _check_mtime(self):
@@ -42,12 +65,36 @@ class MonitorDirectory(object):
             exists = False
         return (mtime, exists)
 
+    def _check_files(self):
+        files = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return files
+        for name in names:
+            try:
+                files[name] = os.path.getmtime(os.path.join(self.path, name))
+            except OSError:
+                # Removed since we listed the directory.
+                pass
+        return files
+
     def update(self):
         mtime, exists = self._check_mtime()
 
         # Has something changed?
         result = mtime != self.mtime or exists != self.exists
 
+        self.changed_files = set()
+        if result:
+            # Only look at the files when we know something happened, so
+            # polling an idle directory stays cheap:
+            files = self._check_files()
+            for name in set(files) | set(self.files):
+                if files.get(name) != self.files.get(name):
+                    self.changed_files.add(name)
+            self.files = files
+
         # Update saved values
         self.mtime = mtime
         self.exists = exists
@@ -55,23 +102,87 @@ class MonitorDirectory(object):
         return result
 
 
+class GioMonitorDirectory(object):
+    """
+    Watches a directory through gio (inotify on Linux), so nothing has
+    to wake up while nothing is happening.
+
+    Changes are collected as they are reported, update() returns whether
+    there were any since it was last called.
+    """
+
+    def __init__(self, path, on_event):
+        self.path = path
+        self.changed_files = set()
+        self._pending = set()
+        self._changed = False
+        self._on_event = on_event
+        # We must hold a reference to the monitor to keep receiving events:
+        self._monitor = gio.File(path).monitor_directory()
+        self._monitor.connect('changed', self._on_changed)
+
+    def _on_changed(self, monitor, changed_file, other_file, event_type):
+        self._changed = True
+        for f in (changed_file, other_file):
+            if f is None:
+                continue
+            name = f.get_basename()
+            # Events for the directory itself carry its own name:
+            if f.get_path() != self.path:
+                self._pending.add(name)
+        self._on_event()
+
+    def update(self):
+        result = self._changed
+        self.changed_files = self._pending
+        self._pending = set()
+        self._changed = False
+        return result
+
+
 class Monitor(gobject.GObject):
 
     __gsignals__ = {
         'changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
-            (gobject.TYPE_BOOLEAN, gobject.TYPE_BOOLEAN, gobject.TYPE_BOOLEAN))
+            (gobject.TYPE_BOOLEAN, gobject.TYPE_BOOLEAN, gobject.TYPE_BOOLEAN)),
+        # Emitted along with 'changed', with the set of file names which
+        # changed in each directory, or None if it didn't change at all.
+        'files-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+            (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT,
+                gobject.TYPE_PYOBJECT))
     }
 
     def __init__(self):
         self.__gobject_init__()
         cfg = rhsm.config.initConfig()
+        self._settle_source = None
         # Identity, Entitlements, Products
-        self.dirs = [MonitorDirectory(cfg.get('rhsm', 'consumerCertDir')),
-                MonitorDirectory(cfg.get('rhsm', 'entitlementCertDir')),
-                MonitorDirectory(cfg.get('rhsm', 'productCertDir'))]
-
-        # poll every 2 seconds for changes
-        gobject.timeout_add(2000, self.run_check)
+        self.dirs = [self._monitor_directory(cfg.get('rhsm', 'consumerCertDir')),
+                self._monitor_directory(cfg.get('rhsm', 'entitlementCertDir')),
+                self._monitor_directory(cfg.get('rhsm', 'productCertDir'))]
+
+        # poll every 2 seconds for changes, if we have to
+        if [d for d in self.dirs if isinstance(d, MonitorDirectory)]:
+            gobject.timeout_add(POLL_INTERVAL, self.run_check)
+
+    def _monitor_directory(self, path):
+        if gio is not None:
+            try:
+                return GioMonitorDirectory(path, self._on_event)
+            except Exception, e:
+                log.debug("Unable to watch %s, polling instead: %s" % (path, e))
+        return MonitorDirectory(path)
+
+    def _on_event(self):
+        if self._settle_source is None:
+            self._settle_source = gobject.timeout_add(SETTLE_INTERVAL,
+                    self._on_settled)
+
+    def _on_settled(self):
+        self._settle_source = None
+        self.run_check()
+        # Don't fire again until there is another event:
+        return False
 
     def run_check(self):
         result = [directory.update() for directory in self.dirs]
@@ -79,4 +190,11 @@ class Monitor(gobject.GObject):
         # If something has changed
         if True in result:
             self.emit("changed", *result)
+            files = []
+            for (directory, changed) in zip(self.dirs, result):
+                if changed:
+                    files.append(directory.changed_files)
+                else:
+                    files.append(None)
+            self.emit("files-changed", *files)
         return True
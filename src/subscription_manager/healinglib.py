@@ -21,6 +21,7 @@ from rhsm import certificate
 from subscription_manager import certlib
 from subscription_manager import entcertlib
 from subscription_manager import injection as inj
+from subscription_manager.consumer_state import CONSUMER, COMPLIANCE
 
 log = logging.getLogger('rhsm-app.' + __name__)
 
@@ -72,7 +73,11 @@ class HealingUpdateAction(object):
         # inject
         identity = inj.require(inj.IDENTITY)
         uuid = identity.getConsumerId()
-        consumer = self.uep.getConsumer(uuid)
+        # We need both, ask for them at once:
+        consumer_state = inj.require(inj.CONSUMER_STATE)
+        consumer_state.prefetch(self.uep, uuid, [CONSUMER, COMPLIANCE])
+        consumer = consumer_state.get_consumer(self.uep, uuid,
+                self.__class__.__name__)
 
         if 'autoheal' not in consumer or not consumer['autoheal']:
             log.info("Auto-heal disabled on server, skipping.")
@@ -20,13 +20,17 @@
 import commands
 import ethtool
 import gettext
+import hashlib
 import logging
 import os
 import platform
 import re
+import signal
 import socket
 from subprocess import PIPE, Popen
 import sys
+import threading
+import time
 
 _ = gettext.gettext
 
@@ -50,6 +54,19 @@ class CalledProcessError(Exception):
         return "Command '%s' returned non-zero exit status %d" % (self.cmd, self.returncode)
 
 
+class CommandTimeoutError(Exception):
+    """
+    Raised when a command run for some facts didn't finish in time, and
+    was killed.
+    """
+    def __init__(self, cmd, timeout):
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' killed after %s seconds" % (self.cmd, self.timeout)
+
+
 class ClassicCheck:
 
     def is_registered_with_classic(self):
@@ -91,6 +108,154 @@ def gather_entries(entries_string):
     return entries
 
 
+# take a cpu siblings list like gather_entries does, and return it as a
+# bitmask with a bit set for each cpu in it. '0-3,8' returns 0x10f
+def cpumask_from_list(entries_string):
+    mask = 0
+    for entry_part in entries_string.split(','):
+        range_list = entry_part.split('-')
+        start = int(range_list[0])
+        end = int(range_list[-1])
+        mask |= ((1 << (end - start + 1)) - 1) << start
+    return mask
+
+
+def count_cpumask(mask):
+    return bin(mask).count('1')
+
+
+# How long what a probe finds stays true, see Hardware.PROBE_VOLATILITY:
+# Can change at any time, so always probed:
+VOLATILE = "volatile"
+# Only changes with a reboot:
+BOOT = "boot"
+# Can also change when CPUs are hot (un)plugged:
+HOTPLUG = "hotplug"
+# Can also change when the network configuration or addresses change:
+NETWORK = "network"
+
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+# Starts commands in a session, and so a process group, of their own. A
+# preexec_fn would do the same, but isn't safe with other threads running:
+SETSID = "/usr/bin/setsid"
+
+# What we look at to tell whether there might have been a hotplug, or a
+# network change:
+HOTPLUG_SOURCES = ["/sys/devices/system/cpu/online",
+                   "/sys/devices/system/cpu/present"]
+NETWORK_SOURCES = ["/proc/net/route", "/proc/net/if_inet6"]
+NETWORK_CONFIG_FILES = ["/etc/hosts", "/etc/resolv.conf",
+                        "/etc/nsswitch.conf"]
+
+
+def _read_source(path):
+    try:
+        f = open(path, 'r')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return "-"
+
+
+def _source_mtime(path):
+    try:
+        return repr(os.stat(path).st_mtime)
+    except OSError:
+        return "-"
+
+
+def run_probes(probes, timeout, max_threads):
+    """
+    Call each of probes on up to max_threads threads at a time, giving up
+    on any probe which takes longer than timeout seconds. timeout can also
+    be a list of the seconds to give each of probes.
+
+    Returns a tuple of a dict of probe to how many seconds it took, a dict
+    of probe to the exception it raised, and a list of probes which timed
+    out. Those are left running, on daemon threads so they don't hold up
+    exiting, and another thread takes over the remaining probes.
+    """
+    if isinstance(timeout, list):
+        timeouts = timeout
+    else:
+        timeouts = [timeout] * len(probes)
+
+    cond = threading.Condition()
+    # Probes are tracked by their position in probes:
+    queue = range(len(probes))
+    started = {}
+    durations = {}
+    errors = {}
+    timed_out = set()
+
+    def worker():
+        while True:
+            cond.acquire()
+            try:
+                if not queue:
+                    return
+                index = queue.pop(0)
+                started[index] = time.time()
+                # Its deadline counts from now:
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+            error = None
+            try:
+                probes[index]()
+            except Exception, e:
+                error = e
+
+            cond.acquire()
+            try:
+                if index not in timed_out:
+                    durations[index] = time.time() - started[index]
+                    if error is not None:
+                        errors[index] = error
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    def start_worker():
+        thread = threading.Thread(target=worker, name="HardwareProbe")
+        thread.setDaemon(True)
+        thread.start()
+
+    cond.acquire()
+    try:
+        for i in range(min(max_threads, len(probes))):
+            start_worker()
+
+        while True:
+            now = time.time()
+            deadlines = []
+            for (index, started_at) in started.items():
+                if index in durations or index in timed_out:
+                    continue
+                if now - started_at >= timeouts[index]:
+                    timed_out.add(index)
+                    if queue:
+                        start_worker()
+                else:
+                    deadlines.append(started_at + timeouts[index])
+            if len(durations) + len(timed_out) == len(probes):
+                break
+            if deadlines:
+                cond.wait(min(deadlines) - now)
+            else:
+                cond.wait(max(timeouts))
+    finally:
+        cond.release()
+
+    return (dict((probes[index], duration) for (index, duration) in durations.items()),
+            dict((probes[index], error) for (index, error) in errors.items()),
+            [probes[index] for index in sorted(timed_out)])
+
+
 class GenericPlatformSpecificInfoProvider(object):
     """Default provider for platform without a specific platform info provider.
 
@@ -105,8 +270,54 @@ class GenericPlatformSpecificInfoProvider(object):
 
 class Hardware:
 
-    def __init__(self, prefix=None, testing=None):
+    # Seconds to wait for any one probe before going on without its facts:
+    PROBE_TIMEOUT = 30
+    # Probes which spend most of their time waiting on something else
+    # (the resolver, or a command) get less:
+    PROBE_TIMEOUTS = {
+        'get_network_info': 10,
+        'get_virt_info': 10,
+    }
+    # Seconds a command run for facts gets before it is killed. This is
+    # less than the probes running them get, so none is left behind:
+    COMMAND_TIMEOUT = 8
+    # Facts to report for a probe which timed out, if it never found any
+    # before. Leaving out virt facts would make a guest look like a host:
+    PROBE_FALLBACK_FACTS = {
+        'get_virt_info': {'virt.is_guest': 'Unknown',
+                          'virt.host_type': 'Unknown'},
+    }
+
+    # Independent probes run concurrently on up to this many threads:
+    MAX_PROBE_THREADS = 4
+
+    # The volatility class of what each probe finds (anything not listed
+    # is VOLATILE), and the files it comes from. Probes cheaper than
+    # telling whether they need to run again are left VOLATILE, i.e.
+    # memory which balloon drivers change at any time.
+    PROBE_VOLATILITY = {
+        'get_release_info': (BOOT, ['/etc/os-release', '/etc/redhat-release']),
+        'get_cpu_info': (HOTPLUG, []),
+        'get_ls_cpu_info': (HOTPLUG, []),
+        'get_network_info': (NETWORK, []),
+        'get_network_interfaces': (NETWORK, []),
+        'get_virt_info': (BOOT, []),
+        # DMI, which also corrects the cpu info on xen dom0:
+        'get_platform_specific_info': (HOTPLUG, []),
+    }
+
+    def __init__(self, prefix=None, testing=None, probe_cache=None):
         self.allhw = {}
+        # How long each probe took, by name:
+        self.probe_durations = {}
+
+        # Probe name to a dict of the facts it found, and the key they are
+        # valid for (see probe_key). Updated with anything probed again.
+        self.probe_cache = probe_cache
+        self.probe_cache_changed = False
+        self._volatility_keys = {}
+        # Probes which ran into errors, whose facts must not be reused:
+        self._failed_probes = set()
         # prefix to look for /sys, for testing
         self.prefix = prefix or ''
         self.testing = testing or False
@@ -183,6 +394,7 @@ class Hardware:
         This is only dmi/smbios data for now (which isn't on ppc/s390).
         """
 
+        before = dict(self.allhw)
         if self.testing and self.prefix:
             dump_file = "%s/dmi.dump" % self.prefix
             platform_info = self.platform_specific_info_provider(self.allhw, dump_file=dump_file).info
@@ -191,6 +403,11 @@ class Hardware:
 
         self.allhw.update(platform_info)
 
+        # The provider can also correct what other probes found (i.e. the
+        # cpu sockets on xen dom0), so return everything it changed:
+        return dict((key, value) for (key, value) in self.allhw.items()
+                if key not in before or before[key] != value)
+
     # this version os very RHEL/Fedora specific...
     def get_distribution(self):
 
@@ -270,29 +487,41 @@ class Hardware:
                     nkey = '.'.join(["memory", key.lower()])
                     self.meminfo[nkey] = "%s" % int(value)
         except Exception, e:
+            self._failed_probes.add('get_mem_info')
             print _("Error reading system memory information:"), e
         self.allhw.update(self.meminfo)
         return self.meminfo
 
-    def count_cpumask_entries(self, cpu, field):
+    def read_cpumask(self, cpu, field):
+        """
+        Returns the cpu siblings list in cpu/topology/field as a bitmask,
+        or None if it is missing or empty.
+        """
+        path = "%s/topology/%s" % (cpu, field)
+        mask = None
         try:
-            f = open("%s/topology/%s" % (cpu, field), 'r')
+            f = open(path, 'r')
         except IOError:
-            return None
+            f = None
 
-        # ia64 entries seem to be null padded, or perhaps
-        # that's a collection error
-        # FIXME
-        entries = f.read().rstrip('\n\x00')
-        f.close()
-        # these fields can exist, but be empty. For example,
-        # thread_siblings_list from s390x-rhel64-zvm-2cpu-has-topo
-        # test data
-
-        if len(entries):
-            cpumask_entries = gather_entries(entries)
-            return len(cpumask_entries)
-        # that field was empty
+        if f:
+            # ia64 entries seem to be null padded, or perhaps
+            # that's a collection error
+            # FIXME
+            entries = f.read().rstrip('\n\x00')
+            f.close()
+            # these fields can exist, but be empty. For example,
+            # thread_siblings_list from s390x-rhel64-zvm-2cpu-has-topo
+            # test data
+            if len(entries):
+                mask = cpumask_from_list(entries)
+        return mask
+
+    def count_cpumask_entries(self, cpu, field):
+        mask = self.read_cpumask(cpu, field)
+        if mask:
+            return count_cpumask(mask)
+        # that field was missing or empty
         return None
 
     # replace/add with getting CPU Totals for s390x
@@ -580,6 +809,7 @@ class Hardware:
                     #
                     pass
         except Exception, e:
+            self._failed_probes.add('get_ls_cpu_info')
             print _("Error reading system CPU information:"), e
         self.allhw.update(self.lscpuinfo)
         return self.lscpuinfo
@@ -605,6 +835,7 @@ class Hardware:
                 self.netinfo['network.ipv6_address'] = "::1"
 
         except Exception, e:
+            self._failed_probes.add('get_network_info')
             print _("Error reading networking information:"), e
         self.allhw.update(self.netinfo)
         return self.netinfo
@@ -704,6 +935,7 @@ class Hardware:
                     netinfdict[key] = permanent_mac_addr
 
         except Exception:
+            self._failed_probes.add('get_network_interfaces')
             print _("Error reading network interface information:"), sys.exc_type
         self.allhw.update(netinfdict)
         return netinfdict
@@ -748,10 +980,14 @@ class Hardware:
             else:
                 virt_dict['virt.is_guest'] = False
                 virt_dict['virt.host_type'] = "Not Applicable"
+        except CommandTimeoutError:
+            # Leave it to _run_probes to use what we found last time:
+            raise
         # TODO:  Should this only catch OSErrors?
         except Exception, e:
             # Otherwise there was an error running virt-what - who knows
             log.exception(e)
+            self._failed_probes.add('get_virt_info')
             virt_dict['virt.is_guest'] = 'Unknown'
 
         # xen dom0 is a guest for virt-what's purposes, but is a host for
@@ -771,8 +1007,37 @@ class Hardware:
 
     def _get_output(self, cmd):
         log.debug("Running '%s'" % cmd)
-        process = Popen([cmd], stdout=PIPE, stderr=PIPE)
-        (std_output, std_error) = process.communicate()
+        # In a process group of its own if we can, so anything it runs
+        # (virt-what is a shell script) can be killed along with it:
+        own_group = os.access(SETSID, os.X_OK)
+        if own_group:
+            process = Popen([SETSID, cmd], stdout=PIPE, stderr=PIPE)
+        else:
+            process = Popen([cmd], stdout=PIPE, stderr=PIPE)
+
+        # Kill it if it takes too long, communicate() then returns:
+        killed = []
+
+        def kill():
+            killed.append(True)
+            try:
+                if own_group:
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    os.kill(process.pid, signal.SIGKILL)
+            except OSError:
+                # Finished after all
+                pass
+
+        timer = threading.Timer(self.COMMAND_TIMEOUT, kill)
+        timer.setDaemon(True)
+        timer.start()
+        try:
+            (std_output, std_error) = process.communicate()
+        finally:
+            timer.cancel()
+        if killed:
+            raise CommandTimeoutError(cmd, self.COMMAND_TIMEOUT)
 
         log.debug("%s stdout: %s" % (cmd, std_output))
         log.debug("%s stderr: %s" % (cmd, std_error))
@@ -825,33 +1090,142 @@ class Hardware:
         "Log any warnings from firmware info gather,and/or clear them."
         self.get_platform_specific_info_provider().log_warnings()
 
+    def _volatility_key(self, volatility):
+        """
+        Returns a string which changes whenever something of the given
+        volatility class may have changed, or None if we can't tell.
+        """
+        if volatility not in self._volatility_keys:
+            sources = []
+            if volatility in (BOOT, HOTPLUG, NETWORK):
+                sources.append(_read_source(BOOT_ID_FILE).strip())
+            if volatility == HOTPLUG:
+                sources.extend([_read_source(path) for path in HOTPLUG_SOURCES])
+            if volatility == NETWORK:
+                sources.append(socket.gethostname())
+                sources.extend([_read_source(path) for path in NETWORK_SOURCES])
+                sources.extend([_source_mtime(path) for path in NETWORK_CONFIG_FILES])
+            key = None
+            # Without a boot id, we can't tell one boot from the next:
+            if sources and sources[0] != "-":
+                key = hashlib.sha256("\0".join(sources)).hexdigest()
+            self._volatility_keys[volatility] = key
+        return self._volatility_keys[volatility]
+
+    def probe_key(self, name):
+        """
+        Returns the key the facts found by the named probe are valid for,
+        or None if they must be probed every time.
+        """
+        # Facts from a test prefix are nothing to do with this system:
+        if self.testing:
+            return None
+        (volatility, files) = self.PROBE_VOLATILITY.get(name, (VOLATILE, []))
+        key = self._volatility_key(volatility)
+        if key is None:
+            return None
+        return ",".join([key] + [_source_mtime(path) for path in files])
+
+    def _cached(self, hardware_method):
+        """
+        Wrap the hardware method to use what it found last time from the
+        probe cache, as long as that can't have changed since.
+        """
+        name = hardware_method.__name__
+
+        def cached_hardware_method():
+            key = None
+            if self.probe_cache is not None:
+                key = self.probe_key(name)
+            if key is None:
+                return hardware_method()
+
+            cached = self.probe_cache.get(name)
+            if cached and cached.get('key') == key:
+                self.allhw.update(cached['facts'])
+                return cached['facts']
+
+            facts = hardware_method()
+            if facts and name not in self._failed_probes:
+                self.probe_cache[name] = {'key': key, 'facts': facts}
+                self.probe_cache_changed = True
+            elif cached:
+                del self.probe_cache[name]
+                self.probe_cache_changed = True
+            return facts
+
+        cached_hardware_method.__name__ = name
+        return cached_hardware_method
+
+    def _use_last_facts(self, name):
+        """
+        Use whatever the named probe found last time from the probe cache,
+        however old, in place of facts it didn't find in time.
+        """
+        cached = None
+        if self.probe_cache is not None:
+            cached = self.probe_cache.get(name)
+        if not cached:
+            log.warn("No earlier facts to use for: %s" % name)
+            self.allhw.update(self.PROBE_FALLBACK_FACTS.get(name, {}))
+            return
+        log.warn("Using facts from an earlier run for: %s" % name)
+        self.allhw.update(cached['facts'])
+
+    def _run_probes(self, hardware_methods):
+        """
+        Run the given hardware methods concurrently. Each is tried
+        separately, since these tend to be fragile, and none is waited on
+        for longer than its timeout (see PROBE_TIMEOUTS). Probes which
+        time out get what they found last time instead.
+        """
+        hardware_methods = [self._cached(hardware_method)
+                for hardware_method in hardware_methods]
+        timeouts = [self.PROBE_TIMEOUTS.get(hardware_method.__name__,
+                                            self.PROBE_TIMEOUT)
+                    for hardware_method in hardware_methods]
+        (durations, errors, timed_out) = run_probes(hardware_methods,
+                timeouts, self.MAX_PROBE_THREADS)
+        for (hardware_method, timeout) in zip(hardware_methods, timeouts):
+            name = hardware_method.__name__
+            if hardware_method in timed_out:
+                log.warn("Hardware detection timed out after %s seconds: %s" %
+                        (timeout, name))
+                self._use_last_facts(name)
+                continue
+            if isinstance(errors.get(hardware_method), CommandTimeoutError):
+                log.warn("Hardware detection timed out: %s: %s" %
+                        (name, errors[hardware_method]))
+                self._use_last_facts(name)
+            elif hardware_method in errors:
+                log.warn("%s" % name)
+                log.warn("Hardware detection failed: %s" % errors[hardware_method])
+            self.probe_durations[name] = durations[hardware_method]
+            log.debug("Hardware detection took %.3f seconds: %s" %
+                    (durations[hardware_method], name))
+
     def get_all(self):
-        hardware_methods = [self.get_uname_info,
-                            self.get_release_info,
-                            self.get_mem_info,
-                            self.get_cpu_info,
-                            self.get_ls_cpu_info,
-                            self.get_network_info,
-                            self.get_network_interfaces,
-                            self.get_virt_info,
-                            # this has to happen after everything else, since
-                            # it expects to check virt and processor info
-                            self.get_platform_specific_info]
-        # try each hardware method, and try/except around, since
-        # these tend to be fragile
-        for hardware_method in hardware_methods:
-            try:
-                hardware_method()
-            except Exception, e:
-                log.warn("%s" % hardware_method)
-                log.warn("Hardware detection failed: %s" % e)
+        # These don't depend on each other:
+        self._run_probes([self.get_uname_info,
+                          self.get_release_info,
+                          self.get_mem_info,
+                          self.get_cpu_info,
+                          self.get_ls_cpu_info,
+                          self.get_network_info,
+                          self.get_network_interfaces,
+                          self.get_virt_info])
+
+        # this has to happen after everything else, since
+        # it expects to check virt and processor info
+        self._run_probes([self.get_platform_specific_info])
 
         #we need to know the DMI info and VirtInfo before determining UUID.
         #Thus, we can't figure it out within the main data collection loop.
         if self.allhw.get('virt.is_guest'):
             self.get_virt_uuid()
 
-        return self.allhw
+        # A probe which timed out can still add to allhw later on:
+        return dict(self.allhw)
 
 
 if __name__ == '__main__':
@@ -86,5 +86,6 @@ class IdentityUpdateAction(object):
 
     def _get_consumer(self, identity):
         # FIXME: not much for error handling here
-        consumer = self.uep.getConsumer(identity.uuid)
+        consumer = inj.require(inj.CONSUMER_STATE).get_consumer(self.uep,
+                identity.uuid, self.__class__.__name__)
         return consumer
@@ -30,6 +30,7 @@ ACTION_LOCK = "ACTION_LOCK"
 FACTS = "FACTS"
 PROFILE_MANAGER = "PROFILE_MANAGER"
 INSTALLED_PRODUCTS_MANAGER = "INSTALLED_PRODUCTS_MANAGER"
+CONSUMER_STATE = "CONSUMER_STATE"
 
 import types
 
@@ -19,6 +19,7 @@ from subscription_manager.cache import ProductStatusCache, EntitlementStatusCach
     ProfileManager, InstalledProductsManager, PoolTypeCache
 
 from subscription_manager.cert_sorter import CertSorter
+from subscription_manager.consumer_state import ConsumerState
 from subscription_manager.certdirectory import EntitlementDirectory
 from subscription_manager.certdirectory import ProductDirectory
 from subscription_manager.facts import Facts
@@ -49,6 +50,7 @@ def init_dep_injection():
     inj.provide(inj.ENTITLEMENT_STATUS_CACHE, EntitlementStatusCache, singleton=True)
     inj.provide(inj.PROD_STATUS_CACHE, ProductStatusCache, singleton=True)
     inj.provide(inj.OVERRIDE_STATUS_CACHE, OverrideStatusCache, singleton=True)
+    inj.provide(inj.CONSUMER_STATE, ConsumerState, singleton=True)
     inj.provide(inj.PROFILE_MANAGER, ProfileManager, singleton=True)
     inj.provide(inj.INSTALLED_PRODUCTS_MANAGER, InstalledProductsManager, singleton=True)
 
@@ -25,6 +25,7 @@ from optparse import OptionValueError
 import os
 import socket
 import sys
+import time
 from time import localtime, strftime, strptime
 
 from M2Crypto import X509
@@ -34,11 +35,13 @@ import rhsm.connection as connection
 from rhsm.utils import remove_scheme, ServerUrlParseError
 
 from subscription_manager.branding import get_branding
+from subscription_manager import cache
 from subscription_manager.entcertlib import EntCertActionInvoker
 from subscription_manager.action_client import ActionClient, UnregisterActionClient
 from subscription_manager.cert_sorter import ComplianceManager, FUTURE_SUBSCRIBED, \
         SUBSCRIBED, NOT_SUBSCRIBED, EXPIRED, PARTIALLY_SUBSCRIBED, UNKNOWN
 from subscription_manager.cli import AbstractCLICommand, CLI, system_exit
+from subscription_manager.consumer_state import COMPLIANCE, CONSUMER
 from subscription_manager import rhelentbranding
 from subscription_manager.hwprobe import ClassicCheck
 import subscription_manager.injection as inj
@@ -53,6 +56,7 @@ from subscription_manager.utils import parse_server_info, \
         restart_virt_who, get_terminal_width
 from subscription_manager.overrides import Overrides, Override
 from subscription_manager.exceptions import ExceptionMapper
+from subscription_manager.facts import Facts, HardwareProbeCache
 from subscription_manager.printing_utils import columnize, format_name, _none_wrap, _echo
 
 _ = gettext.gettext
@@ -122,6 +126,20 @@ ORG_LIST = [
     _("Key:")
 ]
 
+CACHE_LIST = [
+    _("Cache:"),
+    _("File:"),
+    _("Size:"),
+    _("Age:"),
+    _("Hits:"),
+    _("Misses:"),
+    _("Hit Rate:"),
+    _("Errors:"),
+    _("Average Sync Time:"),
+    _("Last Sync:"),
+    _("Last Sync Time:")
+]
+
 CONSUMED_LIST = [
     _("Subscription Name:"),
     _("Provides:"),
@@ -539,6 +557,110 @@ class CleanCommand(CliCommand):
         return False
 
 
+class CacheCommand(CliCommand):
+
+    def __init__(self):
+        shortdesc = _("Show statistics for the local caches, or invalidate them")
+        super(CacheCommand, self).__init__("cache", shortdesc, False)
+
+        self.parser.add_option("--list", action="store_true",
+                               help=_("list the local caches with their statistics (default)"))
+        self.parser.add_option("--invalidate", dest="invalidate", action="append",
+                               metavar="NAME",
+                               help=_("delete the named cache so it is rebuilt when next needed, "
+                                      "can be specified more than once, or as 'all'"))
+        self.parser.add_option("--reset-stats", dest="reset_stats", action="store_true",
+                               help=_("reset the statistics for all caches"))
+
+    def _caches(self):
+        """
+        Returns a list of (name, cache file, function deleting the cache)
+        for each of the local caches.
+        """
+        caches = []
+        for cache_class in [Facts, HardwareProbeCache, cache.ProfileManager,
+                            cache.InstalledProductsManager,
+                            cache.PoolTypeCache, cache.WrittenOverrideCache]:
+            caches.append((cache_class.stats_name(), cache_class.CACHE_FILE,
+                           cache_class.delete_cache))
+        # Status caches are deleted through the instance, to drop what is
+        # held in memory as well:
+        for feature in [inj.ENTITLEMENT_STATUS_CACHE, inj.PROD_STATUS_CACHE,
+                        inj.OVERRIDE_STATUS_CACHE]:
+            status_cache = inj.require(feature)
+            caches.append((status_cache.stats_name(), status_cache.CACHE_FILE,
+                           status_cache.delete_cache))
+        return caches
+
+    def _validate_options(self):
+        names = [name for (name, cache_file, delete) in self._caches()]
+        for name in self.options.invalidate or []:
+            if name != 'all' and name not in names:
+                system_exit(-1, _("Error: No such cache: %s, should be one of: %s") %
+                            (name, ", ".join(names + ['all'])))
+
+        # if no relevant options, default to listing.
+        if not (self.options.list or self.options.invalidate or self.options.reset_stats):
+            self.options.list = True
+
+    def require_connection(self):
+        return False
+
+    def _format_time(self, timestamp):
+        if not timestamp:
+            return None
+        return strftime("%Y-%m-%d %H:%M:%S", localtime(timestamp))
+
+    def _list(self):
+        stats = cache.cache_stats.load()
+        print "+-------------------------------------------+"
+        print _("    Local Caches")
+        print "+-------------------------------------------+"
+        now = time.time()
+        for (name, cache_file, delete) in self._caches():
+            cache_stats = stats.get(name, {})
+            size = None
+            age = None
+            if os.path.exists(cache_file):
+                st = os.stat(cache_file)
+                size = _("%d bytes") % st.st_size
+                age = _("%d seconds") % max(0, now - st.st_mtime)
+
+            hits = cache_stats.get('hits', 0)
+            misses = cache_stats.get('misses', 0)
+            hit_rate = None
+            if hits + misses:
+                hit_rate = "%d%%" % (100 * hits / (hits + misses))
+            sync_time = None
+            last_sync_time = None
+            if cache_stats.get('syncs'):
+                sync_time = _("%.3f seconds") % (cache_stats['sync_time'] / cache_stats['syncs'])
+                last_sync_time = _("%.3f seconds") % cache_stats['last_sync_time']
+
+            print columnize(CACHE_LIST, _none_wrap, name, cache_file, size, age,
+                            str(hits), str(misses), hit_rate,
+                            str(cache_stats.get('errors', 0)), sync_time,
+                            self._format_time(cache_stats.get('last_sync')),
+                            last_sync_time) + "\n"
+
+    def _do_command(self):
+        self._validate_options()
+
+        if self.options.invalidate:
+            invalidate = self.options.invalidate
+            for (name, cache_file, delete) in self._caches():
+                if name in invalidate or 'all' in invalidate:
+                    delete()
+                    print _("Invalidated cache: %s") % name
+
+        if self.options.reset_stats:
+            cache.cache_stats.reset()
+            print _("Cache statistics reset")
+
+        if self.options.list:
+            self._list()
+
+
 class RefreshCommand(CliCommand):
     def __init__(self):
         shortdesc = _("Pull the latest subscription data from the server")
@@ -2034,6 +2156,10 @@ class ListCommand(CliCommand):
         self._validate_options()
 
         if self.options.installed:
+            if self.is_registered():
+                # Product status needs both, fetch them at once:
+                inj.require(inj.CONSUMER_STATE).prefetch(self.cp,
+                        self.identity.uuid, [CONSUMER, COMPLIANCE])
             iproducts = managerlib.get_installed_product_status(self.product_dir,
                     self.entitlement_dir, self.cp)
             if not len(iproducts):
@@ -2396,7 +2522,7 @@ class ManagerCLI(CLI):
                     RedeemCommand, ReposCommand, ReleaseCommand, StatusCommand,
                     EnvironmentsCommand, ImportCertCommand, ServiceLevelCommand,
                     VersionCommand, RemoveCommand, AttachCommand, PluginsCommand,
-                    AutohealCommand, OverrideCommand]
+                    AutohealCommand, OverrideCommand, CacheCommand]
         CLI.__init__(self, command_classes=commands)
 
     def main(self):
@@ -29,7 +29,7 @@ from rhsm.certificate import Key, CertificateException, create_from_pem
 import subscription_manager.cache as cache
 from subscription_manager.cert_sorter import StackingGroupSorter, ComplianceManager
 from subscription_manager import identity
-from subscription_manager.facts import Facts
+from subscription_manager.facts import Facts, HardwareProbeCache
 from subscription_manager.injection import require, CERT_SORTER, \
         PRODUCT_DATE_RANGE_CALCULATOR, IDENTITY, ENTITLEMENT_STATUS_CACHE, \
         PROD_STATUS_CACHE, ENT_DIR, PROD_DIR, CP_PROVIDER, OVERRIDE_STATUS_CACHE, \
@@ -167,18 +167,15 @@ class PoolFilter(object):
         Filter the given list of pools, return only those which provide
         a product installed on this system.
         """
-        installed_products = self.product_directory.list()
+        installed_ids = self._get_installed_product_ids()
         matched_data_dict = {}
         for d in pools:
-            for product in installed_products:
-                productid = product.products[0].id
-                # we only need one matched item per pool id, so add to dict to keep unique:
-                # Build a list of provided product IDs for comparison:
-                provided_ids = [p['productId'] for p in d['providedProducts']]
-
-                if str(productid) in provided_ids or \
-                        str(productid) == d['productId']:
-                    matched_data_dict[d['id']] = d
+            # Build a list of provided product IDs for comparison:
+            provided_ids = [p['productId'] for p in d['providedProducts']]
+            provided_ids.append(d['productId'])
+            # we only need one matched item per pool id, so add to dict to keep unique:
+            if installed_ids.intersection(provided_ids):
+                matched_data_dict[d['id']] = d
 
         return matched_data_dict.values()
 
@@ -187,21 +184,21 @@ class PoolFilter(object):
         Filter the given list of pools, return only those which do not provide
         a product installed on this system.
         """
-        installed_products = self.product_directory.list()
+        installed_ids = self._get_installed_product_ids()
         matched_data_dict = {}
         for d in pools:
-            matched_data_dict[d['id']] = d
             provided_ids = [p['productId'] for p in d['providedProducts']]
-            for product in installed_products:
-                productid = product.products[0].id
-                # we only need one matched item per pool id, so add to dict to keep unique:
-                if str(productid) in provided_ids or \
-                        str(productid) == d['productId']:
-                    del matched_data_dict[d['id']]
-                    break
+            provided_ids.append(d['productId'])
+            # we only need one matched item per pool id, so add to dict to keep unique:
+            if not installed_ids.intersection(provided_ids):
+                matched_data_dict[d['id']] = d
 
         return matched_data_dict.values()
 
+    def _get_installed_product_ids(self):
+        return set([str(summary.id) for summary in
+            self.product_directory.list_summaries()])
+
     def filter_product_name(self, pools, contains_text):
         """
         Filter the given list of pools, removing those whose product name
@@ -221,19 +218,21 @@ class PoolFilter(object):
 
     def _get_entitled_product_ids(self):
         entitled_products = []
-        for cert in self.entitlement_directory.list():
-            for product in cert.products:
-                entitled_products.append(product.id)
+        for summary in self.entitlement_directory.list_summaries():
+            entitled_products.extend(summary.product_ids)
         return entitled_products
 
     def _get_entitled_product_to_cert_map(self):
+        """
+        Maps entitled product IDs to summaries of the entitlement
+        certificates providing them.
+        """
         entitled_products_to_certs = {}
-        for cert in self.entitlement_directory.list():
-            for product in cert.products:
-                prod_id = product.id
+        for summary in self.entitlement_directory.list_summaries():
+            for prod_id in summary.product_ids:
                 if prod_id not in entitled_products_to_certs:
                     entitled_products_to_certs[prod_id] = set()
-                entitled_products_to_certs[prod_id].add(cert)
+                entitled_products_to_certs[prod_id].add(summary)
         return entitled_products_to_certs
 
     def _dates_overlap(self, pool, certs):
@@ -537,7 +536,7 @@ class PoolStash(object):
         return self._filter_pools(incompatible, overlapping, uninstalled, False, text)
 
     def _get_subscribed_pool_ids(self):
-        return [ent.pool.id for ent in require(ENT_DIR).list()]
+        return set(require(ENT_DIR).list_pool_ids())
 
     def _filter_pools(self, incompatible, overlapping, uninstalled, subscribed,
             text):
@@ -863,7 +862,9 @@ def clean_all_data(backup=True):
 
     cache.ProfileManager.delete_cache()
     cache.InstalledProductsManager.delete_cache()
+    cache.PoolTypeCache.delete_cache()
     Facts.delete_cache()
+    HardwareProbeCache.delete_cache()
 
     # Must also delete in-memory cache
     require(ENTITLEMENT_STATUS_CACHE).delete_cache()
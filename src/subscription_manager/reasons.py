@@ -39,15 +39,19 @@ class Reasons(object):
         subscriptions to lists of reasons
         """
         result = {}
+        stack_subscriptions = {}
         for s in self.sorter.valid_entitlement_certs:
             result[s.subject['CN']] = []
+            if s.order and s.order.stacking_id:
+                stack_subscriptions.setdefault(s.order.stacking_id,
+                        set()).add(s.subject['CN'])
 
         for reason in self.reasons:
             if 'entitlement_id' in reason['attributes']:
                 if reason['message'] not in result[reason['attributes']['entitlement_id']]:
                     result[reason['attributes']['entitlement_id']].append(reason['message'])
             elif 'stack_id' in reason['attributes']:
-                for s in self.get_stack_subscriptions(reason['attributes']['stack_id']):
+                for s in stack_subscriptions.get(reason['attributes']['stack_id'], []):
                     if reason['message'] not in result[s]:
                         result[s].append(reason['message'])
         return result
@@ -64,7 +68,8 @@ class Reasons(object):
     def get_stack_subscriptions(self, stack_id):
         result = set([])
         for s in self.sorter.valid_entitlement_certs:
-            if s.order.stacking_id and s.order.stacking_id == stack_id:
+            if s.order and s.order.stacking_id and \
+                    s.order.stacking_id == stack_id:
                 result.add(s.subject['CN'])
         return list(result)
 
@@ -102,7 +107,7 @@ class Reasons(object):
         for s in subscriptions:
             if 'CN' in s.subject:
                 sub_ids.append(s.subject['CN'])
-            if s.order.stacking_id:
+            if s.order and s.order.stacking_id:
                 stack_ids.append(s.order.stacking_id)
         for reason in self.reasons:
             if 'product_id' in reason['attributes']:
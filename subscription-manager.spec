@@ -212,6 +212,8 @@ rm -rf %{buildroot}
 %{_datadir}/rhsm/subscription_manager/branding
 %{_datadir}/rhsm/subscription_manager/cache.py*
 %{_datadir}/rhsm/subscription_manager/certdirectory.py*
+%{_datadir}/rhsm/subscription_manager/certindex.py*
+%{_datadir}/rhsm/subscription_manager/consumer_state.py*
 %{_datadir}/rhsm/subscription_manager/certlib.py*
 %{_datadir}/rhsm/subscription_manager/action_client.py*
 %{_datadir}/rhsm/subscription_manager/cert_sorter.py*
@@ -8,6 +8,7 @@ from mock import Mock, NonCallableMock, patch
 
 import stubs
 import subscription_manager.injection as inj
+from subscription_manager.consumer_state import ConsumerState
 
 # use instead of the normal pid file based ActionLock
 from threading import RLock
@@ -76,6 +77,8 @@ class SubManFixture(unittest.TestCase):
         inj.provide(inj.ENTITLEMENT_STATUS_CACHE, stubs.StubEntitlementStatusCache())
         inj.provide(inj.PROD_STATUS_CACHE, stubs.StubProductStatusCache())
         inj.provide(inj.OVERRIDE_STATUS_CACHE, stubs.StubOverrideStatusCache())
+        # A new one for every test, so nothing fetched is shared between them:
+        inj.provide(inj.CONSUMER_STATE, ConsumerState())
         inj.provide(inj.PROFILE_MANAGER, stubs.StubProfileManager())
         # By default set up an empty stub entitlement and product dir.
         # Tests need to modify or create their own but nothing should hit
@@ -108,6 +111,12 @@ class SubManFixture(unittest.TestCase):
         self.stub_facts = stubs.StubFacts()
         inj.provide(inj.FACTS, self.stub_facts)
 
+        # Don't count anything tests do towards the real cache stats:
+        cache_stats_patcher = patch('subscription_manager.cache.cache_stats',
+                stubs.StubCacheStats())
+        cache_stats_patcher.start()
+        self.addCleanup(cache_stats_patcher.stop)
+
         self.dbus_patcher = patch('subscription_manager.managercli.CliCommand._request_validity_check')
         self.dbus_patcher.start()
 
@@ -22,7 +22,7 @@ import tempfile
 
 from subscription_manager.cert_sorter import CertSorter
 from subscription_manager.cache import EntitlementStatusCache, ProductStatusCache, \
-        OverrideStatusCache, ProfileManager, InstalledProductsManager
+        OverrideStatusCache, ProfileManager, InstalledProductsManager, CacheStats
 from subscription_manager.facts import Facts
 from subscription_manager.lock import ActionLock
 from rhsm.certificate import GMT
@@ -96,7 +96,8 @@ config.CFG.read("test/rhsm.conf")
 
 from datetime import datetime, timedelta
 
-from subscription_manager.certdirectory import EntitlementDirectory, ProductDirectory
+from subscription_manager.certdirectory import EntitlementDirectory, ProductDirectory, \
+        ProductSummary
 
 from rhsm.certificate import parse_tags
 from rhsm.certificate2 import EntitlementCertificate, ProductCertificate, \
@@ -313,6 +314,8 @@ class StubProductDirectory(StubCertificateDirectory, ProductDirectory):
     """
 
     path = "this/is/a/stub"
+    # StubCertificateDirectory is an EntitlementDirectory first:
+    SUMMARY_CLASS = ProductSummary
 
     def __init__(self, certificates=None, pids=None):
         """
@@ -577,6 +580,10 @@ class StubCPProvider(object):
     def get_consumer_auth_cp(self):
         return self.consumer_auth_cp
 
+    # Tests set up the consumer connection they want, use it everywhere:
+    def new_consumer_auth_cp(self):
+        return self.consumer_auth_cp
+
     def get_basic_auth_cp(self):
         return self.basic_auth_cp
 
@@ -587,7 +594,22 @@ class StubCPProvider(object):
         return self.content_connection
 
 
+class StubCacheStats(CacheStats):
+    """ Keeps stats in memory only. """
+
+    def _read(self):
+        return {}
+
+    def _write(self, caches):
+        pass
+
+    def save(self):
+        pass
+
+
 class StubEntitlementStatusCache(EntitlementStatusCache):
+    # Never skip the server because of what is in /var/lib/rhsm:
+    TTL_OPTION = None
 
     def write_cache(self):
         pass
@@ -597,6 +619,8 @@ class StubEntitlementStatusCache(EntitlementStatusCache):
 
 
 class StubProductStatusCache(ProductStatusCache):
+    # Never skip the server because of what is in /var/lib/rhsm:
+    TTL_OPTION = None
 
     def write_cache(self):
         pass
@@ -606,6 +630,8 @@ class StubProductStatusCache(ProductStatusCache):
 
 
 class StubOverrideStatusCache(OverrideStatusCache):
+    # Never skip the server because of what is in /var/lib/rhsm:
+    TTL_OPTION = None
 
     def write_cache(self):
         pass
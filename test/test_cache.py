@@ -17,18 +17,21 @@ import random
 import shutil
 import socket
 import tempfile
-import threading
-from mock import Mock
+from iniparse.compat import NoOptionError
+from mock import Mock, patch
 
 # used to get a user readable cfg class for test cases
 from stubs import StubProduct, StubProductCertificate, StubCertificateDirectory, \
-        StubEntitlementCertificate, StubPool, StubEntitlementDirectory
+        StubEntitlementCertificate, StubPool, StubEntitlementDirectory, \
+        StubCacheStats
 from fixture import SubManFixture
 
 from rhsm import ourjson as json
-from subscription_manager.cache import ProfileManager, \
+from subscription_manager import cache
+from subscription_manager.cache import CacheManager, ProfileManager, \
         InstalledProductsManager, EntitlementStatusCache, \
-        PoolTypeCache
+        PoolTypeCache, CacheStats, CacheWriter, open_cache_file, \
+        write_cache_file
 import subscription_manager.injection as inj
 from rhsm.profile import Package, RPMProfile
 
@@ -45,9 +48,202 @@ class _FACT_MATCHER(object):
 FACT_MATCHER = _FACT_MATCHER()
 
 
+class TestCacheFile(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache_file = os.path.join(self.cache_dir, 'cache.json')
+        self.data = {'packages': [{'name': 'package%d' % i} for i in range(5000)]}
+
+    def _read(self):
+        f = open_cache_file(self.cache_file)
+        try:
+            return json.loads(f.read())
+        finally:
+            f.close()
+
+    def test_write_read(self):
+        write_cache_file(self.cache_file, self.data)
+        self.assertEquals(self.data, json.loads(open(self.cache_file).read()))
+        self.assertEquals(self.data, self._read())
+
+    def test_write_read_compressed(self):
+        write_cache_file(self.cache_file, self.data, compress=True)
+        self.assertEquals('\x1f\x8b', open(self.cache_file).read(2))
+        self.assertEquals(self.data, self._read())
+
+    def test_creates_directory(self):
+        self.cache_file = os.path.join(self.cache_dir, 'sub', 'cache.json')
+        write_cache_file(self.cache_file, self.data)
+        self.assertEquals(self.data, self._read())
+
+    def test_failed_write_keeps_old_cache(self):
+        write_cache_file(self.cache_file, self.data)
+        self.assertRaises(TypeError, write_cache_file, self.cache_file,
+                {'unserializable': object()})
+        self.assertEquals(self.data, self._read())
+        self.assertEquals(['cache.json'], os.listdir(self.cache_dir))
+
+    def test_read_compressed_cache(self):
+        status_cache = EntitlementStatusCache()
+        status_cache.CACHE_FILE = self.cache_file
+        write_cache_file(self.cache_file, self.data, compress=True)
+        self.assertEquals(self.data, status_cache._read_cache())
+
+
+class TestCacheStats(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.stats_file = os.path.join(self.cache_dir, 'cache_stats.json')
+
+        # Don't leave stats saves behind for when the tests exit:
+        atexit_patcher = patch('subscription_manager.cache.atexit')
+        self.mock_atexit = atexit_patcher.start()
+        self.addCleanup(atexit_patcher.stop)
+
+    def test_counts_added_up(self):
+        stats = CacheStats(self.stats_file)
+        stats.hit('facts')
+        stats.hit('facts')
+        stats.miss('facts')
+        stats.synced('facts', 0.5)
+        stats.save()
+
+        stats = CacheStats(self.stats_file)
+        stats.hit('facts')
+        stats.synced('facts', 1.5)
+        stats.wrote('facts', 1234)
+        self.assertEquals(3, stats.load()['facts']['hits'])
+        stats.save()
+
+        facts_stats = CacheStats(self.stats_file).load()['facts']
+        self.assertEquals(3, facts_stats['hits'])
+        self.assertEquals(1, facts_stats['misses'])
+        self.assertEquals(2, facts_stats['syncs'])
+        self.assertEquals(2.0, facts_stats['sync_time'])
+        self.assertEquals(1.5, facts_stats['last_sync_time'])
+        self.assertEquals(1234, facts_stats['size'])
+
+    def test_save_without_cache_dir(self):
+        stats = CacheStats(os.path.join(self.cache_dir, 'nodir', 'cache_stats.json'))
+        stats.hit('facts')
+        stats.save()
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'nodir')))
+
+    def test_corrupt_stats_ignored(self):
+        f = open(self.stats_file, 'w')
+        f.write('{"not": "really json')
+        f.close()
+        stats = CacheStats(self.stats_file)
+        stats.miss('facts')
+        stats.save()
+        self.assertEquals({'facts': {'misses': 1}},
+                CacheStats(self.stats_file).load())
+
+    def test_reset(self):
+        stats = CacheStats(self.stats_file)
+        stats.hit('facts')
+        stats.hit('packages')
+        stats.save()
+        stats.miss('facts')
+
+        stats.reset(['facts'])
+        self.assertEquals(['packages'], stats.load().keys())
+        stats.reset()
+        self.assertEquals({}, CacheStats(self.stats_file).load())
+
+    def test_saved_at_exit(self):
+        stats = CacheStats(self.stats_file)
+        stats.hit('facts')
+        stats.hit('facts')
+        self.mock_atexit.register.assert_called_once_with(stats.save)
+
+
+class TestCacheWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.writer = CacheWriter()
+
+        # Don't leave closing the writer behind for when the tests exit:
+        atexit_patcher = patch('subscription_manager.cache.atexit')
+        atexit_patcher.start()
+        self.addCleanup(atexit_patcher.stop)
+
+    def _status_cache(self, name, status):
+        status_cache = EntitlementStatusCache()
+        status_cache.CACHE_FILE = os.path.join(self.cache_dir, name)
+        status_cache.server_status = status
+        return status_cache
+
+    def _read(self, status_cache):
+        return json.loads(open(status_cache.CACHE_FILE).read())
+
+    def test_write(self):
+        status_cache = self._status_cache('status.json', {'a': '1'})
+        self.writer.write(status_cache)
+        self.writer.flush()
+        self.assertEquals({'a': '1'}, self._read(status_cache))
+        self.writer.close()
+
+    def test_latest_written_in_order(self):
+        written = []
+        self.writer._start = Mock()
+        first = self._status_cache('first.json', {'a': '1'})
+        second = self._status_cache('second.json', {'b': '1'})
+
+        self.writer.write(first)
+        self.writer.write(second)
+        first.server_status = {'a': '2'}
+        self.writer.write(first)
+        first.server_status = {'a': '3'}
+
+        with patch.object(CacheManager, 'write_cache') as mock_write:
+            mock_write.side_effect = lambda snapshot, debug: \
+                    written.append(snapshot.server_status)
+            self.writer.close()
+        self.assertEquals([{'a': '2'}, {'b': '1'}], written)
+
+    def test_discard(self):
+        self.writer._start = Mock()
+        status_cache = self._status_cache('status.json', {'a': '1'})
+        self.writer.write(status_cache)
+        self.writer.discard(status_cache.CACHE_FILE)
+        self.writer.close()
+        self.assertFalse(os.path.exists(status_cache.CACHE_FILE))
+
+    def test_one_thread(self):
+        self.writer.write(self._status_cache('status0.json', {'a': 0}))
+        thread = self.writer._thread
+        for i in range(1, 10):
+            self.writer.write(self._status_cache('status%d.json' % i, {'a': i}))
+            self.assertTrue(self.writer._thread is thread)
+        self.writer.close()
+        self.assertEquals(None, self.writer._thread)
+        for i in range(10):
+            self.assertEquals({'a': i}, self._read(
+                self._status_cache('status%d.json' % i, None)))
+
+    def test_write_after_close(self):
+        self.writer.close()
+        status_cache = self._status_cache('status.json', {'a': '1'})
+        self.writer.write(status_cache)
+        self.assertEquals({'a': '1'}, self._read(status_cache))
+
+
 class TestProfileManager(unittest.TestCase):
 
     def setUp(self):
+        self.cache_stats = StubCacheStats()
+        cache_stats_patcher = patch('subscription_manager.cache.cache_stats',
+                self.cache_stats)
+        cache_stats_patcher.start()
+        self.addCleanup(cache_stats_patcher.stop)
+
         current_pkgs = [
                 Package(name="package1", version="1.0.0", release=1, arch="x86_64"),
                 Package(name="package2", version="2.0.0", release=2, arch="x86_64")]
@@ -65,6 +261,7 @@ class TestProfileManager(unittest.TestCase):
 
         self.assertEquals(0, uep.updatePackageProfile.call_count)
         self.assertEquals(0, self.profile_mgr.write_cache.call_count)
+        self.assertEquals({'packages': {'hits': 1}}, self.cache_stats.load())
 
     def test_update_check_has_changed(self):
         uuid = 'FAKEUUID'
@@ -78,6 +275,9 @@ class TestProfileManager(unittest.TestCase):
         uep.updatePackageProfile.assert_called_with(uuid,
                 FACT_MATCHER)
         self.assertEquals(1, self.profile_mgr.write_cache.call_count)
+        packages_stats = self.cache_stats.load()['packages']
+        self.assertEquals(1, packages_stats['misses'])
+        self.assertEquals(1, packages_stats['syncs'])
 
     def test_update_check_packages_not_supported(self):
         uuid = 'FAKEUUID'
@@ -149,6 +349,107 @@ class TestProfileManager(unittest.TestCase):
         self.assertTrue(self.profile_mgr.has_changed())
         self.profile_mgr._read_cache.assert_called_with()
 
+    def test_update_check_records_upload(self):
+        self.profile_mgr._cache_exists = Mock(return_value=False)
+        self.profile_mgr.write_cache = Mock()
+        uep = Mock()
+
+        self.assertEquals(1, self.profile_mgr.update_check(uep, 'FAKEUUID'))
+
+        uep.updatePackageProfile.assert_called_with('FAKEUUID', FACT_MATCHER)
+        self.assertEquals(2, self.profile_mgr.last_upload['packages'])
+        self.assertTrue(self.profile_mgr.last_upload['time'] >= 0)
+
+    def _write_temp_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.profile_mgr.CACHE_FILE = os.path.join(cache_dir, 'profile.json')
+        self.profile_mgr.write_cache()
+
+    def test_has_changed_no_changes_digest(self):
+        self._write_temp_cache()
+        self.assertTrue(os.path.exists(self.profile_mgr._digest_path()))
+
+        # Same packages in a different order:
+        pkgs = [Package(name="package2", version="2.0.0", release=2, arch="x86_64"),
+                Package(name="package1", version="1.0.0", release=1, arch="x86_64")]
+        self.profile_mgr.current_profile = self._mock_pkg_profile(pkgs)
+        self.profile_mgr._read_cache = Mock()
+
+        self.assertFalse(self.profile_mgr.has_changed())
+        self.assertEquals(0, self.profile_mgr._read_cache.call_count)
+
+    def test_has_changed_digest(self):
+        self._write_temp_cache()
+
+        pkgs = [Package(name="package1", version="1.0.0", release=1, arch="x86_64"),
+                Package(name="package3", version="3.0.0", release=3, arch="x86_64")]
+        self.profile_mgr.current_profile = self._mock_pkg_profile(pkgs)
+        self.profile_mgr._read_cache = Mock()
+
+        self.assertTrue(self.profile_mgr.has_changed())
+        self.assertEquals(0, self.profile_mgr._read_cache.call_count)
+
+    def test_stale_digest_ignored(self):
+        self._write_temp_cache()
+        # Cache rewritten by something which doesn't know about digests:
+        f = open(self.profile_mgr.CACHE_FILE, 'w')
+        f.write(json.dumps([]))
+        f.close()
+
+        self.assertEquals(None, self.profile_mgr._read_digest())
+        self.assertTrue(self.profile_mgr.has_changed())
+
+    def _rpmdb_profile_mgr(self, cookie):
+        profile_mgr = ProfileManager()
+        profile_mgr.CACHE_FILE = self.profile_mgr.CACHE_FILE
+        profile_mgr._get_rpmdb_cookie = Mock(return_value=cookie)
+        profile_mgr._get_profile = Mock(return_value=self.current_profile)
+        return profile_mgr
+
+    def test_rpmdb_unchanged_skips_profile(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.profile_mgr.CACHE_FILE = os.path.join(cache_dir, 'profile.json')
+
+        writer = self._rpmdb_profile_mgr('cookie1')
+        self.assertTrue(writer.has_changed())
+        writer.write_cache()
+
+        reader = self._rpmdb_profile_mgr('cookie1')
+        reader._read_cache = Mock()
+        self.assertFalse(reader.has_changed())
+        self.assertEquals(0, reader._get_profile.call_count)
+        self.assertEquals(0, reader._read_cache.call_count)
+
+    def test_rpmdb_changed_reads_profile(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.profile_mgr.CACHE_FILE = os.path.join(cache_dir, 'profile.json')
+        self._rpmdb_profile_mgr('cookie1').write_cache()
+
+        reader = self._rpmdb_profile_mgr('cookie2')
+        # Same packages, so the digest still says nothing changed:
+        self.assertFalse(reader.has_changed())
+        self.assertEquals(1, reader._get_profile.call_count)
+
+    def test_rpmdb_cookie_ignored_for_given_profile(self):
+        self._write_temp_cache()
+        self.profile_mgr._get_rpmdb_cookie = Mock(return_value='cookie1')
+        self.assertFalse(self.profile_mgr._rpmdb_unchanged())
+        self.assertEquals(0, self.profile_mgr._get_rpmdb_cookie.call_count)
+
+    def test_delete_cache_removes_digest(self):
+        self._write_temp_cache()
+        digest_path = self.profile_mgr._digest_path()
+
+        class TempProfileManager(ProfileManager):
+            CACHE_FILE = self.profile_mgr.CACHE_FILE
+
+        TempProfileManager.delete_cache()
+        self.assertFalse(os.path.exists(self.profile_mgr.CACHE_FILE))
+        self.assertFalse(os.path.exists(digest_path))
+
     @staticmethod
     def _mock_pkg_profile(packages):
         """
@@ -300,6 +601,109 @@ class TestEntitlementStatusCache(SubManFixture):
         self.status_cache._cache_exists = Mock(return_value=False)
         self.assertEquals(None, self.status_cache.load_status(uep, "SOMEUUID"))
 
+    def _fresh_cache(self, cert_dirs_state='certs1'):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.status_cache.CACHE_FILE = os.path.join(cache_dir, 'status.json')
+        self.status_cache._get_ttl = Mock(return_value=60)
+        self.status_cache._cert_dirs_state = Mock(return_value=cert_dirs_state)
+
+        writer = EntitlementStatusCache()
+        writer.CACHE_FILE = self.status_cache.CACHE_FILE
+        writer._cert_dirs_state = Mock(return_value='certs1')
+        writer.server_status = {"a": "1"}
+        # Skip the background thread:
+        CacheManager.write_cache(writer)
+
+    def test_fresh_cache_skips_server(self):
+        self._fresh_cache()
+        uep = Mock()
+        self.assertEquals({"a": "1"}, self.status_cache.load_status(uep, "SOMEUUID"))
+        self.assertEquals(0, uep.getCompliance.call_count)
+        self.assertFalse(self.status_cache.last_error)
+
+    def test_expired_cache_uses_server(self):
+        self._fresh_cache()
+        os.utime(self.status_cache.CACHE_FILE, (0, 0))
+        uep = Mock()
+        uep.getCompliance = Mock(return_value={"a": "2"})
+        self.assertEquals({"a": "2"}, self.status_cache.load_status(uep, "SOMEUUID"))
+        self.assertEquals(1, uep.getCompliance.call_count)
+
+    def test_cert_change_invalidates_cache(self):
+        self._fresh_cache(cert_dirs_state='certs2')
+        uep = Mock()
+        uep.getCompliance = Mock(return_value={"a": "2"})
+        self.assertEquals({"a": "2"}, self.status_cache.load_status(uep, "SOMEUUID"))
+        self.assertEquals(1, uep.getCompliance.call_count)
+
+    def test_ttl_disabled(self):
+        self._fresh_cache()
+        self.status_cache._get_ttl = Mock(return_value=0)
+        uep = Mock()
+        self.status_cache.load_status(uep, "SOMEUUID")
+        self.assertEquals(1, uep.getCompliance.call_count)
+
+    @patch('subscription_manager.cache.cfg')
+    def test_ttl_missing_option(self, mock_cfg):
+        mock_cfg.get_int.side_effect = NoOptionError('entitlement_status_ttl',
+                'rhsm')
+        self.assertEquals(0, EntitlementStatusCache()._get_ttl())
+
+    def _conditional_get(self, response, validators=None):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.status_cache.CACHE_FILE = os.path.join(cache_dir, 'status.json')
+        self.status_cache._get_ttl = Mock(return_value=0)
+        if validators:
+            writer = EntitlementStatusCache()
+            writer.CACHE_FILE = self.status_cache.CACHE_FILE
+            writer.server_status = {"a": "1"}
+            writer._validators = validators
+            CacheManager.write_cache(writer)
+
+        uep = Mock()
+        uep.sanitize = Mock(side_effect=lambda x: x)
+        supported_patcher = patch('subscription_manager.cache._supports_conditional_get')
+        supported_patcher.start().return_value = True
+        self.addCleanup(supported_patcher.stop)
+        request_patcher = patch('rhsm.connection.BaseRestLib._request')
+        mock_request = request_patcher.start()
+        self.addCleanup(request_patcher.stop)
+        mock_request.return_value = response
+
+        status = self.status_cache.load_status(uep, "SOMEUUID")
+        self.assertEquals(0, uep.getCompliance.call_count)
+        (conn, request_type, method), kwargs = mock_request.call_args
+        self.assertEquals('/consumers/SOMEUUID/compliance', method)
+        return status, kwargs['headers']
+
+    def test_conditional_get_not_modified(self):
+        status, headers = self._conditional_get(
+                {'status': 304, 'content': '', 'headers': {}},
+                validators={'etag': '"abc"'})
+        self.assertEquals({'If-None-Match': '"abc"'}, headers)
+        self.assertEquals({"a": "1"}, status)
+        self.assertEquals({'etag': '"abc"'}, self.status_cache._validators)
+
+    def test_conditional_get_modified(self):
+        status, headers = self._conditional_get(
+                {'status': 200, 'content': '{"a": "2"}',
+                 'headers': {'etag': '"def"', 'date': 'now'}},
+                validators={'etag': '"abc"',
+                            'last-modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEquals({'If-None-Match': '"abc"',
+                           'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+                          headers)
+        self.assertEquals({"a": "2"}, status)
+        self.assertEquals({'etag': '"def"'}, self.status_cache._validators)
+
+    def test_conditional_get_without_cache(self):
+        status, headers = self._conditional_get(
+                {'status': 200, 'content': '{"a": "2"}', 'headers': {}})
+        self.assertEquals({}, headers)
+        self.assertEquals({"a": "2"}, status)
+
     def test_write_cache(self):
         mock_server_status = {'fake server status': random.uniform(1, 2 ** 32)}
         status_cache = EntitlementStatusCache()
@@ -309,15 +713,7 @@ class TestEntitlementStatusCache(SubManFixture):
         status_cache.CACHE_FILE = cache_file
         status_cache.write_cache()
 
-        def threadActive(name):
-            for thread in threading.enumerate():
-                if thread.getName() == name:
-                    return True
-            return False
-
-        # If the file exists, and the thread that writes it does not, we know writing has completed
-        while not (os.path.exists(cache_file) and not threadActive("WriteCacheEntitlementStatusCache")):
-            pass
+        cache.cache_writer.flush(cache_file)
         try:
             new_status_buf = open(cache_file).read()
             new_status = json.loads(new_status_buf)
@@ -341,6 +737,13 @@ class TestPoolTypeCache(SubManFixture):
         certs = [StubEntitlementCertificate(StubProduct('pid1'), pool=StubPool('someid'))]
         self.ent_dir = StubEntitlementDirectory(certificates=certs)
 
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_file_patcher = patch.object(PoolTypeCache, 'CACHE_FILE',
+                os.path.join(cache_dir, 'pool_types.json'))
+        cache_file_patcher.start()
+        self.addCleanup(cache_file_patcher.stop)
+
     def test_empty_cache(self):
         pooltype_cache = PoolTypeCache()
         result = pooltype_cache.get("some id")
@@ -397,6 +800,47 @@ class TestPoolTypeCache(SubManFixture):
             expected_id = 'poolid' + str(i)
             self.assertEquals('some type', pooltype_cache.get(expected_id))
 
+    def test_persisted(self):
+        inj.provide(inj.ENT_DIR, self.ent_dir)
+        self.cp.getEntitlementList.return_value = [
+                self._build_ent_json('someid', 'some type'),
+                self._build_ent_json('poolid2', 'some other type')]
+        PoolTypeCache()
+        self.assertEquals(1, self.cp.getEntitlementList.call_count)
+
+        # Only attached pools are kept:
+        self.assertEquals({'someid': 'some type'},
+                json.loads(open(PoolTypeCache.CACHE_FILE).read()))
+
+        pooltype_cache = PoolTypeCache()
+        self.assertEquals('some type', pooltype_cache.get('someid'))
+        self.assertEquals(1, self.cp.getEntitlementList.call_count)
+
+    def test_update_missing_pools_only(self):
+        pooltype_cache = PoolTypeCache()
+        pooltype_cache.pooltype_map['otherid'] = 'some type'
+        pooltype_cache.ent_dir = self.ent_dir
+        self.cp.getPool.return_value = self._build_pool_json('someid', 'some other type')
+
+        pooltype_cache.update()
+
+        self.cp.getPool.assert_called_once_with('someid', inj.require(inj.IDENTITY).uuid)
+        self.assertEquals(0, self.cp.getEntitlementList.call_count)
+        self.assertEquals('some other type', pooltype_cache.get('someid'))
+
+    def test_update_many_missing_pools(self):
+        certs = [StubEntitlementCertificate(StubProduct('pid1'), pool=StubPool('poolid%d' % i))
+                for i in range(PoolTypeCache.MAX_POOL_FETCHES + 1)]
+        pooltype_cache = PoolTypeCache()
+        pooltype_cache.pooltype_map['otherid'] = 'some type'
+        pooltype_cache.ent_dir = StubEntitlementDirectory(certificates=certs)
+        self.cp.getEntitlementList.return_value = []
+
+        pooltype_cache.update()
+
+        self.assertEquals(0, self.cp.getPool.call_count)
+        self.assertEquals(1, self.cp.getEntitlementList.call_count)
+
     def test_requires_update_ents_with_no_pool(self):
         pooltype_cache = PoolTypeCache()
         pooltype_cache.ent_dir = self.ent_dir
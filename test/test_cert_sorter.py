@@ -243,6 +243,20 @@ class CertSorterTests(SubManFixture):
         self.sorter.system_status = 'partial'
         self.assertEquals('Insufficient', self.sorter.get_system_status())
 
+    def test_files_changed_refreshes_changed_dirs(self):
+        self.ent_dir.refresh = Mock()
+        self.prod_dir.refresh = Mock()
+        self.sorter.identity.reload = Mock()
+        callback = Mock()
+        self.sorter.add_callback(callback)
+
+        self.sorter.cert_monitor.emit('files-changed', None,
+                set(['1.pem']), None)
+        self.ent_dir.refresh.assert_called_with(set(['1.pem']))
+        self.assertFalse(self.prod_dir.refresh.called)
+        self.assertFalse(self.sorter.identity.reload.called)
+        self.assertTrue(callback.called)
+
 SAMPLE_COMPLIANCE_JSON = json.loads("""
 {
   "date" : "2013-04-26T13:43:12.436+0000",
@@ -13,15 +13,24 @@
 # in this software or its documentation.
 #
 
-import unittest
+from datetime import datetime, timedelta
 import os
+import shutil
+import tempfile
+import unittest
 
 from mock import patch
 
+from rhsm.certificate import Key, create_from_pem
+from rhsm.certificate2 import Pool
+
+import certdata
 from stubs import StubProduct, StubEntitlementCertificate, \
-    StubProductCertificate
+    StubProductCertificate, StubEntitlementDirectory, StubProductDirectory, \
+    StubContent
 from subscription_manager.certdirectory import Path, EntitlementDirectory, \
-    ProductDirectory
+    ProductDirectory, EntitlementSummary, ProductSummary, Writer
+from subscription_manager import injection as inj
 from subscription_manager.repolib import RepoFile
 from subscription_manager.productid import ProductDatabase
 
@@ -126,3 +135,285 @@ class ProductDirectoryTest(unittest.TestCase):
         pd.list = lambda: [StubProductCertificate(top_product, provided_products)]
         installed_products = pd.get_installed_products()
         self.assertTrue("top" in installed_products)
+
+
+class EntitlementDirectoryLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stacked_1 = StubEntitlementCertificate('product1',
+                stacking_id='stack1', pool=Pool('pool1'))
+        self.stacked_2 = StubEntitlementCertificate('product2',
+                stacking_id='stack1', pool=Pool('pool2'))
+        self.unstacked = StubEntitlementCertificate('product3',
+                provided_products=['product1'], pool=Pool('pool1'))
+        self.ent_dir = StubEntitlementDirectory([self.stacked_1,
+            self.stacked_2, self.unstacked])
+
+    def test_find(self):
+        self.assertEquals(self.stacked_2, self.ent_dir.find(self.stacked_2.serial))
+        self.assertEquals(None, self.ent_dir.find(1))
+
+    def test_find_by_product(self):
+        self.assertEquals(self.stacked_1, self.ent_dir.find_by_product('product1'))
+        self.assertEquals(self.unstacked, self.ent_dir.find_by_product('product3'))
+        self.assertEquals(None, self.ent_dir.find_by_product('product4'))
+
+    def test_list_for_product(self):
+        self.assertEquals([self.stacked_1, self.unstacked],
+                self.ent_dir.list_for_product('product1'))
+        self.assertEquals([], self.ent_dir.list_for_product('product4'))
+
+    def test_find_all_by_product_includes_stack(self):
+        certs = self.ent_dir.find_all_by_product('product1')
+        self.assertEquals(3, len(certs))
+        certs = self.ent_dir.find_all_by_product('product3')
+        self.assertEquals([self.unstacked], certs)
+
+    def test_pool_ids(self):
+        self.assertEquals(set(['pool1', 'pool2']),
+                set(self.ent_dir.list_pool_ids()))
+        self.assertEquals([self.stacked_1, self.unstacked],
+                self.ent_dir.find_by_pool_id('pool1'))
+
+    def test_lookup_follows_listing(self):
+        self.ent_dir.find('1')
+        added = StubEntitlementCertificate('product4')
+        self.ent_dir.certs.append(added)
+        self.assertEquals(added, self.ent_dir.find_by_product('product4'))
+
+    @patch('os.path.exists')
+    def test_refresh_drops_lookup(self, MockExists):
+        MockExists.return_value = True
+        ent_dir = EntitlementDirectory()
+        ent_dir._listing = [self.stacked_1]
+        self.assertEquals(self.stacked_1, ent_dir.find(self.stacked_1.serial))
+        ent_dir.refresh()
+        ent_dir._listing = [self.stacked_2]
+        self.assertEquals(None, ent_dir.find(self.stacked_1.serial))
+        self.assertEquals(self.stacked_2, ent_dir.find(self.stacked_2.serial))
+
+
+class CertificateSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ent_cert = StubEntitlementCertificate('product1',
+                provided_products=['product2'], stacking_id='stack1',
+                pool=Pool('pool1'),
+                content=[StubContent('content1'), StubContent('content2')])
+        self.expired_cert = StubEntitlementCertificate('product3',
+                start_date=datetime.now() - timedelta(days=400),
+                end_date=datetime.now() - timedelta(days=1))
+        self.prod_cert = StubProductCertificate(StubProduct('product1',
+            version='6.5', provided_tags='rhel-6'))
+
+    def test_entitlement_summary(self):
+        ent_dir = StubEntitlementDirectory([self.ent_cert, self.expired_cert])
+        summary, expired = ent_dir.list_summaries()
+        self.assertTrue(isinstance(summary, EntitlementSummary))
+        self.assertEquals(self.ent_cert.serial, summary.serial)
+        self.assertEquals(('product1', 'product2'), summary.product_ids)
+        self.assertEquals(('content1', 'content2'), summary.content_labels)
+        self.assertEquals('stack1', summary.stacking_id)
+        self.assertEquals('pool1', summary.pool_id)
+        self.assertEquals(self.ent_cert.valid_range.end(), summary.end)
+        self.assertTrue(summary.is_valid())
+        self.assertFalse(summary.is_expired())
+        self.assertFalse(expired.is_valid())
+        self.assertTrue(expired.is_expired())
+
+    def test_product_summary(self):
+        prod_dir = StubProductDirectory([self.prod_cert])
+        summary = prod_dir.list_summaries()[0]
+        self.assertTrue(isinstance(summary, ProductSummary))
+        self.assertEquals('product1', summary.id)
+        self.assertEquals(('product1',), summary.product_ids)
+        self.assertEquals('6.5', summary.version)
+        self.assertEquals(('rhel-6',), summary.provided_tags)
+
+    def test_summaries_have_no_dict(self):
+        summary = EntitlementSummary(self.ent_cert)
+        self.assertFalse(hasattr(summary, '__dict__'))
+
+
+class TempEntitlementDirectoryTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.archive_dir = tempfile.mkdtemp()
+        path = self.temp_dir
+        archive_path = self.archive_dir
+
+        class TempEntitlementDirectory(EntitlementDirectory):
+            PATH = path
+            ARCHIVE_PATH = archive_path
+            INDEX_FILE = None
+
+        self.ent_dir = TempEntitlementDirectory()
+        self.ent_dir.list()
+        inj.provide(inj.ENT_DIR, self.ent_dir)
+        self.certs = [create_from_pem(certdata.ENTITLEMENT_CERT_V1_0),
+                create_from_pem(certdata.ENTITLEMENT_CERT_V3_0)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        shutil.rmtree(self.archive_dir)
+
+    def _pems(self):
+        return sorted([f for f in os.listdir(self.temp_dir) if f.endswith('.pem')])
+
+
+class WriterTest(TempEntitlementDirectoryTestBase):
+
+    def test_batch_written_on_commit(self):
+        writer = Writer()
+        writer.begin()
+        for cert in self.certs:
+            writer.write(Key("key"), cert)
+        self.assertEquals([], self._pems())
+        self.assertEquals([], self.ent_dir.list())
+
+        writer.commit()
+        expected = []
+        for cert in self.certs:
+            expected += ['%s-key.pem' % cert.serial, '%s.pem' % cert.serial]
+        self.assertEquals(sorted(expected), self._pems())
+        self.assertEquals(set(self.certs), set(self.ent_dir.list()))
+        self.assertEquals(os.path.join(self.temp_dir, '%s.pem' % self.certs[0].serial),
+                self.certs[0].path)
+        # Nothing staged is left behind:
+        self.assertEquals(sorted(expected), sorted(os.listdir(self.temp_dir)))
+
+    def test_abort(self):
+        writer = Writer()
+        writer.begin()
+        writer.write(Key("key"), self.certs[0])
+        writer.abort()
+        self.assertEquals([], os.listdir(self.temp_dir))
+
+    def test_write_outside_batch(self):
+        Writer().write(Key("key"), self.certs[0])
+        self.assertEquals(2, len(self._pems()))
+        self.assertEquals([self.certs[0]], self.ent_dir.list())
+
+    def test_stale_stage_dirs_removed(self):
+        stale = os.path.join(self.temp_dir, '.staging-99999999-abc')
+        ours = os.path.join(self.temp_dir, '.staging-%d-def' % os.getpid())
+        os.mkdir(stale)
+        os.mkdir(ours)
+        Writer().begin()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(ours))
+
+    def test_partial_commit(self):
+        writer = Writer()
+        writer.begin()
+        for cert in self.certs:
+            writer.write(Key("key"), cert)
+
+        renames = []
+
+        def rename(src, dst):
+            if len(renames) == 3:
+                raise OSError("Disk full")
+            renames.append(dst)
+            os_rename(src, dst)
+        os_rename = os.rename
+        rename_patcher = patch('os.rename', side_effect=rename)
+        rename_patcher.start()
+        try:
+            self.assertRaises(OSError, writer.commit)
+        finally:
+            rename_patcher.stop()
+        self.assertEquals([self.certs[0]], writer.landed())
+        self.assertEquals([self.certs[0]], self.ent_dir.list())
+        writer.abort()
+
+    def test_write_under_root(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.makedirs(os.path.join(root, 'entitlement'))
+
+        class RootEntitlementDirectory(EntitlementDirectory):
+            PATH = '/entitlement'
+            INDEX_FILE = None
+
+        root_patcher = patch.object(Path, 'ROOT', root)
+        root_patcher.start()
+        self.addCleanup(root_patcher.stop)
+        inj.provide(inj.ENT_DIR, RootEntitlementDirectory())
+
+        Writer().write(Key("key"), self.certs[0])
+        self.assertEquals(sorted(['%s.pem' % self.certs[0].serial,
+            '%s-key.pem' % self.certs[0].serial]),
+            sorted(os.listdir(os.path.join(root, 'entitlement'))))
+
+
+class ArchiveTest(TempEntitlementDirectoryTestBase):
+
+    def test_archive(self):
+        writer = Writer()
+        writer.begin()
+        for cert in self.certs:
+            writer.write(Key("key"), cert)
+        writer.commit()
+
+        archived = self.ent_dir.archive([self.certs[0]])
+        self.assertEquals([self.certs[0]], archived)
+        self.assertEquals([self.certs[1]], self.ent_dir.list())
+        self.assertEquals(None, self.ent_dir.find(self.certs[0].serial))
+        self.assertEquals(2, len(self._pems()))
+        self.assertEquals(sorted(['%s.pem' % self.certs[0].serial,
+            '%s-key.pem' % self.certs[0].serial]),
+            sorted(os.listdir(self.archive_dir)))
+        self.assertEquals([self.certs[0].serial],
+                self.ent_dir.list_archived_serials())
+        self.assertTrue(self.ent_dir.is_archived(self.certs[0].serial))
+        self.assertFalse(self.ent_dir.is_archived(self.certs[1].serial))
+
+    def test_archive_rotated(self):
+        self.ent_dir.ARCHIVE_MAX = 1
+        # An older archived cert, which should be rotated out:
+        for fn in ('1.pem', '1-key.pem'):
+            open(os.path.join(self.archive_dir, fn), 'w').close()
+            os.utime(os.path.join(self.archive_dir, fn), (1000, 1000))
+        writer = Writer()
+        writer.begin()
+        writer.write(Key("key"), self.certs[0])
+        writer.commit()
+
+        self.ent_dir.archive([self.certs[0]])
+        self.assertEquals(sorted(['%s.pem' % self.certs[0].serial,
+            '%s-key.pem' % self.certs[0].serial]),
+            sorted(os.listdir(self.archive_dir)))
+
+
+class RefreshFilesTest(TempEntitlementDirectoryTestBase):
+
+    def _write(self, name, pem):
+        f = open(os.path.join(self.temp_dir, name), 'w')
+        f.write(pem)
+        f.close()
+
+    def test_refresh_named_files(self):
+        self._write('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        self.ent_dir.refresh()
+        first = self.ent_dir.list()
+        self.assertEquals(1, len(first))
+
+        self._write('2.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        self.ent_dir.refresh(['2.pem', '2-key.pem'])
+        listing = self.ent_dir.list()
+        self.assertEquals(2, len(listing))
+        # The cert which didn't change is not loaded again:
+        self.assertTrue(first[0] is listing[0])
+
+        os.unlink(os.path.join(self.temp_dir, '1.pem'))
+        self.ent_dir.refresh(['1.pem'])
+        self.assertEquals([listing[1]], self.ent_dir.list())
+        self.assertEquals(None, self.ent_dir.find(listing[0].serial))
+
+    @patch('os.listdir')
+    def test_refresh_named_files_skips_listing(self, mock_listdir):
+        self.ent_dir.refresh(['1.pem'])
+        self.ent_dir.list()
+        self.assertFalse(mock_listdir.called)
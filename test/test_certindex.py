@@ -0,0 +1,399 @@
+#
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+import certdata
+from rhsm.certificate import create_from_file, CertificateException
+from subscription_manager import certindex
+from subscription_manager.certdirectory import CertificateDirectory, \
+        EntitlementDirectory, EntitlementSummary
+from subscription_manager.certindex import CertificateIndex
+
+
+class CertificateIndexTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.temp_dir, 'cache', 'index.json')
+        self.ent_path = self._write_pem('1.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        self.prod_path = self._write_pem('2.pem', certdata.PRODUCT_CERT_V1_0)
+
+        parse_patcher = patch('subscription_manager.certindex.create_from_file',
+                wraps=create_from_file)
+        self.mock_parse = parse_patcher.start()
+        self.addCleanup(parse_patcher.stop)
+
+        # Don't leave index saves behind for when the tests exit:
+        atexit_patcher = patch('subscription_manager.certindex.atexit')
+        atexit_patcher.start()
+        self.addCleanup(atexit_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_pem(self, name, pem):
+        path = os.path.join(self.temp_dir, name)
+        f = open(path, 'w')
+        f.write(pem)
+        f.close()
+        return path
+
+
+class CertificateIndexTests(CertificateIndexTestBase):
+
+    def _load_all(self):
+        index = CertificateIndex(self.index_path)
+        certs = [index.load_cert(self.ent_path), index.load_cert(self.prod_path)]
+        index.save()
+        return certs
+
+    def test_second_load_uses_index(self):
+        parsed = self._load_all()
+        self.assertEquals(2, self.mock_parse.call_count)
+
+        indexed = self._load_all()
+        self.assertEquals(2, self.mock_parse.call_count)
+
+        for (orig, cached) in zip(parsed, indexed):
+            self.assertEquals(orig.serial, cached.serial)
+            self.assertEquals(orig.valid_range.begin(), cached.valid_range.begin())
+            self.assertEquals(orig.valid_range.end(), cached.valid_range.end())
+            self.assertEquals(orig.subject, cached.subject)
+            self.assertEquals(orig.path, cached.path)
+            self.assertEquals([p.id for p in orig.products],
+                    [p.id for p in cached.products])
+
+    def test_entitlement_fields(self):
+        orig = self._load_all()[0]
+        cached = self._load_all()[0]
+        self.assertTrue(isinstance(cached, certindex.LazyEntitlementCertificate))
+        self.assertEquals(orig.order.name, cached.order.name)
+        self.assertEquals(orig.order.stacking_id, cached.order.stacking_id)
+        self.assertEquals(orig.order.quantity_used, cached.order.quantity_used)
+        self.assertEquals([c.label for c in orig.content],
+                [c.label for c in cached.content])
+        self.assertEquals([c.enabled for c in orig.content],
+                [c.enabled for c in cached.content])
+        self.assertEquals(orig.pool, cached.pool)
+
+    def test_raw_data_loaded_on_demand(self):
+        self._load_all()
+        cached = self._load_all()[0]
+        self.assertEquals(2, self.mock_parse.call_count)
+        self.assertTrue(cached.pem is not None)
+        self.assertEquals(3, self.mock_parse.call_count)
+
+    def test_modified_cert_reparsed(self):
+        self._load_all()
+        self._write_pem('2.pem', certdata.PRODUCT_CERT_WITH_OS_NAME_V1_0)
+        os.utime(self.prod_path, (0, 0))
+        certs = self._load_all()
+        self.assertEquals(3, self.mock_parse.call_count)
+        self.assertEquals('37060', certs[1].products[0].id)
+
+    def test_corrupt_index_rebuilt(self):
+        self._load_all()
+        f = open(self.index_path, 'w')
+        f.write('{"not": "really json')
+        f.close()
+        self._load_all()
+        self.assertEquals(4, self.mock_parse.call_count)
+        self._load_all()
+        self.assertEquals(4, self.mock_parse.call_count)
+
+    def test_outdated_index_rebuilt(self):
+        os.makedirs(os.path.dirname(self.index_path))
+        f = open(self.index_path, 'w')
+        f.write('{"version": 1, "certs": {}}')
+        f.close()
+        self._load_all()
+        self.assertEquals(2, self.mock_parse.call_count)
+        self._load_all()
+        self.assertEquals(2, self.mock_parse.call_count)
+
+    def test_save_bumps_generation(self):
+        index = CertificateIndex(self.index_path)
+        index.load_cert(self.ent_path)
+        index.save()
+        self.assertEquals(1, index.generation)
+        index.load_cert(self.prod_path)
+        index.save()
+        self.assertEquals(2, index.generation)
+        self.assertEquals(2, CertificateIndex(self.index_path)._read_generation())
+
+    def test_refresh_picks_up_other_process(self):
+        reader = CertificateIndex(self.index_path)
+        self.assertEquals(None, reader.lookup(self.prod_path))
+
+        writer = CertificateIndex(self.index_path)
+        writer.load_cert(self.prod_path)
+        writer.save()
+
+        self.assertEquals(None, reader.lookup(self.prod_path))
+        reader.refresh()
+        self.assertEquals('100000000000002',
+                reader.lookup(self.prod_path).products[0].id)
+        self.assertEquals(1, self.mock_parse.call_count)
+
+    def test_save_keeps_other_process_changes(self):
+        first = CertificateIndex(self.index_path)
+        first.load_cert(self.ent_path)
+
+        second = CertificateIndex(self.index_path)
+        second.load_cert(self.prod_path)
+        second.save()
+        first.save()
+        self.assertEquals(2, first.generation)
+
+        self._load_all()
+        self.assertEquals(2, self.mock_parse.call_count)
+
+    def test_save_waits_for_lock(self):
+        index = CertificateIndex(self.index_path)
+        index.load_cert(self.ent_path)
+
+        # Another process in the middle of saving:
+        os.makedirs(os.path.dirname(self.index_path))
+        lock_file = open(self.index_path + ".lock", "a")
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        saver = threading.Thread(target=index.save)
+        saver.start()
+        saver.join(0.2)
+        self.assertTrue(saver.isAlive())
+        self.assertFalse(os.path.exists(self.index_path))
+
+        lock_file.close()
+        saver.join()
+        self.assertEquals(1, CertificateIndex(self.index_path)._read_generation())
+
+    def test_retain_drops_removed(self):
+        self._load_all()
+        index = CertificateIndex(self.index_path)
+        index.retain([self.ent_path])
+        index.save()
+        index = CertificateIndex(self.index_path)
+        index.load_cert(self.prod_path)
+        self.assertEquals(3, self.mock_parse.call_count)
+
+
+class LazyCertificateTests(CertificateIndexTestBase):
+
+    def test_cheap_fields_without_decoding(self):
+        index = CertificateIndex(self.index_path)
+        cert = index.load_cert(self.ent_path, certindex.ENTITLEMENT)
+        full = create_from_file(self.ent_path)
+        self.mock_parse.reset_mock()
+
+        self.assertEquals(full.serial, cert.serial)
+        self.assertEquals(full.valid_range.begin(), cert.valid_range.begin())
+        self.assertEquals(full.valid_range.end(), cert.valid_range.end())
+        self.assertEquals(full.subject, cert.subject)
+        self.assertEquals(full.is_valid(), cert.is_valid())
+        self.assertEquals(full.is_expired(), cert.is_expired())
+        self.assertFalse(cert.is_decoded())
+        self.assertEquals(0, self.mock_parse.call_count)
+
+    def test_decoded_on_first_use(self):
+        index = CertificateIndex(self.index_path)
+        cert = index.load_cert(self.ent_path, certindex.ENTITLEMENT)
+        self.assertEquals(0, self.mock_parse.call_count)
+
+        self.assertEquals('100000000000002', cert.products[0].id)
+        self.assertEquals(1, self.mock_parse.call_count)
+        self.assertTrue(cert.order is not None)
+        self.assertTrue(len(cert.content) > 0)
+        self.assertEquals("3.0", str(cert.version))
+        self.assertEquals(1, self.mock_parse.call_count)
+
+    def test_partial_record_completed(self):
+        index = CertificateIndex(self.index_path)
+        index.load_cert(self.prod_path, certindex.PRODUCT)
+        index.save()
+
+        index = CertificateIndex(self.index_path)
+        cert = index.load_cert(self.prod_path, certindex.PRODUCT)
+        self.assertFalse(cert.is_decoded())
+        cert.products
+        index.save()
+        self.assertEquals(1, self.mock_parse.call_count)
+
+        index = CertificateIndex(self.index_path)
+        cert = index.load_cert(self.prod_path, certindex.PRODUCT)
+        self.assertTrue(cert.is_decoded())
+        self.assertEquals('100000000000002', cert.products[0].id)
+        self.assertEquals(1, self.mock_parse.call_count)
+
+
+class IndexedCertificateDirectoryTests(CertificateIndexTestBase):
+
+    def _directory(self):
+        index_file = self.index_path
+
+        class IndexedDirectory(CertificateDirectory):
+            INDEX_FILE = index_file
+
+        return IndexedDirectory(self.temp_dir)
+
+    def test_list_uses_index(self):
+        self.assertEquals(2, len(self._directory().list()))
+        self.assertEquals(2, self.mock_parse.call_count)
+
+        cert_dir = self._directory()
+        self.assertEquals(2, len(cert_dir.list()))
+        self.assertEquals(2, self.mock_parse.call_count)
+
+    def test_lazy_list(self):
+        index_file = self.index_path
+
+        class EntDirectory(CertificateDirectory):
+            INDEX_FILE = index_file
+            CERT_TYPE = certindex.ENTITLEMENT
+
+        serials = [c.serial for c in EntDirectory(self.temp_dir).list()]
+        self.assertEquals(2, len(serials))
+        self.assertEquals(0, self.mock_parse.call_count)
+
+    def test_list_drops_removed_certs(self):
+        self._directory().list()
+        os.unlink(self.prod_path)
+        self.assertEquals([self.ent_path],
+                [c.path for c in self._directory().list()])
+        self._write_pem('2.pem', certdata.PRODUCT_CERT_V1_0)
+        self._directory().list()
+        self.assertEquals(3, self.mock_parse.call_count)
+
+    def test_refresh_only_loads_changes(self):
+        cert_dir = self._directory()
+        ent_cert, prod_cert = sorted(cert_dir.list(), key=lambda c: c.path)
+        self.mock_parse.reset_mock()
+
+        self._write_pem('2.pem', certdata.PRODUCT_CERT_WITH_OS_NAME_V1_0)
+        os.utime(self.prod_path, (0, 0))
+        self._write_pem('3.pem', certdata.PRODUCT_CERT_V1_0)
+        cert_dir.refresh()
+        listing = sorted(cert_dir.list(), key=lambda c: c.path)
+
+        self.assertEquals(3, len(listing))
+        self.assertTrue(listing[0] is ent_cert)
+        self.assertFalse(listing[1] is prod_cert)
+        self.assertEquals('37060', listing[1].products[0].id)
+        self.assertEquals(2, self.mock_parse.call_count)
+
+        os.unlink(self.ent_path)
+        cert_dir.refresh()
+        self.assertEquals(2, len(cert_dir.list()))
+        self.assertEquals(None, cert_dir.find(ent_cert.serial))
+
+    def test_add_cert(self):
+        cert_dir = self._directory()
+        cert_dir.list()
+        path = self._write_pem('3.pem', certdata.PRODUCT_CERT_WITH_OS_NAME_V1_0)
+        cert = create_from_file(path)
+        self.mock_parse.reset_mock()
+
+        cert_dir.add_cert(cert)
+        self.assertTrue(cert_dir.find_by_product('37060') is cert)
+        cert_dir.refresh()
+        self.assertTrue(cert_dir.find_by_product('37060') is cert)
+        self.assertEquals(0, self.mock_parse.call_count)
+
+    def test_summaries_leave_certs_undecoded(self):
+        index_file = self.index_path
+        path = self.temp_dir
+
+        class EntDirectory(EntitlementDirectory):
+            PATH = path
+            INDEX_FILE = index_file
+
+        ent_dir = EntDirectory()
+        os.unlink(self.prod_path)
+        summary = ent_dir.list_summaries()[0]
+        self.assertTrue(isinstance(summary, EntitlementSummary))
+        self.assertEquals('100000000000002', summary.product_ids[0])
+        self.assertFalse(ent_dir.list()[0].is_decoded())
+        self.assertEquals(1, self.mock_parse.call_count)
+
+        # The completed record is used from then on:
+        ent_dir._index.save()
+        self.assertEquals(summary.product_ids,
+                EntDirectory().list_summaries()[0].product_ids)
+        self.assertEquals(1, self.mock_parse.call_count)
+
+    def test_lookups_leave_certs_undecoded(self):
+        index_file = self.index_path
+        path = self.temp_dir
+
+        class EntDirectory(EntitlementDirectory):
+            PATH = path
+            INDEX_FILE = index_file
+
+        ent_dir = EntDirectory()
+        os.unlink(self.prod_path)
+        cert = ent_dir.list()[0]
+        self.assertEquals([cert], ent_dir.list_for_product('100000000000002'))
+        self.assertEquals([cert], ent_dir.find_all_by_product('100000000000002'))
+        ent_dir.list_pool_ids()
+        self.assertFalse(cert.is_decoded())
+
+    def test_parallel_parse(self):
+        # The workers get a copy of the patched parser, so calls made there
+        # never show up here:
+        patcher = patch('subscription_manager.certdirectory._parallel_parse_threshold')
+        patcher.start().return_value = 2
+        self.addCleanup(patcher.stop)
+
+        listing = sorted(self._directory().list(), key=lambda c: c.path)
+        self.assertEquals(0, self.mock_parse.call_count)
+        self.assertTrue(listing[0].is_decoded())
+        self.assertEquals('100000000000002', listing[1].products[0].id)
+        self.assertEquals(0, self.mock_parse.call_count)
+
+        listing = self._directory().list()
+        self.assertEquals(2, len(listing))
+        self.assertEquals(0, self.mock_parse.call_count)
+
+    @patch('subscription_manager.certdirectory.parse_records')
+    def test_parallel_parse_error(self, mock_parse_records):
+        patcher = patch('subscription_manager.certdirectory._parallel_parse_threshold')
+        patcher.start().return_value = 2
+        self.addCleanup(patcher.stop)
+        mock_parse_records.side_effect = CertificateException("bad")
+
+        self.assertEquals(2, len(self._directory().list()))
+
+    def test_parse_records(self):
+        records = certindex.parse_records([self.prod_path, self.ent_path],
+                processes=2)
+        self.assertEquals([certindex.PRODUCT, certindex.ENTITLEMENT],
+                [r['type'] for r in records])
+
+    def test_parse_records_partial(self):
+        records = certindex.parse_records([self.ent_path],
+                certindex.ENTITLEMENT, processes=2)
+        full = create_from_file(self.ent_path)
+        self.assertEquals(full.serial, records[0]['serial'])
+        self.assertFalse('products' in records[0])
+
+        cert = certindex.record_to_cert(records[0], self.ent_path)
+        self.assertFalse(cert.is_decoded())
+        self.assertEquals(full.products[0].id, cert.products[0].id)
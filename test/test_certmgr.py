@@ -145,6 +145,15 @@ class TestActionClient(ActionClientTestBase):
         actionclient = action_client.ActionClient()
         actionclient.update()
 
+    def test_prune_is_opt_in(self):
+        actionclient = action_client.ActionClient()
+        self.assertEquals(None, actionclient.prunelib)
+        self.assertFalse([lib for lib in actionclient._libset
+            if isinstance(lib, entcertlib.EntCertPruneActionInvoker)])
+
+        actionclient = action_client.ActionClient(prune=True)
+        self.assertTrue(actionclient.prunelib in actionclient._libset)
+
     # see bz #852706
     @mock.patch.object(entcertlib.EntCertActionInvoker, 'update')
     def test_gone_exception(self, mock_update):
@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+from mock import Mock, patch
+
+import fixture
+
+from rhsm.connection import RestlibException
+from subscription_manager import consumer_state
+from subscription_manager.consumer_state import ConsumerState, CONSUMER, \
+        COMPLIANCE, OVERRIDES
+import subscription_manager.injection as inj
+
+
+class ConsumerStateTests(fixture.SubManFixture):
+
+    def setUp(self):
+        super(ConsumerStateTests, self).setUp()
+        self.state = ConsumerState()
+        # Prefetching threads each get a connection of their own, count
+        # calls made through any of them:
+        self.connections = []
+        self.stub_cp_provider.new_consumer_auth_cp = self._new_uep
+        self.uep = self._new_uep()
+
+        dirs_patcher = patch('subscription_manager.consumer_state.cert_dirs_state')
+        self.mock_cert_dirs = dirs_patcher.start()
+        self.mock_cert_dirs.return_value = 'certs1'
+        self.addCleanup(dirs_patcher.stop)
+
+    def _new_uep(self):
+        uep = Mock()
+        uep.getConsumer = Mock(return_value={'uuid': 'UUID'})
+        uep.getCompliance = Mock(return_value={'status': 'valid'})
+        uep.getContentOverrides = Mock(return_value=[])
+        self.connections.append(uep)
+        return uep
+
+    def _calls(self, method):
+        return sum([getattr(uep, method).call_count
+            for uep in self.connections])
+
+    def test_shared_between_requesters(self):
+        self.assertEquals({'uuid': 'UUID'},
+                self.state.get_consumer(self.uep, 'UUID', 'first'))
+        self.assertEquals({'uuid': 'UUID'},
+                self.state.get_consumer(self.uep, 'UUID', 'second'))
+        self.assertEquals(1, self.uep.getConsumer.call_count)
+
+    def test_same_requester_fetches_again(self):
+        self.state.get_consumer(self.uep, 'UUID', 'first')
+        self.state.get_consumer(self.uep, 'UUID', 'first')
+        self.assertEquals(2, self.uep.getConsumer.call_count)
+
+    def test_prefetch(self):
+        self.state.prefetch(self.uep, 'UUID', [CONSUMER, COMPLIANCE, OVERRIDES])
+        self.assertEquals(1, self._calls('getConsumer'))
+        self.assertEquals(1, self._calls('getCompliance'))
+        self.assertEquals(1, self._calls('getContentOverrides'))
+
+        self.state.get_consumer(self.uep, 'UUID', 'first')
+        self.assertEquals(({'status': 'valid'}, True),
+                self.state.get(self.uep, 'UUID', COMPLIANCE, 'first'))
+        self.assertEquals(1, self._calls('getConsumer'))
+        self.assertEquals(1, self._calls('getCompliance'))
+
+    def test_prefetch_threads_use_own_connections(self):
+        self.state.prefetch(self.uep, 'UUID', [CONSUMER, COMPLIANCE, OVERRIDES])
+        self.assertEquals(3, len(self.connections))
+        for uep in self.connections:
+            self.assertEquals(1, uep.getConsumer.call_count +
+                    uep.getCompliance.call_count +
+                    uep.getContentOverrides.call_count)
+
+    def test_prefetch_skips_fresh_caches(self):
+        status_cache = inj.require(inj.ENTITLEMENT_STATUS_CACHE)
+        status_cache.is_fresh = Mock(return_value=True)
+        self.state.prefetch(self.uep, 'UUID', [CONSUMER, COMPLIANCE])
+        self.assertEquals(1, self._calls('getConsumer'))
+        self.assertEquals(0, self._calls('getCompliance'))
+
+    def test_error_raised_to_requester(self):
+        self.uep.getContentOverrides = Mock(side_effect=RestlibException(404, "boom"))
+        self.assertRaises(RestlibException, self.state.get, self.uep, 'UUID',
+                OVERRIDES, 'first')
+        self.assertEquals({'uuid': 'UUID'},
+                self.state.get_consumer(self.uep, 'UUID', 'first'))
+
+    def test_error_not_cached(self):
+        self.uep.getContentOverrides = Mock(side_effect=RestlibException(404, "boom"))
+        self.assertRaises(RestlibException, self.state.get, self.uep, 'UUID',
+                OVERRIDES, 'first')
+
+        self.uep.getContentOverrides = Mock(return_value=[])
+        self.assertEquals([], self.state.get(self.uep, 'UUID', OVERRIDES,
+            'second')[0])
+        self.assertEquals(1, self.uep.getContentOverrides.call_count)
+
+    def test_prefetch_error_fetched_again(self):
+        self.state.prefetch(self.uep, 'UUID', [CONSUMER])
+        self.uep.getConsumer.side_effect = RestlibException(500, "boom")
+        self.state._fetched.clear()
+        self.state.prefetch(self.uep, 'UUID', [CONSUMER])
+        self.assertFalse(CONSUMER in self.state._fetched)
+
+        self.uep.getConsumer.side_effect = None
+        self.assertEquals({'uuid': 'UUID'},
+                self.state.get_consumer(self.uep, 'UUID', 'first'))
+        self.assertEquals(3, self.uep.getConsumer.call_count)
+
+    def test_cert_change_invalidates(self):
+        self.state.get_consumer(self.uep, 'UUID', 'first')
+        self.mock_cert_dirs.return_value = 'certs2'
+        self.state.get_consumer(self.uep, 'UUID', 'second')
+        self.assertEquals(2, self.uep.getConsumer.call_count)
+
+    def test_other_consumer(self):
+        self.state.get_consumer(self.uep, 'UUID', 'first')
+        self.state.get_consumer(self.uep, 'OTHERUUID', 'second')
+        self.assertEquals(2, self.uep.getConsumer.call_count)
+
+    def test_expired(self):
+        self.state.get_consumer(self.uep, 'UUID', 'first')
+        self.state._fetched[CONSUMER].fetched_at -= consumer_state.MAX_AGE
+        self.state.get_consumer(self.uep, 'UUID', 'second')
+        self.assertEquals(2, self.uep.getConsumer.call_count)
+
+    def test_status_cache_uses_prefetched(self):
+        self.state.prefetch(self.uep, 'UUID', [COMPLIANCE])
+        inj.provide(inj.CONSUMER_STATE, self.state)
+
+        status_cache = inj.require(inj.ENTITLEMENT_STATUS_CACHE)
+        self.assertEquals({'status': 'valid'},
+                status_cache.load_status(self.uep, 'UUID'))
+        self.assertEquals(1, self.uep.getCompliance.call_count)
@@ -94,3 +94,94 @@ class UpdateActionTests(SubManFixture):
 
         exceptions = update_action.report.exceptions()
         self.assertEquals([], exceptions)
+
+
+class PruneActionTests(SubManFixture):
+
+    def setUp(self):
+        super(PruneActionTests, self).setUp()
+        now = datetime.now()
+        self.long_expired = StubEntitlementCertificate(StubProduct("POld"),
+                start_date=now - timedelta(days=400),
+                end_date=now - timedelta(days=40))
+        self.recently_expired = StubEntitlementCertificate(StubProduct("PRecent"),
+                start_date=now - timedelta(days=400),
+                end_date=now - timedelta(days=2))
+        self.valid = StubEntitlementCertificate(StubProduct("PValid"))
+        self.ent_dir = StubEntitlementDirectory([self.long_expired,
+            self.recently_expired, self.valid])
+        self.ent_dir.archive = Mock(side_effect=lambda certs: certs)
+        inj.provide(inj.ENT_DIR, self.ent_dir)
+
+    def test_archives_certs_expired_past_grace_period(self):
+        report = entcertlib.EntCertPruneAction(grace_period=30).perform()
+        self.ent_dir.archive.assert_called_once_with([self.long_expired])
+        self.assertEquals([self.long_expired], report.archived)
+
+    def test_nothing_archived_when_disabled(self):
+        report = entcertlib.EntCertPruneAction(grace_period=0).perform()
+        self.assertFalse(self.ent_dir.archive.called)
+        self.assertEquals([], report.archived)
+
+    def test_archived_serials_not_fetched_again(self):
+        self.ent_dir.list_archived_serials = Mock()
+        self.ent_dir.is_archived = Mock(
+                side_effect=lambda sn: sn == self.long_expired.serial)
+        update_action = TestingUpdateAction()
+        missing = update_action._find_missing_serials(
+                {self.recently_expired.serial: self.recently_expired},
+                [self.long_expired.serial, self.recently_expired.serial,
+                    self.valid.serial])
+        self.assertEquals([self.valid.serial], missing)
+        # Only the serials we don't have are looked for in the archive:
+        self.assertEquals(2, self.ent_dir.is_archived.call_count)
+        self.assertFalse(self.ent_dir.list_archived_serials.called)
+
+
+class BundlesInstallerTests(SubManFixture):
+
+    def setUp(self):
+        super(BundlesInstallerTests, self).setUp()
+        # Same dates, so the certificates compare equal:
+        start = datetime.now() - timedelta(days=1)
+        end = datetime.now() + timedelta(days=10)
+        self.landed = StubEntitlementCertificate(StubProduct("PLanded"),
+                start_date=start, end_date=end)
+        self.failed = StubEntitlementCertificate(StubProduct("PFailed"),
+                start_date=start, end_date=end)
+        self.bundles = [{'key': Mock(), 'cert': self.failed},
+                {'key': Mock(), 'cert': self.landed}]
+
+        build_patcher = patch.object(entcertlib.EntitlementCertBundleInstaller,
+                'build_cert', side_effect=lambda b: (b['key'], b['cert']))
+        build_patcher.start()
+        self.addCleanup(build_patcher.stop)
+        hook_patcher = patch.object(entcertlib.EntitlementCertBundleInstaller,
+                'post_install')
+        self.mock_post_install = hook_patcher.start()
+        self.addCleanup(hook_patcher.stop)
+        writer_patcher = patch("subscription_manager.entcertlib.Writer")
+        self.writer = writer_patcher.start().return_value
+        self.addCleanup(writer_patcher.stop)
+
+    def test_hooks_run_after_commit(self):
+        def commit():
+            self.assertFalse(self.mock_post_install.called)
+            self.assertEquals([], report.added)
+        self.writer.commit.side_effect = commit
+
+        report = entcertlib.EntCertUpdateReport()
+        entcertlib.EntitlementCertBundlesInstaller(report).install(self.bundles)
+        self.assertEquals(2, len(report.added))
+        self.assertEquals(2, self.mock_post_install.call_count)
+
+    def test_failed_commit_reports_landed_certs(self):
+        self.writer.commit.side_effect = OSError("Disk full")
+        self.writer.landed.return_value = [self.landed]
+
+        report = entcertlib.EntCertUpdateReport()
+        entcertlib.EntitlementCertBundlesInstaller(report).install(self.bundles)
+        self.assertEquals(1, len(report.added))
+        self.assertTrue(report.added[0] is self.landed)
+        self.assertEquals(1, len(report._exceptions))
+        self.mock_post_install.assert_called_once_with(self.bundles[1])
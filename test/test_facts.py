@@ -1,11 +1,13 @@
 import tempfile
 import shutil
-from mock import patch
+import unittest
+from mock import Mock, patch
 
 import fixture
 from stubs import StubEntitlementDirectory, StubProductDirectory
 from subscription_manager import facts
 from rhsm import ourjson as json
+from iniparse.compat import NoOptionError
 
 facts_buf = """
 {
@@ -124,6 +126,37 @@ def stub_get_facts():
     return {'newstuff': True}
 
 
+class TestFactsDiff(unittest.TestCase):
+    def test_diff(self):
+        old = {'a': 1, 'b': 2, 'c': 3}
+        new = {'b': 2, 'c': 4, 'd': 5}
+        diff = facts.FactsDiff(old, new)
+        self.assertTrue(diff)
+        self.assertEquals({'d': 5}, diff.added)
+        self.assertEquals({'a': 1}, diff.removed)
+        self.assertEquals({'c': (3, 4)}, diff.changed)
+        self.assertEquals("added: d; removed: a; changed: c", str(diff))
+
+    def test_graylist_globs(self):
+        old = {'net.interface.eth0.ipv6_address.global': 'fe80::1',
+               'net.interface.eth0.mac_address': '00:11'}
+        new = {'net.interface.eth0.ipv6_address.global': 'fe80::2',
+               'net.interface.eth1.ipv6_address.global': 'fe80::3',
+               'net.interface.eth0.mac_address': '00:11'}
+        diff = facts.FactsDiff(old, new, ['net.interface.*.ipv6_address.*'])
+        self.assertFalse(diff)
+        self.assertEquals("no changes", str(diff))
+
+    @patch('subscription_manager.facts.cfg')
+    def test_configured_graylist(self, mock_cfg):
+        mock_cfg.get = Mock(return_value="net.interface.*.ipv6_address.*,\n"
+                                          "  network.ipv6_address")
+        self.assertEquals(['net.interface.*.ipv6_address.*', 'network.ipv6_address'],
+                          facts.configured_graylist())
+        mock_cfg.get = Mock(side_effect=NoOptionError('fact_graylist', 'rhsm'))
+        self.assertEquals([], facts.configured_graylist())
+
+
 class TestFacts(fixture.SubManFixture):
     def setUp(self):
         super(TestFacts, self).setUp()
@@ -179,6 +212,40 @@ class TestFacts(fixture.SubManFixture):
         self.assertEquals(self.f.facts['cpu.cpu_socket(s)'], '16')
         self.assertTrue(changed)
 
+    @patch('subscription_manager.facts.Facts._load_custom_facts',
+           return_value={})
+    @patch('subscription_manager.facts.Facts._load_hw_facts')
+    def test_facts_has_changed_digest(self, mock_load_hw, mock_load_cf):
+        test_facts = json.loads(facts_buf)
+        mock_load_hw.return_value = test_facts
+        self.f.write_cache()
+
+        # Graylisted facts don't count as a change:
+        test_facts['cpu.cpu_mhz'] = '1200'
+        with patch.object(self.f, '_read_cache') as mock_read_cache:
+            self.assertFalse(self.f.has_changed())
+            test_facts['cpu.cpu_socket(s)'] = '16'
+            self.assertTrue(self.f.has_changed())
+            self.assertEquals(0, mock_read_cache.call_count)
+
+    @patch('subscription_manager.facts.Facts._load_custom_facts',
+           return_value={})
+    @patch('subscription_manager.facts.Facts._load_hw_facts')
+    def test_facts_has_changed_graylist_glob(self, mock_load_hw, mock_load_cf):
+        test_facts = json.loads(facts_buf)
+        mock_load_hw.return_value = test_facts
+        self.f.graylist = self.f.graylist + ['net.interface.*.ipv6_address.*']
+        self.f.write_cache()
+
+        test_facts['net.interface.eth0.ipv6_address.global'] = 'fe80::2'
+        self.assertFalse(self.f.has_changed())
+        test_facts['cpu.cpu_socket(s)'] = '16'
+        # Without a refresh, the facts has_changed() collected are used:
+        self.assertFalse(self.f.get_diff())
+        diff = self.f.get_diff(True)
+        self.assertEquals({'cpu.cpu_socket(s)': (2, '16')}, diff.changed)
+        self.assertEquals({}, diff.added)
+
     @patch('subscription_manager.facts.Facts._read_cache',
            return_value=None)
     @patch('subscription_manager.facts.Facts._load_custom_facts',
@@ -300,3 +367,23 @@ class TestFacts(fixture.SubManFixture):
         self.assertTrue("system.certificate_version" in self.f.get_facts())
         self.assertEquals(facts.CERT_VERSION,
                 self.f.get_facts()['system.certificate_version'])
+
+    @patch('subscription_manager.hwprobe.Hardware')
+    def test_hw_probe_cache_written(self, mock_hardware):
+        probe_cache_file = self.fact_cache_dir + "/hardware_probes.json"
+        patcher = patch.object(facts.HardwareProbeCache, 'CACHE_FILE',
+                               probe_cache_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def hardware(probe_cache):
+            probe_cache['get_release_info'] = {'key': 'key1',
+                                               'facts': {'distribution.name': 'Foo'}}
+            mock_hardware.return_value.probe_cache_changed = True
+            return mock_hardware.return_value
+        mock_hardware.side_effect = hardware
+        mock_hardware.return_value.get_all.return_value = {'distribution.name': 'Foo'}
+
+        self.assertEquals({'distribution.name': 'Foo'}, self.f._load_hw_facts())
+        self.assertEquals('key1',
+                facts.HardwareProbeCache().probes['get_release_info']['key'])
@@ -0,0 +1,139 @@
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from subscription_manager import file_monitor
+
+
+def touch(path, mtime):
+    f = open(path, 'w')
+    f.close()
+    os.utime(path, (mtime, mtime))
+
+
+class MonitorDirectoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, True)
+        touch(os.path.join(self.path, '1.pem'), 1000)
+        os.utime(self.path, (1000, 1000))
+        self.directory = file_monitor.MonitorDirectory(self.path)
+
+    def test_unchanged(self):
+        self.assertFalse(self.directory.update())
+        self.assertEquals(set(), self.directory.changed_files)
+
+    def test_added_and_removed(self):
+        os.unlink(os.path.join(self.path, '1.pem'))
+        touch(os.path.join(self.path, '2.pem'), 2000)
+        os.utime(self.path, (2000, 2000))
+        self.assertTrue(self.directory.update())
+        self.assertEquals(set(['1.pem', '2.pem']), self.directory.changed_files)
+
+        # Only reported once:
+        self.assertFalse(self.directory.update())
+        self.assertEquals(set(), self.directory.changed_files)
+
+    def test_changed(self):
+        touch(os.path.join(self.path, '1.pem'), 2000)
+        touch(os.path.join(self.path, '2.pem'), 1000)
+        os.utime(self.path, (2000, 2000))
+        self.assertTrue(self.directory.update())
+        self.assertEquals(set(['1.pem', '2.pem']), self.directory.changed_files)
+
+    def test_removed_directory(self):
+        shutil.rmtree(self.path)
+        self.assertTrue(self.directory.update())
+        self.assertEquals(set(['1.pem']), self.directory.changed_files)
+        self.assertFalse(self.directory.exists)
+
+
+class GioMonitorDirectoryTests(unittest.TestCase):
+
+    def setUp(self):
+        gio_patcher = patch('subscription_manager.file_monitor.gio')
+        self.mock_gio = gio_patcher.start()
+        self.addCleanup(gio_patcher.stop)
+        self.on_event = Mock()
+        self.directory = file_monitor.GioMonitorDirectory('/some/dir',
+                self.on_event)
+        monitor = self.mock_gio.File.return_value.monitor_directory.return_value
+        self.callback = monitor.connect.call_args[0][1]
+
+    def _file(self, path):
+        f = Mock()
+        f.get_path.return_value = path
+        f.get_basename.return_value = os.path.basename(path)
+        return f
+
+    def test_watches_directory(self):
+        self.mock_gio.File.assert_called_with('/some/dir')
+        self.assertFalse(self.directory.update())
+
+    def test_changed_files(self):
+        self.callback(None, self._file('/some/dir/1.pem'), None, 0)
+        self.callback(None, self._file('/some/dir/2.pem'),
+                self._file('/some/dir/3.pem'), 0)
+        self.assertEquals(2, self.on_event.call_count)
+        self.assertTrue(self.directory.update())
+        self.assertEquals(set(['1.pem', '2.pem', '3.pem']),
+                self.directory.changed_files)
+
+        # Only reported once:
+        self.assertFalse(self.directory.update())
+        self.assertEquals(set(), self.directory.changed_files)
+
+    def test_directory_event(self):
+        self.callback(None, self._file('/some/dir'), None, 0)
+        self.assertTrue(self.directory.update())
+        self.assertEquals(set(), self.directory.changed_files)
+
+
+class MonitorTests(unittest.TestCase):
+
+    @patch('subscription_manager.file_monitor.gio', None)
+    def test_files_changed(self):
+        monitor = file_monitor.Monitor()
+        directories = [Mock(), Mock(), Mock()]
+        for (directory, result) in zip(directories, [False, True, False]):
+            directory.update.return_value = result
+        directories[1].changed_files = set(['1.pem'])
+        monitor.dirs = directories
+
+        changed = Mock()
+        files_changed = Mock()
+        monitor.connect('changed', changed)
+        monitor.connect('files-changed', files_changed)
+        monitor.run_check()
+        changed.assert_called_with(monitor, False, True, False)
+        files_changed.assert_called_with(monitor, None, set(['1.pem']), None)
+
+    @patch('subscription_manager.file_monitor.gio', None)
+    def test_nothing_changed(self):
+        monitor = file_monitor.Monitor()
+        directory = Mock()
+        directory.update.return_value = False
+        monitor.dirs = [directory]
+        files_changed = Mock()
+        monitor.connect('files-changed', files_changed)
+        monitor.run_check()
+        self.assertFalse(files_changed.called)
@@ -12,7 +12,11 @@
 # granted to use or replicate Red Hat trademarks that are incorporated
 # in this software or its documentation.
 
+import os
+import shutil
+import tempfile
 import unittest
+import threading
 
 
 import cStringIO
@@ -144,6 +148,48 @@ class TestGatherEntries(unittest.TestCase):
         self.assertEquals(2, len(ent_list))
 
 
+class TestCpumask(unittest.TestCase):
+    def test_single(self):
+        self.assertEquals(0x2, hwprobe.cpumask_from_list("1"))
+
+    def test_ranges(self):
+        mask = hwprobe.cpumask_from_list("0-3,8")
+        self.assertEquals(0x10f, mask)
+        self.assertEquals(5, hwprobe.count_cpumask(mask))
+
+    def test_matches_gather_entries(self):
+        for ent in ["1,2,3,4", "1-4,9-12", "0,2", "0-1023",
+                    "0,4,8,12,16,20,24,28,32,36,40,44,48,52,56,60"]:
+            self.assertEquals(len(hwprobe.gather_entries(ent)),
+                    hwprobe.count_cpumask(hwprobe.cpumask_from_list(ent)))
+
+
+class TestRunProbes(unittest.TestCase):
+
+    def test_results(self):
+        def fails():
+            raise ValueError("boom")
+        probes = [Mock(), fails, Mock()]
+        durations, errors, timed_out = hwprobe.run_probes(probes, 30, 2)
+        for probe in probes:
+            self.assertTrue(probe in durations)
+        self.assertEquals([fails], errors.keys())
+        self.assertEquals([], timed_out)
+        self.assertEquals(1, probes[0].call_count)
+        self.assertEquals(1, probes[2].call_count)
+
+    def test_timeout(self):
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+        hangs = Mock(side_effect=hang.wait)
+        fast = Mock()
+        # The hanging probe holds up the only thread, another takes over:
+        durations, errors, timed_out = hwprobe.run_probes([hangs, fast], 0.1, 1)
+        self.assertEquals([hangs], timed_out)
+        self.assertEquals([fast], durations.keys())
+        self.assertEquals(1, fast.call_count)
+
+
 class GenericPlatformSpecificInfoProviderTests(fixture.SubManFixture):
     def test(self):
         hw_info = {}
@@ -179,6 +225,26 @@ class HardwareProbeTests(fixture.SubManFixture):
         hw = hwprobe.Hardware()
         self.assertEquals('this is valid', hw._get_output('testing'))
 
+    @patch('os.kill')
+    @patch('os.killpg')
+    @patch('subprocess.Popen')
+    def test_command_timeout(self, MockPopen, mock_killpg, mock_kill):
+        killed = threading.Event()
+        mock_killpg.side_effect = lambda pid, sig: killed.set()
+        mock_kill.side_effect = mock_killpg.side_effect
+
+        def communicate():
+            killed.wait()
+            return ['', None]
+        MockPopen.return_value.communicate.side_effect = communicate
+
+        reload(hwprobe)
+        hw = hwprobe.Hardware()
+        hw.COMMAND_TIMEOUT = 0.1
+        self.assertRaises(hwprobe.CommandTimeoutError, hw._get_output, 'test')
+        self.assertEquals(1, mock_killpg.call_count + mock_kill.call_count)
+        self.assertFalse('preexec_fn' in MockPopen.call_args[1])
+
     @patch('subprocess.Popen')
     def test_virt_guest(self, MockPopen):
         MockPopen.return_value.communicate.return_value = ['kvm', None]
@@ -740,3 +806,149 @@ class HardwareProbeTests(fixture.SubManFixture):
                                 'cpu.topology_source':
                                     'kernel /sys cpu sibling lists'},
                                hw.get_cpu_info())
+
+    def _probes(self, hw, called):
+        def probe(name, facts):
+            def hardware_method():
+                called.append(name)
+                hw.allhw.update(facts)
+            hardware_method.__name__ = name
+            return hardware_method
+
+        for name in ['get_uname_info', 'get_release_info', 'get_mem_info',
+                     'get_cpu_info', 'get_ls_cpu_info', 'get_network_info',
+                     'get_network_interfaces']:
+            setattr(hw, name, probe(name, {}))
+        hw.get_virt_info = probe('get_virt_info', {'virt.is_guest': True})
+        hw.get_platform_specific_info = probe('get_platform_specific_info',
+                {'dmi.system.uuid': 'some-uuid'})
+        hw.get_virt_uuid = probe('get_virt_uuid', {})
+
+    def test_get_all_order(self):
+        hw = hwprobe.Hardware()
+        called = []
+        self._probes(hw, called)
+        hw.get_all()
+        self.assertEquals(10, len(called))
+        self.assertEquals(['get_platform_specific_info', 'get_virt_uuid'], called[-2:])
+        self.assertEquals(9, len(hw.probe_durations))
+
+    def test_get_all_timeout(self):
+        hw = hwprobe.Hardware()
+        hw.PROBE_TIMEOUT = 0.1
+        hw.PROBE_TIMEOUTS = {}
+        self._probes(hw, [])
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+
+        def get_virt_info():
+            hang.wait()
+        hw.get_virt_info = get_virt_info
+
+        facts = hw.get_all()
+        self.assertFalse('get_virt_info' in hw.probe_durations)
+        self.assertEquals('some-uuid', facts['dmi.system.uuid'])
+        self.assertEquals('Unknown', facts['virt.is_guest'])
+
+    def _cached_probe(self, hw, called, facts):
+        def get_release_info():
+            called.append('get_release_info')
+            if facts is None:
+                hw._failed_probes.add('get_release_info')
+                return {}
+            hw.allhw.update(facts)
+            return facts
+        return hw._cached(get_release_info)
+
+    def test_probe_cache_reused(self):
+        probe_cache = {}
+        called = []
+        hw = hwprobe.Hardware(probe_cache=probe_cache)
+        hw.probe_key = Mock(return_value='key1')
+        self._cached_probe(hw, called, {'distribution.name': 'Foo'})()
+        self.assertTrue(hw.probe_cache_changed)
+        self.assertEquals({'key': 'key1', 'facts': {'distribution.name': 'Foo'}},
+                          probe_cache['get_release_info'])
+
+        hw = hwprobe.Hardware(probe_cache=probe_cache)
+        hw.probe_key = Mock(return_value='key1')
+        self._cached_probe(hw, called, {'distribution.name': 'Bar'})()
+        self.assertEquals(1, len(called))
+        self.assertFalse(hw.probe_cache_changed)
+        self.assertEquals('Foo', hw.allhw['distribution.name'])
+
+    def test_probe_cache_key_changed(self):
+        probe_cache = {'get_release_info': {'key': 'key1',
+                                            'facts': {'distribution.name': 'Foo'}}}
+        called = []
+        hw = hwprobe.Hardware(probe_cache=probe_cache)
+        hw.probe_key = Mock(return_value='key2')
+        self._cached_probe(hw, called, {'distribution.name': 'Bar'})()
+        self.assertEquals(1, len(called))
+        self.assertEquals('Bar', hw.allhw['distribution.name'])
+        self.assertEquals('key2', probe_cache['get_release_info']['key'])
+
+    def test_probe_cache_skips_failed(self):
+        probe_cache = {'get_release_info': {'key': 'key1',
+                                            'facts': {'distribution.name': 'Foo'}}}
+        hw = hwprobe.Hardware(probe_cache=probe_cache)
+        hw.probe_key = Mock(return_value='key2')
+        self._cached_probe(hw, [], None)()
+        self.assertTrue(hw.probe_cache_changed)
+        self.assertEquals({}, probe_cache)
+
+    def test_probe_key_volatile(self):
+        hw = hwprobe.Hardware()
+        self.assertEquals(None, hw.probe_key('get_mem_info'))
+        hw = hwprobe.Hardware(prefix='/tmp', testing=True)
+        self.assertEquals(None, hw.probe_key('get_release_info'))
+
+    def test_timeout_uses_last_facts(self):
+        probe_cache = {'get_virt_info': {'key': 'key1',
+                                         'facts': {'virt.is_guest': False}}}
+        hw = hwprobe.Hardware(probe_cache=probe_cache)
+        hw.probe_key = Mock(return_value='key2')
+        hw.PROBE_TIMEOUTS = {'get_virt_info': 0.1}
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+
+        def get_virt_info():
+            hang.wait()
+        hw._run_probes([get_virt_info])
+        self.assertEquals(False, hw.allhw['virt.is_guest'])
+
+    def test_command_timeout_uses_last_facts(self):
+        probe_cache = {'get_virt_info': {'key': 'key1',
+                                         'facts': {'virt.is_guest': False}}}
+        hw = hwprobe.Hardware(probe_cache=probe_cache)
+        hw.probe_key = Mock(return_value='key2')
+
+        def get_virt_info():
+            raise hwprobe.CommandTimeoutError('virt-what', 8)
+        hw._run_probes([get_virt_info])
+        self.assertEquals(False, hw.allhw['virt.is_guest'])
+        self.assertEquals('key1', probe_cache['get_virt_info']['key'])
+
+    def test_virt_timeout_without_last_facts(self):
+        hw = hwprobe.Hardware(probe_cache={})
+
+        def get_virt_info():
+            raise hwprobe.CommandTimeoutError('virt-what', 8)
+        hw._run_probes([get_virt_info])
+        self.assertEquals('Unknown', hw.allhw['virt.is_guest'])
+        self.assertEquals('Unknown', hw.allhw['virt.host_type'])
+
+    def test_count_cpumask_entries(self):
+        cpu_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cpu_dir)
+        os.mkdir(os.path.join(cpu_dir, 'topology'))
+        for (field, entries) in [('thread_siblings_list', '0-1\n'),
+                                 ('core_siblings_list', '')]:
+            f = open(os.path.join(cpu_dir, 'topology', field), 'w')
+            f.write(entries)
+            f.close()
+
+        hw = hwprobe.Hardware()
+        self.assertEquals(2, hw.count_cpumask_entries(cpu_dir, 'thread_siblings_list'))
+        self.assertEquals(None, hw.count_cpumask_entries(cpu_dir, 'core_siblings_list'))
+        self.assertEquals(None, hw.count_cpumask_entries(cpu_dir, 'book_siblings_list'))
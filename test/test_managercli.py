@@ -155,6 +155,28 @@ class TestCleanCommand(TestCliCommand):
     command_class = managercli.CleanCommand
 
 
+class TestCacheCommand(TestCliCommand):
+    command_class = managercli.CacheCommand
+
+    def test_list(self):
+        self.cc._do_command = self._orig_do_command
+        with Capture() as cap:
+            self.cc.main(["--list"])
+        self.assertTrue("packages" in cap.out)
+        self.assertTrue("entitlement_status" in cap.out)
+
+    def test_invalidate(self):
+        self.cc._do_command = self._orig_do_command
+        with patch.object(managercli.cache.ProfileManager, 'delete_cache') as mock_delete:
+            with Capture():
+                self.cc.main(["--invalidate", "packages"])
+        mock_delete.assert_called_once_with()
+
+    def test_invalidate_unknown(self):
+        self.cc._do_command = self._orig_do_command
+        self.assertRaises(SystemExit, self.cc.main, ["--invalidate", "nosuchcache"])
+
+
 class TestRefreshCommand(TestCliProxyCommand):
     command_class = managercli.RefreshCommand
 
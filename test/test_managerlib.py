@@ -301,7 +301,7 @@ class PoolFilterTests(unittest.TestCase):
         product1 = 'product1'
         product2 = 'product2'
 
-        pd = StubCertificateDirectory([
+        pd = StubProductDirectory([
             StubProductCertificate(StubProduct(product2))])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
@@ -319,7 +319,7 @@ class PoolFilterTests(unittest.TestCase):
         product1 = 'product1'
         product2 = 'product2'
         provided = 'providedProduct'
-        pd = StubCertificateDirectory([
+        pd = StubProductDirectory([
             StubProductCertificate(StubProduct(provided))])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
@@ -335,7 +335,7 @@ class PoolFilterTests(unittest.TestCase):
     def test_installed_filter_direct_match(self):
         product1 = 'product1'
         product2 = 'product2'
-        pd = StubCertificateDirectory([
+        pd = StubProductDirectory([
             StubProductCertificate(StubProduct(product2))])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
@@ -353,7 +353,7 @@ class PoolFilterTests(unittest.TestCase):
         product1 = 'product1'
         product2 = 'product2'
         provided = 'providedProduct'
-        pd = StubCertificateDirectory([
+        pd = StubProductDirectory([
             StubProductCertificate(StubProduct(provided))])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
@@ -370,7 +370,7 @@ class PoolFilterTests(unittest.TestCase):
         product1 = 'product1'
         product2 = 'product2'
         provided = 'providedProduct'
-        pd = StubCertificateDirectory([
+        pd = StubProductDirectory([
             StubProductCertificate(StubProduct(provided)),
             StubProductCertificate(StubProduct(product2))])
         pool_filter = PoolFilter(product_dir=pd,
@@ -387,7 +387,7 @@ class PoolFilterTests(unittest.TestCase):
     def test_filter_product_name(self):
         product1 = 'Foo Product'
         product2 = 'Bar Product'
-        pd = StubCertificateDirectory([])
+        pd = StubProductDirectory([])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
 
@@ -402,7 +402,7 @@ class PoolFilterTests(unittest.TestCase):
     def test_filter_product_name_matches_provided(self):
         product1 = 'Foo Product'
         product2 = 'Bar Product'
-        pd = StubCertificateDirectory([])
+        pd = StubProductDirectory([])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
 
@@ -417,7 +417,7 @@ class PoolFilterTests(unittest.TestCase):
         product1 = "Test Product 1"
         provided1 = "Provided By Test Product 1"
 
-        pd = StubCertificateDirectory([])
+        pd = StubProductDirectory([])
         pool_filter = PoolFilter(product_dir=pd,
                 entitlement_dir=StubCertificateDirectory([]))
 
@@ -444,7 +444,7 @@ class PoolFilterTests(unittest.TestCase):
                                                    end_date=cert_end)
 
         ent_dir = StubCertificateDirectory([cert1])
-        pool_filter = PoolFilter(product_dir=StubCertificateDirectory([]),
+        pool_filter = PoolFilter(product_dir=StubProductDirectory([]),
                 entitlement_dir=ent_dir)
 
         pools = [
@@ -472,7 +472,7 @@ class PoolFilterTests(unittest.TestCase):
         ent_dir = StubCertificateDirectory([cert1])
         mock_sorter = Mock()
         mock_sorter.valid_products = {cert1.products[0].id: set([cert1])}
-        pool_filter = PoolFilter(product_dir=StubCertificateDirectory([]),
+        pool_filter = PoolFilter(product_dir=StubProductDirectory([]),
                 entitlement_dir=ent_dir,
                 sorter=mock_sorter)
 
@@ -503,7 +503,7 @@ class PoolFilterTests(unittest.TestCase):
         ent_dir = StubCertificateDirectory([cert1])
         mock_sorter = Mock()
         mock_sorter.valid_products = {}
-        pool_filter = PoolFilter(product_dir=StubCertificateDirectory([]),
+        pool_filter = PoolFilter(product_dir=StubProductDirectory([]),
                 entitlement_dir=ent_dir,
                 sorter=mock_sorter)
 
@@ -530,7 +530,7 @@ class PoolFilterTests(unittest.TestCase):
                                                    end_date=cert_end)
 
         ent_dir = StubCertificateDirectory([cert1])
-        pool_filter = PoolFilter(product_dir=StubCertificateDirectory([]),
+        pool_filter = PoolFilter(product_dir=StubProductDirectory([]),
                 entitlement_dir=ent_dir)
 
         begin_date = datetime.now() - timedelta(days=100)
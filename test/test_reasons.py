@@ -111,6 +111,14 @@ class ReasonsTests(unittest.TestCase):
         actual = sub_reason_map[ENT_ID_2][0]
         self.assertEquals(expected, actual)
 
+    def test_get_subscription_reasons_map_without_order(self):
+        no_order = StubEntitlementCertificate(PROD_1, ent_id='NoOrderId')
+        no_order.order = None
+        self.sorter.valid_entitlement_certs.append(no_order)
+        sub_reason_map = self.sorter.reasons.get_subscription_reasons_map()
+        self.assertEquals([], sub_reason_map['NoOrderId'])
+        self.assertEquals(1, len(self.sorter.reasons.get_stack_subscriptions(STACK_1)))
+
     def test_get_reason_id(self):
         reason = self.build_ent_reason_with_attrs(
                 'SOCKETS', 'some message', '8', '6', ent='1234')